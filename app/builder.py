@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+from .cache import IndexCache
+from .db import get_generation_db, get_search_backend_db
+from .hybrid import HybridIndex
+from .snapshot import load_snapshot, save_snapshot
+
+Update = Callable[[HybridIndex], None]
+
+# 多个 worker 进程共享 data/index 下的快照：查询时最多每隔这么久对一次数据库里的 generation，
+# 别的进程写入后从新快照重新映射
+GENERATION_CHECK_INTERVAL = float(os.environ.get("INDEX_GENERATION_CHECK_INTERVAL", "1.0"))
+# 数据库 generation 领先而一直等不到新快照（写入的进程没加载这个索引）时，自己重建
+STALE_REBUILD_AFTER = float(os.environ.get("INDEX_STALE_REBUILD_AFTER", "5.0"))
+
+
+class IndexBuilder:
+    """
+    每个笔记本的索引构建器：
+      - get: 缓存里没有时加载（快照或全量构建），同一笔记本的并发请求只加载一次
+      - submit: 写操作把增量更新 / 全量重建交给后台线程，请求立即返回；
+        同一笔记本的任务串行执行，排队中的多个重建合并成一次
+      - 全量重建在新对象上进行，旧索引继续服务查询，建好后在缓存里一次性替换
+      - 每次构建 / 更新保存快照后改用快照的 mmap 映射，多个 worker 进程共享同一批只读页；
+        get 时定期检查数据库 generation，别的进程写入后重新映射
+    """
+
+    def __init__(
+        self,
+        cache: IndexCache,
+        build: Callable[[Optional[str]], HybridIndex],
+        max_workers: int = 2,
+    ):
+        self.cache = cache
+        self._build = build
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index-builder")
+        self._lock = threading.Lock()
+        # 每个笔记本一把锁：加载和应用增量更新互斥，保证更新不会落在过期的索引上
+        self._notebook_locks: Dict[Optional[str], threading.RLock] = {}
+        self._updates: Dict[Optional[str], List[Update]] = {}
+        self._rebuilds: Set[Optional[str]] = set()
+        self._running: Set[Optional[str]] = set()
+        self._idle = threading.Condition(self._lock)
+        self._checked_at: Dict[Optional[str], float] = {}
+        self._stale_since: Dict[Optional[str], float] = {}
+
+    def _notebook_lock(self, notebook_id: Optional[str]) -> threading.RLock:
+        with self._lock:
+            return self._notebook_locks.setdefault(notebook_id, threading.RLock())
+
+    def get(self, notebook_id: Optional[str]) -> HybridIndex:
+        index = self.cache.get(notebook_id)
+        if index is not None:
+            return self._check_generation(notebook_id, index)
+        with self._notebook_lock(notebook_id):
+            index = self.cache.get(notebook_id)
+            if index is None:
+                # 重启或被淘汰后优先 mmap 磁盘上的快照，不用重新分词
+                index = load_snapshot(notebook_id, get_generation_db(notebook_id)) if notebook_id else None
+                if index is None:
+                    index = self._remap(notebook_id, self._build(notebook_id))
+                self.cache.put(notebook_id, index)
+                self._checked_at[notebook_id] = time.time()
+            return index
+
+    def _remap(self, notebook_id: Optional[str], index: HybridIndex) -> HybridIndex:
+        # 刚保存的快照换成 mmap 映射，释放本进程堆上的副本（FTS 后端没有快照）
+        if not notebook_id or not isinstance(index, HybridIndex):
+            return index
+        return load_snapshot(notebook_id, index.generation) or index
+
+    def _check_generation(self, notebook_id: Optional[str], index: HybridIndex) -> HybridIndex:
+        """
+        别的 worker 进程写入后数据库 generation 会领先于本进程的索引：
+        有对应快照就重新映射；本进程自己有排队的更新就等它完成
+        """
+        now = time.time()
+        if not notebook_id or now - self._checked_at.get(notebook_id, 0.0) < GENERATION_CHECK_INTERVAL:
+            return index
+        self._checked_at[notebook_id] = now
+        generation = get_generation_db(notebook_id)
+        if generation == index.generation:
+            self._stale_since.pop(notebook_id, None)
+            return index
+        if not isinstance(index, HybridIndex):
+            # FTS 后端查询时直接读数据库，别的进程写入后不用重新加载；
+            # 别的进程把笔记本切回了 hybrid 的话重建
+            if get_search_backend_db(notebook_id) == "hybrid":
+                self.submit(notebook_id)
+            index.generation = generation
+            return index
+        with self._lock:
+            if notebook_id in self._running:
+                return index
+        fresh = load_snapshot(notebook_id, generation)
+        if fresh is not None:
+            with self._notebook_lock(notebook_id):
+                # 期间本进程已经换过索引的话以缓存为准
+                if self.cache.get(notebook_id) is index:
+                    self.cache.put(notebook_id, fresh)
+                    index = fresh
+            self._stale_since.pop(notebook_id, None)
+            print(f"DEBUG: Remapped index for notebook {notebook_id} at generation {generation}")
+            return index
+        stale_since = self._stale_since.setdefault(notebook_id, now)
+        if now - stale_since > STALE_REBUILD_AFTER:
+            self._stale_since.pop(notebook_id, None)
+            self.submit(notebook_id)
+        return index
+
+    def submit(self, notebook_id: Optional[str], update: Optional[Update] = None):
+        """
+        update 为 None 表示全量重建（会覆盖排队中的增量更新）
+        """
+        with self._lock:
+            if update is None:
+                self._rebuilds.add(notebook_id)
+                self._updates.pop(notebook_id, None)
+            elif notebook_id not in self._rebuilds:
+                self._updates.setdefault(notebook_id, []).append(update)
+            if notebook_id in self._running:
+                return
+            self._running.add(notebook_id)
+        self._executor.submit(self._run, notebook_id)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待所有排队的任务完成（测试和关闭时用）
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._running, timeout=timeout)
+
+    def _run(self, notebook_id: Optional[str]):
+        while True:
+            with self._lock:
+                rebuild = notebook_id in self._rebuilds
+                self._rebuilds.discard(notebook_id)
+                updates = self._updates.pop(notebook_id, [])
+                if not rebuild and not updates:
+                    self._running.discard(notebook_id)
+                    self._idle.notify_all()
+                    return
+            try:
+                if rebuild:
+                    self._rebuild(notebook_id)
+                else:
+                    self._apply(notebook_id, updates)
+            except Exception as e:
+                # 增量更新失败时丢掉缓存的索引，下次查询从数据库重新加载
+                print(f"ERROR: Index update for notebook {notebook_id} failed: {e}")
+                self.cache.pop(notebook_id)
+
+    def _rebuild(self, notebook_id: Optional[str]):
+        # 构建期间旧索引照常服务；重建开始后到达的写操作会排在后面，应用到新索引上
+        index = self._remap(notebook_id, self._build(notebook_id))
+        with self._notebook_lock(notebook_id):
+            self.cache.put(notebook_id, index)
+        print(f"DEBUG: Swapped in rebuilt index for notebook {notebook_id} (generation {index.generation})")
+
+    def _apply(self, notebook_id: Optional[str], updates: List[Update]):
+        with self._notebook_lock(notebook_id):
+            index = self.cache.get(notebook_id)
+            # 没加载过的笔记本不用管，下次 get 时从数据库加载到的已经是最新的
+            if index is None or not notebook_id:
+                return
+            # 每次写入 generation 加一：领先的部分多于本进程的更新，说明别的进程也写过，
+            # 增量更新补不全，改为全量重建
+            generation = get_generation_db(notebook_id)
+            if index.generation + len(updates) < generation:
+                self._rebuild(notebook_id)
+                return
+            for update in updates:
+                update(index)
+            index.generation = generation
+            if isinstance(index, HybridIndex) and save_snapshot(notebook_id, index):
+                index = self._remap(notebook_id, index)
+            # 索引大小变了，重新估算并按预算淘汰
+            self.cache.put(notebook_id, index)
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+
+class QueryCache:
+    """
+    有容量上限的 LRU + TTL 缓存，线程安全，带命中 / 未命中计数
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (写入时间, value)，按最近使用排序
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, notebook_id: Optional[str] = None):
+        # key 的第一项约定为 notebook_id
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == notebook_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_NO_KEEP = object()
+
+
+class IndexCache:
+    """
+    按内存预算缓存各笔记本的 HybridIndex：超出预算时按 LRU 淘汰未固定（pin）的索引。
+    淘汰的索引在磁盘上有快照，下次访问时重新 mmap 加载即可。
+    """
+
+    def __init__(self, max_bytes: int, pinned: Iterable[Optional[str]] = ()):
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        # notebook_id -> (index, 估算的字节数)，按最近使用排序
+        self._entries: "OrderedDict[Optional[str], Tuple[Any, int]]" = OrderedDict()
+        self._pinned: Set[Optional[str]] = set(pinned)
+        self.evictions = 0
+
+    def __contains__(self, notebook_id: Optional[str]) -> bool:
+        with self._lock:
+            return notebook_id in self._entries
+
+    def get(self, notebook_id: Optional[str]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(notebook_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(notebook_id)
+            return entry[0]
+
+    def put(self, notebook_id: Optional[str], index: Any):
+        """
+        放入（或在增量更新后重新估算）一个索引，然后按预算淘汰
+        """
+        size = index.memory_usage()["total"]
+        with self._lock:
+            self._entries[notebook_id] = (index, size)
+            self._entries.move_to_end(notebook_id)
+            self._evict(keep=notebook_id)
+
+    def pop(self, notebook_id: Optional[str]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.pop(notebook_id, None)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def pin(self, notebook_id: Optional[str]):
+        with self._lock:
+            self._pinned.add(notebook_id)
+
+    def unpin(self, notebook_id: Optional[str]):
+        with self._lock:
+            self._pinned.discard(notebook_id)
+            self._evict()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def _evict(self, keep: Any = _NO_KEEP):
+        # 刚放进来的索引即使单独超预算也保留，否则这次查询就没有索引可用
+        total = self.total_bytes()
+        for notebook_id in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if notebook_id == keep or notebook_id in self._pinned:
+                continue
+            _, size = self._entries.pop(notebook_id)
+            total -= size
+            self.evictions += 1
+            print(f"DEBUG: Evicted index for notebook {notebook_id} ({size} bytes)")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "total_bytes": self.total_bytes(),
+                "evictions": self.evictions,
+                "pinned": sorted(str(n) for n in self._pinned),
+                "notebooks": [
+                    dict(notebook_id=notebook_id, pinned=notebook_id in self._pinned, **index.memory_usage())
+                    for notebook_id, (index, _) in self._entries.items()
+                ],
+            }
@@ -1,23 +1,112 @@
 import sqlite3
 import os
 import json
-from typing import List, Dict, Optional, Tuple
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, List, Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+from .utils import TOKENIZER_VERSION, pack_features, unpack_features, fts_document, chunk_hash
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 DB_PATH = os.path.join(DATA_DIR, "notebooklm.db")
 
+# Per-connection settings. WAL lets /query reads proceed while ingest writes.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('busy_timeout', '5000'),
+    ('cache_size', '-16000'),      # KiB (negative = size, not pages)
+    ('mmap_size', str(256 << 20)),
+    ('temp_store', 'MEMORY'),
+)
+
+# Bulk-load mode (see bulk_ingest_db): page cache used while loading, in KiB,
+# and the chunk count from which imports switch to it by default
+BULK_CACHE_SIZE_KB = int(os.environ.get('BULK_CACHE_SIZE_KB', str(256 << 10)))
+BULK_LOAD_THRESHOLD = int(os.environ.get('BULK_LOAD_THRESHOLD', '50000'))
+BULK_BATCH_SIZE = 1000
+
+# UPSERT needs SQLite 3.24, window functions (OCR cache eviction) 3.25;
+# json_each needs the JSON1 extension. FTS5 is optional (see FTS_AVAILABLE).
+MIN_SQLITE_VERSION = (3, 25, 0)
+
+_local = threading.local()
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    Returns this thread's connection, opening it on first use. Connections are
+    reused for the life of the thread, so callers must not close them.
+    Autocommit mode: writes go through transaction().
+    """
+    conn = getattr(_local, 'conn', None)
+    # A connection inherited across fork must not be reused in the child
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        _local.conn, _local.pid, _local.depth = conn, os.getpid(), 0
     return conn
 
+def close_db_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction():
+    """
+    Runs the enclosed statements in one write transaction on this thread's
+    connection (BEGIN IMMEDIATE, so concurrent writers wait on busy_timeout
+    instead of failing mid-transaction). Nested uses join the outer one.
+    """
+    conn = get_db_connection()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        _local.depth = 0
+
+def _check_sqlite(conn):
+    """
+    Fails early with a clear message instead of a syntax error on the first
+    UPSERT or window query when Python is linked against an old SQLite.
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))}+ is required, but Python's sqlite3 module "
+            f"is linked against SQLite {sqlite3.sqlite_version}. Upgrade SQLite or use a Python build linked against a newer one."
+        )
+    try:
+        conn.execute("SELECT value FROM json_each('[]')").fetchall()
+    except sqlite3.OperationalError as e:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} was built without the JSON1 extension, which is required: {e}")
+
 def init_db():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    
+    with transaction() as conn:
+        _check_sqlite(conn)
+        _create_tables(conn.cursor())
+
+def _create_tables(c):
     # Notebooks table
     c.execute('''
         CREATE TABLE IF NOT EXISTS notebooks (
@@ -46,9 +135,77 @@ def init_db():
     ''')
     
     # Chunks table
+    _create_chunks_table(c, 'chunks')
+    
+    # Columns added after the first release
+    _ensure_column(c, 'notebooks', 'generation', 'INTEGER DEFAULT 0')
+    _ensure_chunk_columns(c, 'chunks')
+    # Chunk ids ("<source_id>#<n>") are only unique within a notebook
+    _migrate_chunks_primary_key(c)
+    # Denormalized per-source stats, kept up to date in the chunk write transaction
+    added = _ensure_column(c, 'sources', 'chunk_count', 'INTEGER DEFAULT 0')
+    added |= _ensure_column(c, 'sources', 'total_chars', 'INTEGER DEFAULT 0')
+    added |= _ensure_column(c, 'sources', 'last_ingested_at', 'REAL')
+    
+    # Secondary indexes: per-source chunk lookups, ON DELETE CASCADE from
+    # sources/notebooks, and per-notebook index builds all seek on these
+    # (see scripts/check_query_plans.py)
+    c.execute(CHUNKS_SOURCE_INDEX)
+    
+    # Retrieval backend per notebook: 'hybrid' (in-memory HybridIndex) or
+    # 'fts' / 'fts+trigram' (FTS5 table below, see app/fts.py)
+    _ensure_column(c, 'notebooks', 'search_backend', "TEXT DEFAULT 'hybrid'")
+    _create_fts_table(c)
+    
+    # OCR results keyed by ocr.ocr_cache_key (hash of image bytes + OCR config),
+    # shared by all notebooks; least recently used rows are evicted past a size bound
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            key TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache (last_used)')
+    # Mean word confidence (0-100), used to pick the full-page OCR resolution;
+    # NULL when it was not computed
+    _ensure_column(c, 'ocr_cache', 'confidence', 'REAL')
+    
+    # Background ingest jobs (see app/jobs.py). A running job is leased by one
+    # process (owner) that keeps heartbeat_at fresh; jobs whose lease expired,
+    # e.g. after a restart, are claimed again.
     c.execute('''
-        CREATE TABLE IF NOT EXISTS chunks (
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
             id TEXT PRIMARY KEY,
+            notebook_id TEXT,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            FOREIGN KEY(notebook_id) REFERENCES notebooks(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_jobs_notebook ON ingest_jobs (notebook_id, status)')
+    
+    if added:
+        _refresh_source_stats(c)
+
+CHUNKS_SOURCE_INDEX = 'CREATE INDEX IF NOT EXISTS idx_chunks_notebook_source ON chunks (notebook_id, source_id)'
+
+def _create_chunks_table(c, table: str):
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT NOT NULL,
             source_id TEXT NOT NULL,
             notebook_id TEXT NOT NULL,
             text TEXT,
@@ -56,77 +213,249 @@ def init_db():
             image_path TEXT,
             created_at REAL,
             meta_data TEXT,
+            PRIMARY KEY (notebook_id, id),
             FOREIGN KEY(notebook_id, source_id) REFERENCES sources(notebook_id, id) ON DELETE CASCADE,
             FOREIGN KEY(notebook_id) REFERENCES notebooks(id) ON DELETE CASCADE
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+
+def _ensure_chunk_columns(c, table: str):
+    # Pre-tokenized features (see utils.pack_features); rows written by an older
+    # tokenizer are re-tokenized in the background
+    _ensure_column(c, table, 'features', 'BLOB')
+    _ensure_column(c, table, 'tokenizer_version', 'INTEGER DEFAULT 0')
+    # utils.chunk_hash of the text, used to diff re-ingested sources;
+    # NULL for rows written before it existed (hashed on read)
+    _ensure_column(c, table, 'content_hash', 'TEXT')
+
+def _migrate_chunks_primary_key(c):
+    """
+    Databases created before chunk ids were scoped by notebook have id as the
+    primary key of chunks, so a notebook ingesting a source of the same name
+    took over another notebook's rows. Rebuilds the table with the
+    (notebook_id, id) key, keeping rowids (the search index and chunks_fts
+    refer to chunks by rowid).
+    """
+    pk = [r[1] for r in sorted(c.execute('PRAGMA table_info(chunks)').fetchall(), key=lambda r: r[5]) if r[5]]
+    if pk != ['id']:
+        return
+    print("DEBUG: Migrating chunks to the (notebook_id, id) primary key")
+    columns = ', '.join(r[1] for r in c.execute('PRAGMA table_info(chunks)').fetchall())
+    # The delete trigger would empty chunks_fts while the old table is dropped
+    c.execute('DROP TRIGGER IF EXISTS chunks_fts_delete')
+    c.execute('DROP TABLE IF EXISTS chunks_new')
+    _create_chunks_table(c, 'chunks_new')
+    _ensure_chunk_columns(c, 'chunks_new')
+    c.execute(f'INSERT INTO chunks_new (rowid, {columns}) SELECT rowid, {columns} FROM chunks')
+    c.execute('DROP TABLE chunks')
+    c.execute('ALTER TABLE chunks_new RENAME TO chunks')
+
+SEARCH_BACKENDS = ('hybrid', 'fts', 'fts+trigram')
+FTS_AVAILABLE = True
+
+def _create_fts_table(c):
+    """
+    chunks_fts holds the pretokenized terms (utils.fts_document) of chunks in
+    FTS-backed notebooks, keyed by chunks.rowid. Rows go away with their chunk
+    through the trigger, including ON DELETE CASCADE deletes.
+    """
+    global FTS_AVAILABLE
+    try:
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(terms)')
+    except sqlite3.OperationalError as e:
+        FTS_AVAILABLE = False
+        print(f"WARNING: SQLite FTS5 is not available, FTS search backend disabled: {e}")
+        return
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+            DELETE FROM chunks_fts WHERE rowid = old.rowid;
+        END
+    ''')
+
+def _ensure_column(cursor, table: str, column: str, decl: str) -> bool:
+    columns = [r[1] for r in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        return True
+    return False
+
+def _refresh_source_stats(conn, pairs: Optional[Iterable[Tuple[str, str]]] = None):
+    """
+    Recompute chunk_count / total_chars / last_ingested_at for the given
+    (notebook_id, source_id) pairs, or for every source when pairs is None.
+    Each source is read through idx_chunks_notebook_source.
+    """
+    query = '''
+        UPDATE sources SET
+            chunk_count = (SELECT COUNT(*) FROM chunks c WHERE c.notebook_id = sources.notebook_id AND c.source_id = sources.id),
+            total_chars = (SELECT COALESCE(SUM(LENGTH(c.text)), 0) FROM chunks c WHERE c.notebook_id = sources.notebook_id AND c.source_id = sources.id),
+            last_ingested_at = (SELECT MAX(c.created_at) FROM chunks c WHERE c.notebook_id = sources.notebook_id AND c.source_id = sources.id)
+    '''
+    if pairs is None:
+        conn.execute(query)
+    else:
+        conn.executemany(query + ' WHERE notebook_id = ? AND id = ?', list(pairs))
 
 # --- Notebook Operations ---
 
 def list_notebooks_db() -> List[Dict]:
     conn = get_db_connection()
     notebooks = conn.execute('SELECT * FROM notebooks ORDER BY created_at DESC').fetchall()
-    conn.close()
     return [dict(n) for n in notebooks]
 
 def create_notebook_db(notebook_id: str, title: str, created_at: float):
-    conn = get_db_connection()
-    conn.execute(
-        'INSERT INTO notebooks (id, title, created_at) VALUES (?, ?, ?)',
-        (notebook_id, title, created_at)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO notebooks (id, title, created_at) VALUES (?, ?, ?)',
+            (notebook_id, title, created_at)
+        )
 
 def delete_notebook_db(notebook_id: str):
+    with transaction() as conn:
+        conn.execute('DELETE FROM notebooks WHERE id = ?', (notebook_id,))
+
+def bump_generation_db(conn, notebook_id: str):
+    # Every write that changes what the index should contain bumps the notebook
+    # generation in the same transaction; index snapshots are keyed by it.
+    conn.execute('UPDATE notebooks SET generation = generation + 1 WHERE id = ?', (notebook_id,))
+
+def get_generation_db(notebook_id: str) -> int:
     conn = get_db_connection()
-    conn.execute('PRAGMA foreign_keys = ON')
-    conn.execute('DELETE FROM notebooks WHERE id = ?', (notebook_id,))
-    conn.commit()
-    conn.close()
+    row = conn.execute('SELECT generation FROM notebooks WHERE id = ?', (notebook_id,)).fetchone()
+    return row[0] if row and row[0] is not None else 0
 
 def get_notebook_db(notebook_id: str) -> Optional[Dict]:
     conn = get_db_connection()
     n = conn.execute('SELECT * FROM notebooks WHERE id = ?', (notebook_id,)).fetchone()
-    conn.close()
     return dict(n) if n else None
 
+def get_search_backend_db(notebook_id: str) -> str:
+    conn = get_db_connection()
+    row = conn.execute('SELECT search_backend FROM notebooks WHERE id = ?', (notebook_id,)).fetchone()
+    return row[0] if row and row[0] else 'hybrid'
+
+def set_search_backend_db(notebook_id: str, backend: str):
+    """
+    Switch a notebook's retrieval backend. Switching to an FTS backend fills
+    chunks_fts from the stored features in the same transaction.
+    """
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend: {backend}")
+    if backend != 'hybrid' and not FTS_AVAILABLE:
+        raise ValueError("SQLite FTS5 is not available")
+    with transaction() as conn:
+        conn.execute('UPDATE notebooks SET search_backend = ? WHERE id = ?', (backend, notebook_id))
+        rows = conn.execute('SELECT rowid FROM chunks WHERE notebook_id = ?', (notebook_id,)).fetchall()
+        rowids = [r[0] for r in rows]
+        if backend == 'hybrid':
+            _delete_fts_rows(conn, rowids)
+        else:
+            _index_fts(conn, rowids)
+        bump_generation_db(conn, notebook_id)
+
+def _delete_fts_rows(conn, rowids: List[int]):
+    if FTS_AVAILABLE:
+        conn.executemany('DELETE FROM chunks_fts WHERE rowid = ?', [(r,) for r in rowids])
+
+def _index_fts(conn, rowids: List[int]):
+    """
+    (Re)write the chunks_fts rows of the given chunks, skipping chunks of
+    notebooks that use the in-memory backend and chunks whose features are
+    stale (they are re-indexed when update_chunk_features_db refreshes them).
+    """
+    if not FTS_AVAILABLE or not rowids:
+        return
+    for i in range(0, len(rowids), FETCH_BATCH_SIZE):
+        batch = rowids[i:i + FETCH_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f'''
+            SELECT c.rowid, c.features, c.tokenizer_version
+            FROM chunks c
+            JOIN notebooks n ON n.id = c.notebook_id
+            WHERE c.rowid IN ({placeholders}) AND n.search_backend != 'hybrid'
+        ''', batch).fetchall()
+        _delete_fts_rows(conn, [r[0] for r in rows])
+        docs = []
+        for r in rows:
+            if r[1] is None or r[2] != TOKENIZER_VERSION:
+                continue
+            keys, tf, _ = unpack_features(r[1])
+            docs.append((r[0], fts_document(keys, tf)))
+        conn.executemany('INSERT INTO chunks_fts (rowid, terms) VALUES (?, ?)', docs)
+
+def fts_search_db(notebook_id: str, match: str, limit: int) -> List[Tuple[int, float]]:
+    """
+    FTS5 candidates of a notebook (enabled sources only) as (rowid, score),
+    best first; score is -bm25() so that higher is better. BM25 statistics
+    (idf, average length) are those of the whole chunks_fts table.
+    """
+    if not match:
+        return []
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT f.rowid, -bm25(chunks_fts) AS score
+        FROM chunks_fts f
+        JOIN chunks c ON c.rowid = f.rowid
+        JOIN sources s ON c.source_id = s.id AND c.notebook_id = s.notebook_id
+        WHERE chunks_fts MATCH ? AND c.notebook_id = ? AND s.enabled = 1
+        ORDER BY bm25(chunks_fts)
+        LIMIT ?
+    ''', (match, notebook_id, limit)).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+def get_chunk_features_by_rowids_db(rowids: Iterable[int]) -> Dict[int, Tuple]:
+    rowids = list(rowids)
+    if not rowids:
+        return {}
+    conn = get_db_connection()
+    placeholders = ','.join('?' * len(rowids))
+    rows = conn.execute(
+        f'SELECT rowid, features FROM chunks WHERE rowid IN ({placeholders}) AND tokenizer_version = ?',
+        rowids + [TOKENIZER_VERSION]
+    ).fetchall()
+    return {r[0]: unpack_features(r[1]) for r in rows if r[1]}
+
 # --- Source Operations ---
 
 def get_source_db(notebook_id: str, source_id: str) -> Optional[Dict]:
     conn = get_db_connection()
     s = conn.execute('SELECT * FROM sources WHERE notebook_id = ? AND id = ?', (notebook_id, source_id)).fetchone()
-    conn.close()
     return dict(s) if s else None
 
-def create_source_db(source_id: str, notebook_id: str, source_type: str, file_name: str, created_at: float, meta_data: Dict = {}):
+def find_source_by_url_db(notebook_id: str, url: str) -> Optional[Dict]:
+    # URL sources are keyed by page title, so look them up by meta_data.url
     conn = get_db_connection()
+    s = conn.execute(
+        "SELECT * FROM sources WHERE notebook_id = ? AND json_extract(meta_data, '$.url') = ? ORDER BY created_at DESC LIMIT 1",
+        (notebook_id, url)
+    ).fetchone()
+    return dict(s) if s else None
+
+def update_source_meta_db(notebook_id: str, source_id: str, meta_data: Dict):
+    # Metadata only (e.g. a touched file's new mtime): chunks and the index are unaffected
+    with transaction() as conn:
+        conn.execute('UPDATE sources SET meta_data = ? WHERE notebook_id = ? AND id = ?', (json.dumps(meta_data), notebook_id, source_id))
+
+def create_source_db(source_id: str, notebook_id: str, source_type: str, file_name: str, created_at: float, meta_data: Dict = {}):
     # print(f"DEBUG DB: Inserting source {source_id} for notebook {notebook_id}")
     try:
-        conn.execute(
-            'INSERT OR IGNORE INTO sources (id, notebook_id, source_type, file_name, created_at, meta_data) VALUES (?, ?, ?, ?, ?, ?)',
-            (source_id, notebook_id, source_type, file_name, created_at, json.dumps(meta_data))
-        )
-        conn.commit()
+        with transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO sources (id, notebook_id, source_type, file_name, created_at, meta_data) VALUES (?, ?, ?, ?, ?, ?)',
+                (source_id, notebook_id, source_type, file_name, created_at, json.dumps(meta_data))
+            )
     except Exception as e:
         print(f"ERROR DB: Failed to insert source: {e}")
-    finally:
-        conn.close()
 
 def list_sources_db(notebook_id: str) -> List[Dict]:
     conn = get_db_connection()
-    # Join with chunks count and alias id to source_id
+    # chunk_count is a denormalized column (see _refresh_source_stats)
     query = '''
-        SELECT s.*, 
-               (SELECT COUNT(*) FROM chunks c WHERE c.source_id = s.id AND c.notebook_id = s.notebook_id) as chunk_count
+        SELECT s.*
         FROM sources s 
         WHERE s.notebook_id = ?
     '''
     sources = conn.execute(query, (notebook_id,)).fetchall()
-    conn.close()
     
     results = []
     for s in sources:
@@ -146,27 +475,123 @@ def list_sources_db(notebook_id: str) -> List[Dict]:
     return results
 
 def update_source_status_db(notebook_id: str, source_id: str, enabled: bool):
-    conn = get_db_connection()
-    conn.execute('UPDATE sources SET enabled = ? WHERE notebook_id = ? AND id = ?', (1 if enabled else 0, notebook_id, source_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('UPDATE sources SET enabled = ? WHERE notebook_id = ? AND id = ?', (1 if enabled else 0, notebook_id, source_id))
+        bump_generation_db(conn, notebook_id)
 
 def delete_source_db(notebook_id: str, source_id: str):
-    conn = get_db_connection()
-    conn.execute('PRAGMA foreign_keys = ON')
-    conn.execute('DELETE FROM sources WHERE notebook_id = ? AND id = ?', (notebook_id, source_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('DELETE FROM sources WHERE notebook_id = ? AND id = ?', (notebook_id, source_id))
+        bump_generation_db(conn, notebook_id)
 
 # --- Chunk Operations ---
 
-def create_chunks_batch_db(chunks: List[Dict]):
-    conn = get_db_connection()
-    
-    data_to_insert = []
+# Columns returned to callers; the features blob is only read by the index builder
+CHUNK_FIELDS = ('id', 'source_id', 'notebook_id', 'text', 'location', 'image_path', 'created_at', 'meta_data')
+CHUNK_COLUMNS = ', '.join(f'c.{f}' for f in CHUNK_FIELDS)
+# Rows per fetchmany() when streaming chunks
+FETCH_BATCH_SIZE = 500
+
+class ChunkRow(dict):
+    """
+    A chunk dict whose meta_data JSON is merged in only when a key that is not
+    a plain column is looked up (or the whole dict is iterated/serialized).
+    """
+    __slots__ = ('_meta',)
+
+    def __init__(self, row, meta: Optional[str]):
+        super().__init__(row)
+        self._meta = meta
+
+    def _decode(self):
+        meta, self._meta = self._meta, None
+        if meta:
+            try:
+                for k, v in json.loads(meta).items():
+                    # Plain columns take precedence over keys duplicated in meta_data
+                    if k not in self:
+                        dict.__setitem__(self, k, v)
+            except:
+                pass
+
+    def __missing__(self, key):
+        if self._meta is None:
+            raise KeyError(key)
+        self._decode()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def __contains__(self, key) -> bool:
+        if dict.__contains__(self, key):
+            return True
+        if self._meta is not None:
+            self._decode()
+            return dict.__contains__(self, key)
+        return False
+
+    def __iter__(self):
+        self._decode()
+        return dict.__iter__(self)
+
+    def __len__(self) -> int:
+        self._decode()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._decode()
+        return dict.keys(self)
+
+    def values(self):
+        self._decode()
+        return dict.values(self)
+
+    def items(self):
+        self._decode()
+        return dict.items(self)
+
+    def copy(self) -> Dict:
+        self._decode()
+        return dict(dict.items(self))
+
+    def __repr__(self) -> str:
+        self._decode()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+def _iter_rows(conn, query: str, params: Sequence[Any], batch_size: int) -> Iterator[sqlite3.Row]:
+    cursor = conn.execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for r in rows:
+                yield r
+    finally:
+        cursor.close()
+
+CHUNK_META_EXCLUDE = frozenset(['id', 'rowid', 'source_id', 'notebook_id', 'text', 'location', 'image_path', 'created_at', 'features', 'content_hash'])
+
+def _chunk_params(chunks: List[Dict]) -> Iterator[Tuple]:
+    # Chunks of one source carry the same leftover keys (source_type, url,
+    # path, ...), so each distinct meta_data is serialized only once
+    meta_json: Dict[Tuple, str] = {}
     for c in chunks:
-        meta = {k: v for k, v in c.items() if k not in ['id', 'source_id', 'notebook_id', 'text', 'location', 'image_path', 'created_at']}
-        data_to_insert.append((
+        meta = tuple((k, v) for k, v in c.items() if k not in CHUNK_META_EXCLUDE)
+        try:
+            encoded = meta_json.get(meta)
+        except TypeError:  # unhashable values, e.g. nested dicts
+            encoded = json.dumps(dict(meta))
+        if encoded is None:
+            encoded = meta_json[meta] = json.dumps(dict(meta))
+        features = c.get('features')
+        yield (
             c['id'],
             c['source_id'],
             c['notebook_id'],
@@ -174,49 +599,479 @@ def create_chunks_batch_db(chunks: List[Dict]):
             c.get('location', ''),
             c.get('image_path', ''),
             c.get('created_at', 0),
-            json.dumps(meta)
-        ))
-        
-    conn.executemany(
-        'INSERT OR REPLACE INTO chunks (id, source_id, notebook_id, text, location, image_path, created_at, meta_data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-        data_to_insert
-    )
-    conn.commit()
-    conn.close()
+            encoded,
+            pack_features(features) if features is not None else None,
+            TOKENIZER_VERSION if features is not None else 0,
+            c.get('content_hash')
+        )
+
+def _upsert_chunks(conn, chunks: List[Dict], batch_size: int = BULK_BATCH_SIZE) -> Set[Tuple[str, str]]:
+    """
+    Upserts chunks in executemany batches inside the caller's transaction.
+    Returns the (notebook_id, source_id) pairs that lost rows to the upsert
+    (an existing id written again under another source), whose stats need a
+    refresh as well.
+    """
+    displaced: Set[Tuple[str, str]] = set()
+    params = _chunk_params(chunks)
+    while True:
+        batch = list(islice(params, batch_size))
+        if not batch:
+            break
+        by_notebook: Dict[str, Dict[str, str]] = {}
+        for p in batch:
+            by_notebook.setdefault(p[2], {})[p[0]] = p[1]
+        for notebook_id, sources in by_notebook.items():
+            for cid, source_id in conn.execute(
+                'SELECT id, source_id FROM chunks WHERE notebook_id = ? AND id IN (SELECT value FROM json_each(?))',
+                (notebook_id, json.dumps(list(sources)))
+            ):
+                if sources[cid] != source_id:
+                    displaced.add((notebook_id, source_id))
+        # Upsert rather than INSERT OR REPLACE: a re-ingested chunk keeps its
+        # rowid, which is what the search index stores for it. A row never
+        # changes notebook (ids are unique per notebook only).
+        conn.executemany(
+            '''
+            INSERT INTO chunks (id, source_id, notebook_id, text, location, image_path, created_at, meta_data, features, tokenizer_version, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(notebook_id, id) DO UPDATE SET
+                source_id = excluded.source_id, text = excluded.text,
+                location = excluded.location, image_path = excluded.image_path, created_at = excluded.created_at,
+                meta_data = excluded.meta_data, features = excluded.features, tokenizer_version = excluded.tokenizer_version,
+                content_hash = excluded.content_hash
+            ''',
+            batch
+        )
+    return displaced
+
+def _after_chunk_writes(conn, chunks: List[Dict], refresh_stats: bool = True, displaced: Iterable[Tuple[str, str]] = ()):
+    """
+    Sets c['rowid'] and brings chunks_fts, source stats and notebook
+    generations up to date for chunks just written; displaced are the
+    pairs returned by _upsert_chunks.
+    """
+    rowids: Dict[Tuple[str, str], int] = {}
+    for notebook_id in {c['notebook_id'] for c in chunks}:
+        ids = [c['id'] for c in chunks if c['notebook_id'] == notebook_id]
+        rowids.update(((notebook_id, cid), rowid) for cid, rowid in _rowids_by_id(conn, notebook_id, ids).items())
+    for c in chunks:
+        c['rowid'] = rowids.get((c['notebook_id'], c['id']))
+    _index_fts(conn, list(rowids.values()))
+    if refresh_stats:
+        _refresh_source_stats(conn, {(c['notebook_id'], c['source_id']) for c in chunks} | set(displaced))
+    for notebook_id in {c['notebook_id'] for c in chunks}:
+        bump_generation_db(conn, notebook_id)
+
+def create_chunks_batch_db(chunks: List[Dict], refresh_stats: bool = True):
+    """
+    refresh_stats=False leaves sources.chunk_count / total_chars as they are,
+    for callers writing one source in many batches (the stats are recomputed
+    from all of the source's chunks); call refresh_source_stats_db at the end.
+    """
+    with transaction() as conn:
+        displaced = _upsert_chunks(conn, chunks)
+        _after_chunk_writes(conn, chunks, refresh_stats=refresh_stats, displaced=displaced)
+
+def refresh_source_stats_db(notebook_id: str):
+    with transaction() as conn:
+        rows = conn.execute('SELECT id FROM sources WHERE notebook_id = ?', (notebook_id,)).fetchall()
+        _refresh_source_stats(conn, [(notebook_id, r[0]) for r in rows])
+
+@contextmanager
+def _bulk_load_mode(conn):
+    """
+    Tuned settings for large imports, used inside the import transaction:
+    a bigger page cache, and idx_chunks_notebook_source dropped while rows go
+    in and rebuilt once at the end (before the source stats need it). The
+    DROP/CREATE are part of the transaction, so readers never see the table
+    without its index, and a failed import rolls both back.
+    """
+    conn.execute(f'PRAGMA cache_size = -{BULK_CACHE_SIZE_KB}')
+    try:
+        conn.execute('DROP INDEX IF EXISTS idx_chunks_notebook_source')
+        yield
+        conn.execute(CHUNKS_SOURCE_INDEX)
+    finally:
+        conn.execute(f"PRAGMA cache_size = {dict(SQLITE_PRAGMAS)['cache_size']}")
+
+def _count_chunks(conn, notebook_id: str) -> int:
+    return conn.execute('SELECT COUNT(*) FROM chunks WHERE notebook_id = ?', (notebook_id,)).fetchone()[0]
+
+def bulk_ingest_db(
+    notebook_id: str,
+    sources: List[Dict],
+    chunks: List[Dict],
+    bulk_load: Optional[bool] = None,
+    removed_ids: Sequence[str] = (),
+    relocated: Sequence[Tuple[str, Optional[str]]] = (),
+) -> Dict[str, int]:
+    """
+    Writes sources and chunks (upsert) of one notebook in a single
+    transaction with batched executemany calls, deletes removed_ids (the
+    stale chunks of re-ingested sources) and sets the location of
+    unchanged chunks that moved, given as (id, location). Existing sources keep their row
+    but take the new meta_data (content hash, size/mtime, ...). Returns the
+    notebook's chunk count before and after, and how many chunks were added,
+    removed and relocated; the generation is bumped only if chunks changed.
+    bulk_load defaults to on for imports of at least BULK_LOAD_THRESHOLD
+    chunks that are also at least as big as the chunks table already is
+    (rebuilding the index costs time proportional to the whole table).
+    """
+    with transaction() as conn:
+        if bulk_load is None:
+            table_rows = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM chunks').fetchone()[0]
+            bulk_load = len(chunks) >= max(BULK_LOAD_THRESHOLD, table_rows)
+        before = _count_chunks(conn, notebook_id)
+        source_rows = [
+            (s['id'], notebook_id, s.get('source_type', 'unknown'), s.get('file_name', s['id']),
+             s.get('created_at', 0), json.dumps(s.get('meta_data', {})))
+            for s in sources
+        ]
+        for i in range(0, len(source_rows), BULK_BATCH_SIZE):
+            conn.executemany(
+                '''
+                INSERT INTO sources (id, notebook_id, source_type, file_name, created_at, meta_data) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(notebook_id, id) DO UPDATE SET meta_data = excluded.meta_data
+                ''',
+                source_rows[i:i + BULK_BATCH_SIZE]
+            )
+        removed = 0
+        if removed_ids:
+            removed_pairs = {
+                (notebook_id, r[0])
+                for r in conn.execute(
+                    'SELECT DISTINCT source_id FROM chunks WHERE notebook_id = ? AND id IN (SELECT value FROM json_each(?))',
+                    (notebook_id, json.dumps(list(removed_ids)))
+                )
+            }
+            for i in range(0, len(removed_ids), BULK_BATCH_SIZE):
+                cursor = conn.executemany(
+                    'DELETE FROM chunks WHERE notebook_id = ? AND id = ?',
+                    [(notebook_id, cid) for cid in removed_ids[i:i + BULK_BATCH_SIZE]]
+                )
+                removed += cursor.rowcount
+            _refresh_source_stats(conn, removed_pairs)
+        if relocated:
+            conn.executemany('UPDATE chunks SET location = ? WHERE notebook_id = ? AND id = ?', [(loc, notebook_id, cid) for cid, loc in relocated])
+        if chunks:
+            if bulk_load:
+                with _bulk_load_mode(conn):
+                    displaced = _upsert_chunks(conn, chunks)
+            else:
+                displaced = _upsert_chunks(conn, chunks)
+            _after_chunk_writes(conn, chunks, displaced=displaced)
+        elif removed or relocated:
+            bump_generation_db(conn, notebook_id)
+        total = _count_chunks(conn, notebook_id)
+    return {"before": before, "added": total - before + removed, "removed": removed, "relocated": len(relocated), "total": total}
+
+def list_chunk_hashes_db(notebook_id: str, source_ids: Iterable[str]) -> Dict[str, List[Tuple[str, int, str, Optional[str]]]]:
+    """
+    (id, rowid, content_hash, location) of the chunks of each given source,
+    in rowid order. Rows written before content hashes were stored are
+    hashed here.
+    """
+    conn = get_db_connection()
+    result: Dict[str, List[Tuple[str, int, str, Optional[str]]]] = {}
+    for source_id in source_ids:
+        rows = conn.execute(
+            '''
+            SELECT id, rowid, content_hash, location, CASE WHEN content_hash IS NULL THEN text END AS text
+            FROM chunks WHERE notebook_id = ? AND source_id = ? ORDER BY rowid
+            ''',
+            (notebook_id, source_id)
+        ).fetchall()
+        if rows:
+            result[source_id] = [(r[0], r[1], r[2] or chunk_hash(r[4]), r[3]) for r in rows]
+    return result
+
+def iter_chunks_db(
+    notebook_id: str,
+    columns: Optional[Sequence[str]] = None,
+    include_disabled: bool = False,
+    batch_size: int = FETCH_BATCH_SIZE,
+) -> Iterator[Dict]:
+    """
+    Streams a notebook's chunks in fetchmany() batches instead of building one
+    big list. columns picks the chunk columns to read (default: all of
+    CHUNK_FIELDS); enabled / source_type / file_name always come from sources.
+    meta_data is decoded lazily (see ChunkRow).
+    """
+    columns = list(columns) if columns else list(CHUNK_FIELDS)
+    unknown = set(columns) - set(CHUNK_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown chunk columns: {sorted(unknown)}")
+    select = ', '.join(f'c.{f}' for f in columns)
+    # Join sources to check enabled status
+    # Need to match on both source_id and notebook_id
+    query = f'''
+        SELECT {select}, s.enabled, s.source_type, s.file_name
+        FROM chunks c
+        JOIN sources s ON c.source_id = s.id AND c.notebook_id = s.notebook_id
+        WHERE c.notebook_id = ?
+    '''
+    if not include_disabled:
+        query += ' AND s.enabled = 1'
+    conn = get_db_connection()
+    for r in _iter_rows(conn, query, (notebook_id,), batch_size):
+        yield _chunk_row_to_dict(r)
+
+def _rowids_by_id(conn, notebook_id: str, chunk_ids: List[str], batch_size: int = FETCH_BATCH_SIZE) -> Dict[str, int]:
+    rowids = {}
+    for i in range(0, len(chunk_ids), batch_size):
+        batch = chunk_ids[i:i + batch_size]
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f'SELECT id, rowid FROM chunks WHERE notebook_id = ? AND id IN ({placeholders})', [notebook_id] + batch).fetchall()
+        rowids.update((r[0], r[1]) for r in rows)
+    return rowids
 
 def load_chunks_db(notebook_id: str) -> List[Dict]:
     """
     Returns chunks in the format expected by the application (flat dicts).
     Only returns chunks from ENABLED sources.
     """
+    return list(iter_chunks_db(notebook_id))
+
+def _chunk_row_to_dict(row) -> Dict:
+    d = {k: row[k] for k in row.keys() if k != 'meta_data'}
+    return ChunkRow(d, row['meta_data'] if 'meta_data' in row.keys() else None)
+
+def get_chunks_by_rowids_db(rowids: Iterable[int]) -> Dict[int, Dict]:
+    """
+    Fetch full chunk dicts (same shape as load_chunks_db) for search hits,
+    keyed by chunk rowid.
+    """
+    rowids = list(rowids)
+    if not rowids:
+        return {}
     conn = get_db_connection()
-    # Join sources to check enabled status
-    # Need to match on both source_id and notebook_id
-    query = '''
-        SELECT c.*, s.enabled, s.source_type, s.file_name
+    placeholders = ','.join('?' * len(rowids))
+    query = f'''
+        SELECT c.rowid AS _rowid, {CHUNK_COLUMNS}, s.enabled, s.source_type, s.file_name
         FROM chunks c
         JOIN sources s ON c.source_id = s.id AND c.notebook_id = s.notebook_id
-        WHERE c.notebook_id = ? AND s.enabled = 1
+        WHERE c.rowid IN ({placeholders})
     '''
-    rows = conn.execute(query, (notebook_id,)).fetchall()
-    conn.close()
-    
-    results = []
+    rows = conn.execute(query, rowids).fetchall()
+    chunks = {}
     for r in rows:
-        d = dict(r)
-        # Unpack meta_data
-        if d['meta_data']:
-            try:
-                meta = json.loads(d['meta_data'])
-                d.update(meta)
-            except:
-                pass
-        del d['meta_data'] # Clean up
-        results.append(d)
-    return results
+        d = _chunk_row_to_dict(r)
+        chunks[d.pop('_rowid')] = d
+    return chunks
+
+def iter_index_rows_db(notebook_id: str, batch_size: int = FETCH_BATCH_SIZE) -> Iterator[Dict]:
+    """
+    Minimal rows for building a HybridIndex: id, source_id, enabled and the
+    unpacked features, streamed in fetchmany() batches. Text is only returned
+    for rows whose features are missing or from an older tokenizer, so the
+    caller can tokenize those.
+    """
+    conn = get_db_connection()
+    query = '''
+        SELECT c.rowid, c.id, c.source_id, s.enabled,
+               CASE WHEN c.tokenizer_version = ? AND c.features IS NOT NULL THEN c.features END AS features,
+               CASE WHEN c.tokenizer_version = ? AND c.features IS NOT NULL THEN NULL ELSE c.text END AS text
+        FROM chunks c
+        JOIN sources s ON c.source_id = s.id AND c.notebook_id = s.notebook_id
+        WHERE c.notebook_id = ?
+    '''
+    for r in _iter_rows(conn, query, (TOKENIZER_VERSION, TOKENIZER_VERSION, notebook_id), batch_size):
+        yield {
+            'rowid': r['rowid'],
+            'id': r['id'],
+            'source_id': r['source_id'],
+            'enabled': bool(r['enabled']),
+            'features': unpack_features(r['features']),
+            'text': r['text'] or '',
+        }
+
+def list_stale_chunks_db(limit: int = 500) -> List[Tuple[int, str]]:
+    # (rowid, text) of chunks whose features are missing or from an older tokenizer
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT rowid, text FROM chunks WHERE tokenizer_version IS NOT ? OR features IS NULL LIMIT ?',
+        (TOKENIZER_VERSION, limit)
+    ).fetchall()
+    return [(r[0], r[1] or '') for r in rows]
+
+def update_chunk_features_db(features_by_rowid: List[Tuple[int, Tuple]]):
+    # Only touch rows that are still stale: a chunk re-ingested meanwhile
+    # already carries features for its new text.
+    with transaction() as conn:
+        conn.executemany(
+            'UPDATE chunks SET features = ?, tokenizer_version = ? WHERE rowid = ? AND (tokenizer_version IS NOT ? OR features IS NULL)',
+            [(pack_features(f), TOKENIZER_VERSION, rowid, TOKENIZER_VERSION) for rowid, f in features_by_rowid]
+        )
+        _index_fts(conn, [rowid for rowid, _ in features_by_rowid])
 
 def count_chunks_by_source(notebook_id: str, source_id: str) -> int:
     conn = get_db_connection()
-    count = conn.execute('SELECT COUNT(*) FROM chunks WHERE notebook_id = ? AND source_id = ?', (notebook_id, source_id)).fetchone()[0]
-    conn.close()
-    return count
+    row = conn.execute('SELECT chunk_count FROM sources WHERE notebook_id = ? AND id = ?', (notebook_id, source_id)).fetchone()
+    return row[0] if row and row[0] is not None else 0
+
+def count_chunk_rows_db(notebook_id: str, source_id: str) -> int:
+    # Actual row count, as opposed to the denormalized sources.chunk_count
+    conn = get_db_connection()
+    return conn.execute('SELECT COUNT(*) FROM chunks WHERE notebook_id = ? AND source_id = ?', (notebook_id, source_id)).fetchone()[0]
+
+def get_ocr_cache_db(keys: Iterable[str], batch_size: int = FETCH_BATCH_SIZE) -> Dict[str, Tuple[str, Optional[float]]]:
+    """
+    Cached (text, confidence) for the given keys; hits are marked as recently used.
+    """
+    keys = list(dict.fromkeys(keys))
+    conn = get_db_connection()
+    result: Dict[str, Tuple[str, Optional[float]]] = {}
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        placeholders = ','.join('?' * len(batch))
+        for key, text, confidence in conn.execute(f'SELECT key, text, confidence FROM ocr_cache WHERE key IN ({placeholders})', batch):
+            result[key] = (text, confidence)
+    if result:
+        now = time.time()
+        with transaction() as conn:
+            conn.executemany('UPDATE ocr_cache SET last_used = ? WHERE key = ?', [(now, k) for k in result])
+    return result
+
+def put_ocr_cache_db(entries: Dict[str, Tuple[str, Optional[float]]], max_bytes: int):
+    """
+    Stores (text, confidence) OCR results, then evicts the least recently used entries until the
+    cache holds at most max_bytes of text.
+    """
+    if not entries:
+        return
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO ocr_cache (key, text, confidence, size, last_used) VALUES (?, ?, ?, ?, ?)',
+            [(k, text, confidence, len(k) + len(text.encode('utf-8')), now) for k, (text, confidence) in entries.items()]
+        )
+        conn.execute(
+            '''
+            DELETE FROM ocr_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept FROM ocr_cache
+                ) WHERE kept > ?
+            )
+            ''',
+            (max_bytes,)
+        )
+
+# --- Ingest Jobs ---
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+JOB_JSON_FIELDS = ('request', 'progress', 'result')
+
+def _job_row_to_dict(row) -> Dict:
+    job = dict(row)
+    for field in JOB_JSON_FIELDS:
+        job[field] = json.loads(job[field]) if job[field] else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    return job
+
+def create_ingest_job_db(job_id: str, notebook_id: Optional[str], request: Dict) -> Dict:
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO ingest_jobs (id, notebook_id, status, request, created_at) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, notebook_id, json.dumps(request), time.time())
+        )
+    return get_ingest_job_db(job_id)
+
+def get_ingest_job_db(job_id: str) -> Optional[Dict]:
+    conn = get_db_connection()
+    row = conn.execute('SELECT * FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()
+    return _job_row_to_dict(row) if row else None
+
+def claim_ingest_job_db(owner: str, max_per_notebook: int, lease_seconds: float, max_attempts: int) -> Optional[Dict]:
+    """
+    Atomically leases the oldest runnable job to owner: a queued job, or a
+    running one whose lease expired (its process died). Jobs of a notebook
+    that already has max_per_notebook live running jobs wait. A job that
+    was claimed max_attempts times without finishing is marked failed.
+    """
+    now = time.time()
+    stale = now - lease_seconds
+    with transaction() as conn:
+        while True:
+            row = conn.execute(
+                '''
+                SELECT j.id, j.attempts FROM ingest_jobs j
+                WHERE (j.status = 'queued' OR (j.status = 'running' AND j.heartbeat_at < ?))
+                AND (
+                    SELECT COUNT(*) FROM ingest_jobs r
+                    WHERE r.notebook_id IS j.notebook_id AND r.status = 'running' AND r.heartbeat_at >= ?
+                ) < ?
+                ORDER BY j.created_at LIMIT 1
+                ''',
+                (stale, stale, max_per_notebook)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, attempts = row
+            if attempts >= max_attempts:
+                conn.execute(
+                    "UPDATE ingest_jobs SET status = 'failed', error = ?, owner = NULL, finished_at = ? WHERE id = ?",
+                    (f'Gave up after {attempts} attempts', now, job_id)
+                )
+                continue
+            conn.execute(
+                '''
+                UPDATE ingest_jobs SET status = 'running', owner = ?, heartbeat_at = ?, attempts = attempts + 1,
+                    started_at = COALESCE(started_at, ?)
+                WHERE id = ?
+                ''',
+                (owner, now, now, job_id)
+            )
+            break
+    return get_ingest_job_db(job_id)
+
+def update_ingest_job_progress_db(job_id: str, owner: str, progress: Dict) -> Optional[bool]:
+    """
+    Saves progress and renews the lease. Returns whether cancellation was
+    requested, or None if owner no longer holds the job.
+    """
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE ingest_jobs SET progress = ?, heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (json.dumps(progress), time.time(), job_id, owner)
+        )
+        if not cur.rowcount:
+            return None
+        return bool(conn.execute('SELECT cancel_requested FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()[0])
+
+def heartbeat_ingest_jobs_db(owner: str, job_ids: Iterable[str]):
+    job_ids = list(job_ids)
+    if not job_ids:
+        return
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE ingest_jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            [(time.time(), job_id, owner) for job_id in job_ids]
+        )
+
+def finish_ingest_job_db(job_id: str, owner: str, status: str, result: Optional[Dict] = None, error: Optional[str] = None, progress: Optional[Dict] = None) -> bool:
+    if status not in JOB_STATUSES:
+        raise ValueError(f'Unknown job status: {status}')
+    with transaction() as conn:
+        cur = conn.execute(
+            '''
+            UPDATE ingest_jobs SET status = ?, result = ?, error = ?, progress = COALESCE(?, progress), finished_at = ?
+            WHERE id = ? AND owner = ? AND status = 'running'
+            ''',
+            (status, json.dumps(result) if result is not None else None, error,
+             json.dumps(progress) if progress is not None else None, time.time(), job_id, owner)
+        )
+        return cur.rowcount > 0
+
+def cancel_ingest_job_db(job_id: str) -> Optional[Dict]:
+    """
+    Queued jobs are cancelled right away; running ones are flagged and stop
+    at their next progress update.
+    """
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE ingest_jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        conn.execute("UPDATE ingest_jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+    return get_ingest_job_db(job_id)
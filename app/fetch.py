@@ -0,0 +1,171 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, NamedTuple, Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# 同时抓取的 URL 数（线程数，也是连接池大小）
+URL_FETCH_WORKERS = int(os.environ.get("URL_FETCH_WORKERS", "16"))
+# 同一个站点同时进行的请求上限
+URL_FETCH_PER_HOST = int(os.environ.get("URL_FETCH_PER_HOST", "6"))
+# 同一个站点两次请求开始之间至少间隔多少秒（限速），0 表示不限
+URL_FETCH_HOST_INTERVAL = float(os.environ.get("URL_FETCH_HOST_INTERVAL", "0.05"))
+# 单次请求的连接 / 读取超时（秒）
+URL_FETCH_TIMEOUT = float(os.environ.get("URL_FETCH_TIMEOUT", "20"))
+# 连接失败、超时、429 / 5xx 时的重试次数，退避时间从 URL_FETCH_BACKOFF 秒开始翻倍（有 Retry-After 时按它来）
+URL_FETCH_RETRIES = int(os.environ.get("URL_FETCH_RETRIES", "2"))
+URL_FETCH_BACKOFF = float(os.environ.get("URL_FETCH_BACKOFF", "0.5"))
+# 单个 URL 的总时限（秒，包括等站点槽位、重试和退避），从开始抓这个 URL 时算起
+URL_FETCH_DEADLINE = float(os.environ.get("URL_FETCH_DEADLINE", "120"))
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchDeadlineExceeded(Exception):
+    """
+    这个 URL 的时限到了还没抓到（一直等不到站点的槽位、重试用完了时间）
+    """
+
+
+class FetchResult(NamedTuple):
+    url: str
+    # 成功时是网页内容，失败时 text 为 None、error 是最后一次的异常
+    text: Optional[str]
+    error: Optional[Exception]
+
+
+class _HostLimit:
+    # 一个站点的并发槽位和请求间隔
+    def __init__(self, concurrency: int, interval: float):
+        self.slots = threading.Semaphore(max(1, concurrency))
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait_turn(self, deadline: float) -> bool:
+        # 排到下一个请求时间；排到的时间超过时限时返回 False
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            if at >= deadline:
+                return False
+            self._next_at = at + self.interval
+        time.sleep(at - now)
+        return True
+
+
+class UrlFetcher:
+    """
+    并发抓取网页：一个带连接池的 requests.Session 在所有请求间共用（keep-alive，同一站点不用每次都重新握手），
+    每个站点有并发上限和请求间隔，失败按指数退避重试，每个 URL 有总时限。
+    只负责 HTTP 抓取；内容不够、需要浏览器渲染的网页由调用方串行处理（见 ingest._fetch_url_html）
+    """
+
+    def __init__(
+        self,
+        workers: int = URL_FETCH_WORKERS,
+        per_host: int = URL_FETCH_PER_HOST,
+        host_interval: float = URL_FETCH_HOST_INTERVAL,
+        timeout: float = URL_FETCH_TIMEOUT,
+        retries: int = URL_FETCH_RETRIES,
+        backoff: float = URL_FETCH_BACKOFF,
+    ):
+        self.workers = max(1, workers)
+        self.per_host = per_host
+        self.host_interval = host_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="url-fetch")
+        self._hosts: Dict[str, _HostLimit] = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host(self, url: str) -> _HostLimit:
+        host = urlsplit(url).netloc.lower()
+        with self._hosts_lock:
+            limit = self._hosts.get(host)
+            if limit is None:
+                limit = self._hosts[host] = _HostLimit(self.per_host, self.host_interval)
+            return limit
+
+    def fetch(self, url: str, deadline: float = URL_FETCH_DEADLINE) -> FetchResult:
+        """
+        抓取一个 URL（在调用线程里），deadline 秒内抓不到就放弃
+        """
+        deadline = time.monotonic() + deadline
+        host = self._host(url)
+        error: Exception = FetchDeadlineExceeded(f"Deadline exceeded before fetching {url}")
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            if not host.slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                break
+            try:
+                if not host.wait_turn(deadline):
+                    break
+                resp = self.session.get(url, timeout=min(self.timeout, max(0.1, deadline - time.monotonic())))
+                if resp.status_code not in RETRY_STATUS or attempt == self.retries:
+                    resp.raise_for_status()
+                    return FetchResult(url, resp.text, None)
+                error = requests.HTTPError(f"{resp.status_code} for {url}", response=resp)
+                retry_after = resp.headers.get("Retry-After")
+                resp.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception as e:
+                # 4xx、非法 URL 等重试也没用
+                return FetchResult(url, None, e)
+            finally:
+                host.slots.release()
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            if time.monotonic() + delay >= deadline:
+                break
+            print(f"DEBUG: Retrying {url} in {delay:.1f}s after: {error}")
+            time.sleep(delay)
+        return FetchResult(url, None, error)
+
+    def fetch_all(self, urls: Iterable[str], deadline: float = URL_FETCH_DEADLINE) -> Iterator[FetchResult]:
+        """
+        并发抓取一批 URL，按输入顺序产出结果。最多提前抓 2 倍 workers 个，
+        调用方处理得慢时不会把所有网页都堆在内存里；调用方中途停止迭代时取消还没开始的请求。
+        deadline 是每个 URL 的时限，从 worker 开始抓它时算起，调用方处理得再久也不会让后面的 URL 超时
+        """
+        pending: Deque = deque()
+        urls = iter(urls)
+        try:
+            while True:
+                while len(pending) < 2 * self.workers:
+                    url = next(urls, None)
+                    if url is None:
+                        break
+                    pending.append(self._executor.submit(self.fetch, url, deadline))
+                if not pending:
+                    return
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+_fetcher: Optional[UrlFetcher] = None
+_fetcher_lock = threading.Lock()
+
+def get_url_fetcher() -> UrlFetcher:
+    # 连接池和各站点的限速在所有摄取之间共用
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = UrlFetcher()
+        return _fetcher
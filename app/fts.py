@@ -0,0 +1,75 @@
+import os
+from typing import List, Dict, Iterable, Tuple
+import numpy as np
+from .utils import text_features, fts_match
+from .scoring import W_BM25, W_TRIGRAM
+from .db import fts_search_db, get_chunks_by_rowids_db, get_chunk_features_by_rowids_db
+
+# 开启 trigram 重排时，先从 FTS5 取 top_k 的这么多倍候选，再在候选集里重新打分
+FTS_CANDIDATE_FACTOR = int(os.environ.get("FTS_CANDIDATE_FACTOR", "5"))
+
+
+class FtsIndex:
+    """
+    基于 SQLite FTS5 的检索后端，给内存放不下 HybridIndex 的大笔记本用：
+    chunks_fts 里存的是入库时 jieba 分好的 token（见 utils.fts_document），排序用 FTS5 自带的 bm25()。
+    数据库本身就是索引，写操作在同一事务里维护 chunks_fts，这里的增量更新都是空操作。
+    """
+
+    def __init__(self, notebook_id: str, generation: int = 0, rescore_trigrams: bool = False):
+        self.notebook_id = notebook_id
+        self.generation = generation
+        self.rescore_trigrams = rescore_trigrams
+
+    def add_chunks(self, chunks: List[Dict], removed_rowids: Iterable[int] = ()):
+        pass
+
+    def remove_source(self, source_id: str):
+        pass
+
+    def set_source_enabled(self, source_id: str, enabled: bool):
+        pass
+
+    def search(self, query: str, top_k: int = 8) -> List[Tuple[Dict, float]]:
+        return self.search_many([query], top_k=top_k)[0]
+
+    def search_many(self, queries: List[str], top_k: int = 8) -> List[List[Tuple[Dict, float]]]:
+        limit = top_k * FTS_CANDIDATE_FACTOR if self.rescore_trigrams else top_k
+        results = []
+        for query in queries:
+            keys, _, trigrams = text_features(query)
+            candidates = fts_search_db(self.notebook_id, fts_match(keys), limit)
+            if not candidates:
+                results.append([])
+                continue
+            rowids = np.array([r for r, _ in candidates], dtype=np.int64)
+            bm_raw = np.array([s for _, s in candidates])
+            # 和 HybridIndex 一样做 Min-Max 归一化，只是范围是候选集
+            mn, mx = float(bm_raw.min()), float(bm_raw.max())
+            scores = np.ones(len(rowids)) if mx == mn else (bm_raw - mn) / (mx - mn)
+            if self.rescore_trigrams and len(trigrams):
+                scores = W_BM25 * scores + W_TRIGRAM * self._trigram_overlap(rowids, trigrams)
+                order = np.lexsort((rowids, -scores))[:top_k]
+                rowids, scores = rowids[order], scores[order]
+            results.append(list(zip(rowids.tolist(), scores.tolist())))
+
+        chunks = get_chunks_by_rowids_db({rowid for hits in results for rowid, _ in hits})
+        return [
+            [(chunks[rowid], float(s)) for rowid, s in hits if rowid in chunks]
+            for hits in results
+        ]
+
+    def _trigram_overlap(self, rowids: np.ndarray, q_trigrams: np.ndarray) -> np.ndarray:
+        # 候选 chunk 的 trigram 直接从入库时存的 features 里取，不重新分词
+        features = get_chunk_features_by_rowids_db(rowids.tolist())
+        overlap = np.zeros(len(rowids))
+        for i, rowid in enumerate(rowids.tolist()):
+            f = features.get(rowid)
+            if f is None or not len(f[2]):
+                continue
+            n = len(np.intersect1d(q_trigrams, f[2], assume_unique=True))
+            overlap[i] = n / max(len(q_trigrams), len(f[2]))
+        return overlap
+
+    def memory_usage(self) -> Dict[str, int]:
+        return {"heap": 0, "mapped": 0, "total": 0}
@@ -1,71 +1,150 @@
-from typing import List, Dict, Tuple
-from rank_bm25 import BM25Okapi
-from .utils import tokenize, char_trigrams
+import threading
+from typing import List, Dict, Iterable, Set, Tuple
+import numpy as np
+from .utils import text_features
+from .scoring import SparseScorer, array_bytes
+from .db import get_chunks_by_rowids_db
 
 
-def _min_max_norm(scores: List[float]) -> List[float]:
-    if not scores:
-        return scores
-    mn = min(scores)
-    mx = max(scores)
-    if mx == mn:
-        return [1.0 for _ in scores]
-    return [(s - mn) / (mx - mn) for s in scores]
+class HybridIndex:
+    """
+    索引里每个 chunk 只是几个并行数组里的一格：SQLite rowid、资料下标，
+    文档长度和是否可检索在 scorer 里（doc_len / live）。
+    命中的 top-k 再按 rowid 从 SQLite 取正文和元数据，这样索引可以整体落盘、mmap 加载（见 snapshot.py）
+    """
 
+    def __init__(self, chunks: Iterable[Dict] = (), generation: int = 0):
+        # 禁用资料的 chunk 也进索引，只是在掩码里标记为不可检索，启用时不用重新分词
+        self._lock = threading.RLock()
+        self.generation = generation
+        self.scorer = SparseScorer()
+        self.doc_rowid = np.empty(0, dtype=np.int64)
+        self.sources: List[str] = []
+        self._source_index: Dict[str, int] = {}
+        self.doc_source = np.empty(0, dtype=np.int32)
+        self.disabled_sources: Set[str] = set()
+        # chunks 可以是数据库游标上的生成器，这里只遍历一遍，不整体物化
+        self._append(chunks)
 
-class HybridIndex:
-    def __init__(self, chunks: List[Dict]):
-        # 过滤掉 enabled=False 的 chunks
-        self.chunks = [c for c in chunks if c.get("enabled", True) is not False]
-        self.corpus_tokens: List[List[str]] = [tokenize(c["text"]) for c in self.chunks]
-        self.corpus_trigrams: List[List[str]] = [char_trigrams(c["text"]) for c in self.chunks]
-        self.bm25 = BM25Okapi(self.corpus_tokens) if self.corpus_tokens else None
-
-    def _jaccard(self, a: List[str], b: List[str]) -> float:
-        sa, sb = set(a), set(b)
-        if not sa or not sb:
-            return 0.0
-        inter = len(sa & sb)
-        union = len(sa | sb)
-        return inter / union if union else 0.0
-
-    def _trigram_overlap(self, a: List[str], b: List[str]) -> float:
-        sa, sb = set(a), set(b)
-        if not sa or not sb:
-            return 0.0
-        inter = len(sa & sb)
-        return inter / max(len(sa), len(sb))
+    def _source_idx(self, source_id: str) -> int:
+        idx = self._source_index.get(source_id)
+        if idx is None:
+            idx = self._source_index[source_id] = len(self.sources)
+            self.sources.append(source_id)
+        return idx
+
+    def _docs_of_source(self, source_id: str) -> np.ndarray:
+        idx = self._source_index.get(source_id)
+        if idx is None:
+            return np.empty(0, dtype=np.int64)
+        return np.nonzero(self.doc_source == idx)[0]
+
+    def _append(self, chunks: Iterable[Dict]):
+        # 入库时已经分好词的 chunk 带着 features，不用再跑 jieba；
+        # 每个 chunk 只留下 features、rowid 和资料下标，行本身随遍历释放
+        features, live, sources, rowids = [], [], [], []
+        for c in chunks:
+            features.append(c["features"] if c.get("features") is not None else text_features(c["text"]))
+            source_id = c.get("source_id")
+            if not c.get("enabled", True):
+                self.disabled_sources.add(source_id)
+            live.append(source_id not in self.disabled_sources)
+            sources.append(self._source_idx(source_id))
+            rowids.append(c["rowid"])
+        if not rowids:
+            return
+        self.scorer.add(features, live=live)
+        self.doc_source = np.concatenate([self.doc_source, np.array(sources, dtype=np.int32)])
+        self.doc_rowid = np.concatenate([self.doc_rowid, np.array(rowids, dtype=np.int64)])
+
+    def _compact(self):
+        keep = self.scorer.compact()
+        if keep is None:
+            return
+        self.doc_rowid = self.doc_rowid[keep]
+        self.doc_source = self.doc_source[keep]
+
+    def add_chunks(self, chunks: List[Dict], removed_rowids: Iterable[int] = ()):
+        """
+        增量加入新摄取的 chunks（需带 rowid，见 create_chunks_batch_db）；
+        重新摄取的 chunk 在数据库里是原地更新，rowid 不变，据此找到并替换旧文档。
+        removed_rowids 是资料重新摄取后不再存在的 chunk（见 save_chunks 的 chunk 级比对）
+        """
+        with self._lock:
+            rowids = np.fromiter((c["rowid"] for c in chunks), dtype=np.int64, count=len(chunks))
+            rowids = np.concatenate([rowids, np.fromiter(removed_rowids, dtype=np.int64)])
+            replaced = np.nonzero(np.isin(self.doc_rowid, rowids) & ~self.scorer.deleted)[0]
+            if len(replaced):
+                self.scorer.delete(replaced)
+            self._append(chunks)
+            self._compact()
+
+    def remove_source(self, source_id: str):
+        with self._lock:
+            self.disabled_sources.discard(source_id)
+            docs = self._docs_of_source(source_id)
+            if not len(docs):
+                return
+            self.scorer.delete(docs)
+            self._compact()
+
+    def set_source_enabled(self, source_id: str, enabled: bool):
+        with self._lock:
+            if enabled:
+                self.disabled_sources.discard(source_id)
+            else:
+                self.disabled_sources.add(source_id)
+            self.scorer.set_live(self._docs_of_source(source_id), enabled)
 
     def search(self, query: str, top_k: int = 8) -> List[Tuple[Dict, float]]:
-        if not self.chunks:
-            return []
-        q_tokens = tokenize(query)
-        q_trigrams = char_trigrams(query)
-
-        bm_scores: List[float]
-        if self.bm25:
-            bm_raw = list(self.bm25.get_scores(q_tokens))
-            bm_scores = _min_max_norm([float(x) for x in bm_raw])
-        else:
-            bm_scores = [0.0 for _ in self.chunks]
-
-        jac_scores: List[float] = []
-        tri_scores: List[float] = []
-        for i in range(len(self.chunks)):
-            jac = self._jaccard(q_tokens, self.corpus_tokens[i])
-            tri = self._trigram_overlap(q_trigrams, self.corpus_trigrams[i])
-            jac_scores.append(jac)
-            tri_scores.append(tri)
-
-        # 权重：BM25 0.6 + Jaccard 0.25 + Trigram 0.15
-        scores = []
-        for i in range(len(self.chunks)):
-            s = 0.6 * bm_scores[i] + 0.25 * jac_scores[i] + 0.15 * tri_scores[i]
-            scores.append(s)
-
-        ranked = sorted(
-            [(self.chunks[i], float(scores[i])) for i in range(len(self.chunks))],
-            key=lambda x: x[1],
-            reverse=True,
-        )
-        return ranked[:top_k]
+        return self.search_many([query], top_k=top_k)[0]
+
+    def search_many(self, queries: List[str], top_k: int = 8) -> List[List[Tuple[Dict, float]]]:
+        """
+        批量检索：整批 query 合成一个稀疏矩阵，与语料矩阵做一次矩阵乘法；
+        所有 query 的命中 chunk 用一条 SQL 取回
+        """
+        features = [text_features(q) for q in queries]
+        with self._lock:
+            results = self.scorer.search_many(features, top_k)
+            hits = [self.doc_rowid[docs].tolist() for docs, _ in results]
+        chunks = get_chunks_by_rowids_db({rowid for rowids in hits for rowid in rowids})
+        # 并发删除的 chunk 可能已经不在数据库里了，跳过即可
+        return [
+            [(chunks[rowid], float(s)) for rowid, s in zip(rowids, scores.tolist()) if rowid in chunks]
+            for rowids, (_, scores) in zip(hits, results)
+        ]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        估算索引占用的内存：heap 是进程自己的内存，mapped 是快照文件的 mmap 映射
+        """
+        with self._lock:
+            heap, mapped = self.scorer.memory_usage()
+            h, m = array_bytes([self.doc_rowid, self.doc_source])
+            heap, mapped = heap + h, mapped + m
+            return {"heap": heap, "mapped": mapped, "total": heap + mapped}
+
+    # --- 快照 ---
+
+    def export(self) -> Tuple[Dict, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        with self._lock:
+            meta, frozen, mutable = self.scorer.export()
+            mutable.update({"doc_rowid": self.doc_rowid, "doc_source": self.doc_source})
+            meta.update({
+                "generation": self.generation,
+                "sources": self.sources,
+                "disabled_sources": sorted(s for s in self.disabled_sources if s is not None),
+            })
+            return meta, frozen, mutable
+
+    @classmethod
+    def from_export(cls, meta: Dict, frozen: Dict[str, np.ndarray], mutable: Dict[str, np.ndarray]) -> "HybridIndex":
+        index = cls(generation=meta["generation"])
+        index.doc_rowid = mutable.pop("doc_rowid")
+        index.doc_source = mutable.pop("doc_source")
+        index.sources = list(meta["sources"])
+        index._source_index = {s: i for i, s in enumerate(index.sources)}
+        index.disabled_sources = set(meta["disabled_sources"])
+        index.scorer = SparseScorer.from_export(meta, frozen, mutable)
+        return index
@@ -1,13 +1,21 @@
+import hashlib
 import json
+import multiprocessing
 import os
+import threading
 import time
-from typing import Dict, List, Optional
-import requests
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 from bs4 import BeautifulSoup
 from readability import Document
 import fitz  # PyMuPDF
-from .utils import clean_text, chunk_text
-from .ocr import ocr_image
+import numpy as np
+from .utils import clean_text, chunk_text, iter_clean_text, iter_text_windows, text_features, chunk_hash
+from .fetch import FetchResult, get_url_fetcher
+from .ocr import ocr_array, ocr_images
+from .ocr_plan import OCR_BUDGET_SECONDS, OcrPlanner, merge_reports
 import asyncio
 from pyppeteer import launch
 
@@ -19,108 +27,325 @@ def ensure_data_dir():
     os.makedirs(DATA_DIR, exist_ok=True)
 
 
+class IngestCancelled(Exception):
+    """
+    进度回调要求取消摄取（见 jobs.py）；不会被各处跳过单个文件 / 页面错误的 except 吞掉
+    """
+
+
+class SourceFailed(Exception):
+    """
+    一个资料没能完整解析（文件打不开、读到一半出错）：摄取跳过它继续下一个，
+    不记它的新指纹、不删它的旧 chunk，下次摄取重新解析
+    """
+
+
+# 进度回调 progress(资料, 更新的字段)：资料是文件路径或 URL，为 None 时更新整个摄取的字段（phase）。
+# 回调里可以抛 IngestCancelled 取消摄取
+Progress = Callable[[Optional[str], Dict], None]
+
+
+def _chunk_dict(source_id: str, n: int, source_type: str, text: str, location: Optional[str] = None, url: Optional[str] = None, path: Optional[str] = None) -> Dict:
+    return {
+        "id": f"{source_id}#{n}",
+        "text": text,
+        "source_id": source_id,
+        "source_type": source_type,
+        "location": location,
+        "url": url,
+        "path": path,
+    }
+
+
 def _add_chunks(all_chunks: List[Dict], source_id: str, source_type: str, text: str, location: Optional[str] = None, url: Optional[str] = None, path: Optional[str] = None):
     text = clean_text(text)
     for chunk in chunk_text(text):
-        all_chunks.append(
-            {
-                "id": f"{source_id}#{len(all_chunks)}",
-                "text": chunk,
-                "source_id": source_id,
-                "source_type": source_type,
-                "location": location,
-                "url": url,
-                "path": path,
-            }
-        )
+        all_chunks.append(_chunk_dict(source_id, len(all_chunks), source_type, chunk, location=location, url=url, path=path))
+
+
+# PDF 按页并行处理（文本提取、图片 OCR、整页渲染 OCR）的 worker 进程数，<= 1 时在当前进程里逐页处理
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(os.cpu_count() or 1)))
+# 页数少于这个值的 PDF 不值得分发到进程池
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "8"))
+
+# 整页 OCR 先用低 DPI 渲染，平均置信度低于 OCR_MIN_CONFIDENCE 时再用高 DPI 渲染一次
+OCR_DPI_LOW = int(os.environ.get("OCR_DPI_LOW", "150"))
+OCR_DPI_HIGH = int(os.environ.get("OCR_DPI_HIGH", "300"))
+OCR_MIN_CONFIDENCE = float(os.environ.get("OCR_MIN_CONFIDENCE", "70"))
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    # 进程池常驻，多次摄取共用；用 spawn 而不是 fork：服务进程里有多个线程（请求、索引构建），
+    # fork 出的子进程可能继承别的线程持有的锁
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+
+def _reset_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False)
+        _pdf_pool = None
 
 
-def ingest_pdf(file_path: str, source_id: Optional[str] = None) -> List[Dict]:
+def _pdf_page_text(doc, page, i: int, xref_texts: Optional[Dict[int, str]] = None, planner: Optional[OcrPlanner] = None) -> str:
+    # xref_texts: 本文档里已经识别过的图片 xref -> OCR 文本。logo、页眉、水印这类每页都嵌同一张图的，
+    # 第二次起不用再 extract_image；内容相同但 xref 不同的图片由 OCR 缓存兜住（见 ocr.ocr_images）
+    if xref_texts is None:
+        xref_texts = {}
+    if planner is None:
+        planner = OcrPlanner()
+    # 1. 尝试直接提取文本
+    text = page.get_text() or ""
+    
+    # 2. OCR 增强逻辑：如果页面包含图片，尝试对图片进行 OCR
+    # PyMuPDF 的 get_images() 返回页面内的图片列表
+    images = page.get_images(full=True)
+    if images:
+        # 图标、页面上很小的图、已经被文字层覆盖的图不 OCR，预算用完也不再 OCR（见 ocr_plan.py）
+        selected = planner.plan_images(page, images, len(text.strip()), xref_texts)
+        print(f"DEBUG: Page {i+1} has {len(images)} images, {len(selected)} worth OCR")
+        # 先取出整页要识别的图片，再一次性交给 OCR worker 池并行识别
+        xrefs, image_batch = [], []
+        for xref in selected:
+            if xref in xref_texts:
+                continue
+            try:
+                base_image = doc.extract_image(xref)
+                xrefs.append(xref)
+                image_batch.append(base_image["image"])
+            except Exception as e:
+                print(f"WARNING: Failed to extract image {xref} on page {i+1}: {e}")
+        if image_batch:
+            started = time.time()
+            xref_texts.update(zip(xrefs, ocr_images(image_batch)))
+            planner.charge(time.time() - started, len(image_batch))
+        
+        # 将 OCR 结果追加到文本末尾
+        ocr_texts = [xref_texts[xref] for xref in selected if xref_texts.get(xref)]
+        
+        if ocr_texts:
+            combined_ocr = "\n".join(ocr_texts)
+            print(f"DEBUG: OCR extracted {len(combined_ocr)} chars from images on page {i+1}")
+            # 将 OCR 结果追加到页面文本末尾
+            text += "\n" + combined_ocr
+    
+    # 3. 如果整页依然没文本（既没文字层也没提取出 OCR），尝试整页渲染 OCR
+    # 这是最后的保底，防止漏掉那些“绘制”出来的文字（非 Image 对象）
+    if len(text.strip()) < 50 and planner.plan_full_page():
+        print(f"DEBUG: Page {i+1} still has little text ({len(text.strip())} chars), attempting full-page OCR...")
+        try:
+            started = time.time()
+            ocr_text = _full_page_ocr(page, i)
+            planner.charge(time.time() - started)
+            if ocr_text:
+                print(f"DEBUG: Full-page OCR extracted {len(ocr_text)} chars from page {i+1}")
+                text += "\n" + ocr_text
+        except Exception as e:
+            print(f"ERROR: Full-page OCR failed for page {i+1}: {e}")
+    return text
+
+
+def _pixmap_gray(pix) -> np.ndarray:
+    # 直接包装 Pixmap 的像素缓冲区（samples_mv 不复制，samples 会复制一份 bytes）；
+    # 每行可能有填充，按 stride 切回 width。数组引用着 pix 的内存，用完之前 pix 不能释放
+    return np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def _full_page_ocr(page, i: int) -> str:
+    """
+    整页渲染成灰度图后 OCR，不经过 PNG 编码 / 解码。先用 OCR_DPI_LOW 渲染，
+    置信度不够再用 OCR_DPI_HIGH，取置信度高的结果
+    """
+    best_text, best_conf = "", None
+    for dpi in (OCR_DPI_LOW, OCR_DPI_HIGH):
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+        text, conf = ocr_array(_pixmap_gray(pix))
+        del pix
+        if conf is None:
+            # OCR 失败或不可用，换 DPI 也没用
+            break
+        if best_conf is None or conf > best_conf:
+            best_text, best_conf = text, conf
+        if conf >= OCR_MIN_CONFIDENCE or dpi >= OCR_DPI_HIGH:
+            break
+        print(f"DEBUG: Full-page OCR of page {i+1} at {dpi} dpi has low confidence ({conf:.0f}), retrying at {OCR_DPI_HIGH} dpi")
+    return best_text
+
+
+def _iter_pdf_page_texts(file_path: str, pages: range, planner: OcrPlanner, on_page: Optional[Callable[[int], None]] = None) -> Iterator[Tuple[int, str]]:
+    # 逐页产出 (页下标, 文本)；on_page 每处理完一页调用一次
+    xref_texts: Dict[int, str] = {}
+    doc = fitz.open(file_path)
+    try:
+        for i in pages:
+            text = None
+            try:
+                text = _pdf_page_text(doc, doc[i], i, xref_texts, planner)
+            except Exception as e:
+                print(f"Error reading page {i} of {file_path}: {e}")
+            if on_page is not None:
+                on_page(i)
+            if text is not None:
+                yield i, text
+    finally:
+        doc.close()
+
+
+def _pdf_pages_text(file_path: str, pages: range, ocr_budget: float) -> Tuple[List[Tuple[int, str]], Dict]:
+    """
+    处理 PDF 的一段页码，返回 ([(页下标, 文本)], OCR 决定的 report)；
+    在 worker 进程里运行，每个进程自己打开文档，ocr_budget 是分给这段页码的 OCR 时间预算
+    """
+    planner = OcrPlanner(ocr_budget)
+    return list(_iter_pdf_page_texts(file_path, pages, planner)), planner.report()
+
+
+def _page_ranges(page_count: int, parts: int) -> List[range]:
+    # 连续的页码段；段数是 worker 数的几倍，扫描页和文字页耗时差别很大，段小一些负载更均衡
+    size = max(1, -(-page_count // parts))
+    return [range(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def _iter_pdf_pages(file_path: str, page_count: int, reports: List[Dict], on_pages: Optional[Callable[[int, int], None]] = None) -> Iterator[Tuple[int, str]]:
+    """
+    按页码顺序产出 (页下标, 文本)，各段的 OCR report 追加到 reports。
+    页数多时分段交给进程池，按段产出；进程池崩溃时从还没产出的页接着在当前进程里逐页处理。
+    最多同时提交 2 倍 PDF_WORKERS 段，消费一段再提交下一段，调用方处理得慢时已处理完的页不会堆在内存里
+    """
+    next_page = 0
+    if PDF_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        ranges = iter(_page_ranges(page_count, PDF_WORKERS * 4))
+        pending: Deque = deque()
+        try:
+            pool = _get_pdf_pool()
+            while True:
+                while len(pending) < 2 * PDF_WORKERS:
+                    r = next(ranges, None)
+                    if r is None:
+                        break
+                    # OCR 预算按页数分给各段
+                    pending.append((r, pool.submit(_pdf_pages_text, file_path, r, OCR_BUDGET_SECONDS * len(r) / page_count)))
+                if not pending:
+                    break
+                # 按提交顺序取结果，拼起来就是页码顺序
+                r, future = pending.popleft()
+                part, report = future.result()
+                reports.append(report)
+                next_page = r.stop
+                if on_pages is not None:
+                    on_pages(next_page, page_count)
+                yield from part
+        except BrokenProcessPool as e:
+            # worker 进程崩溃（比如 MuPDF 在坏文件上段错误）：换一个新进程池，剩下的页在当前进程里处理
+            print(f"ERROR: PDF worker pool broke while processing {file_path}: {e}, continuing serially from page {next_page+1}")
+            _reset_pdf_pool()
+        finally:
+            # 调用方中途停止迭代时取消还没开始的段
+            for _, future in pending:
+                future.cancel()
+            pending.clear()
+    if next_page < page_count:
+        planner = OcrPlanner(OCR_BUDGET_SECONDS * (page_count - next_page) / page_count)
+        on_page = None
+        if on_pages is not None:
+            on_page = lambda i: on_pages(i + 1, page_count)
+        try:
+            yield from _iter_pdf_page_texts(file_path, range(next_page, page_count), planner, on_page)
+        finally:
+            reports.append(planner.report())
+
+
+def iter_pdf_chunks(
+    file_path: str,
+    source_id: Optional[str] = None,
+    ocr_report: Optional[Dict] = None,
+    on_pages: Optional[Callable[[int, int], None]] = None,
+) -> Iterator[Dict]:
+    """
+    逐页产出 chunk，不把整个文档的 chunk 放在内存里（见 stream_ingest）。
+    ocr_report 不为 None 时，迭代完后填入这个文档的 OCR 决定和耗时统计（见 ocr_plan.merge_reports）；
+    on_pages(已处理页数, 总页数) 报告进度，并行处理时按页码段报告
+    """
     ensure_data_dir()
     source_id = source_id or os.path.basename(file_path)
-    chunks: List[Dict] = []
+    count = 0
     
     try:
         doc = fitz.open(file_path)
-        print(f"DEBUG: Processing PDF {file_path} with {len(doc)} pages")
+        page_count = len(doc)
+        doc.close()
+        print(f"DEBUG: Processing PDF {file_path} with {page_count} pages")
+        if on_pages is not None:
+            on_pages(0, page_count)
         
-        for i, page in enumerate(doc):
-            try:
-                # 1. 尝试直接提取文本
-                text = page.get_text() or ""
-                
-                # 2. OCR 增强逻辑：如果页面包含图片，尝试对图片进行 OCR
-                # PyMuPDF 的 get_images() 返回页面内的图片列表
-                images = page.get_images(full=True)
-                if images:
-                    print(f"DEBUG: Page {i+1} has {len(images)} images, attempting OCR...")
-                    ocr_texts = []
-                    for img_index, img in enumerate(images):
-                        try:
-                            xref = img[0]
-                            base_image = doc.extract_image(xref)
-                            image_bytes = base_image["image"]
-                            
-                            # 简单的去重逻辑：如果这一页已经提取了很多文本（>500字），
-                            # 且图片较小（可能是图标），则跳过 OCR 以节省时间
-                            # 这里暂不实现复杂的重叠检测，而是简单地将 OCR 结果追加到文本末尾
-                            ocr_res = ocr_image(image_bytes)
-                            if ocr_res:
-                                ocr_texts.append(ocr_res)
-                        except Exception as e:
-                            print(f"WARNING: Failed to extract/OCR image {img_index} on page {i+1}: {e}")
-                    
-                    if ocr_texts:
-                        combined_ocr = "\n".join(ocr_texts)
-                        print(f"DEBUG: OCR extracted {len(combined_ocr)} chars from images on page {i+1}")
-                        # 将 OCR 结果追加到页面文本末尾
-                        text += "\n" + combined_ocr
-                
-                # 3. 如果整页依然没文本（既没文字层也没提取出 OCR），尝试整页渲染 OCR
-                # 这是最后的保底，防止漏掉那些“绘制”出来的文字（非 Image 对象）
-                if len(text.strip()) < 50:
-                    print(f"DEBUG: Page {i+1} still has little text ({len(text.strip())} chars), attempting full-page OCR...")
-                    try:
-                        # 渲染页面为图片 (dpi=300 提升清晰度)
-                        pix = page.get_pixmap(dpi=300)
-                        img_bytes = pix.tobytes("png")
-                        ocr_text = ocr_image(img_bytes)
-                        if ocr_text:
-                            print(f"DEBUG: Full-page OCR extracted {len(ocr_text)} chars from page {i+1}")
-                            text += "\n" + ocr_text
-                    except Exception as e:
-                        print(f"ERROR: Full-page OCR failed for page {i+1}: {e}")
-
-                if text.strip():
-                    _add_chunks(chunks, source_id, "pdf", text, location=f"page {i+1}", path=file_path)
-            except Exception as e:
-                print(f"Error reading page {i} of {file_path}: {e}")
+        reports: List[Dict] = []
+        # 按页码顺序切块编号，chunk id 和逐页处理时一致
+        for i, text in _iter_pdf_pages(file_path, page_count, reports, on_pages):
+            if not text.strip():
                 continue
-                
-        doc.close()
+            page_chunks = chunk_text(clean_text(text))
+            for k, chunk in enumerate(page_chunks):
+                yield _chunk_dict(source_id, count + k, "pdf", chunk, location=f"page {i+1}", path=file_path)
+            count += len(page_chunks)
+        if ocr_report is not None:
+            ocr_report.update(merge_reports(reports, OCR_BUDGET_SECONDS))
+            print(f"DEBUG: OCR plan for {file_path}: {ocr_report['ocr_count']} OCR runs in {ocr_report['ocr_seconds']}s, "
+                  f"{ocr_report['skipped']} skipped (~{ocr_report['estimated_seconds_saved']}s saved)")
+    except IngestCancelled:
+        raise
     except Exception as e:
         print(f"Error opening PDF {file_path}: {e}")
-        
+        # 不能当作正常结束：否则解析到一半的文档会带着新指纹存下来，以后一直被跳过
+        raise SourceFailed(f"Failed to parse {file_path}: {e}") from e
+
+
+def ingest_pdf(
+    file_path: str,
+    source_id: Optional[str] = None,
+    ocr_report: Optional[Dict] = None,
+    on_pages: Optional[Callable[[int, int], None]] = None,
+) -> List[Dict]:
+    chunks: List[Dict] = []
+    try:
+        chunks.extend(iter_pdf_chunks(file_path, source_id, ocr_report, on_pages))
+    except SourceFailed:
+        # 单独解析一个 PDF 时和以前一样，出错前解析出的部分照常返回
+        pass
     return chunks
 
 
-def ingest_text_file(file_path: str, source_id: Optional[str] = None) -> List[Dict]:
+# 流式读取文本文件的块大小（字符）
+TEXT_READ_SIZE = 1 << 20
+
+def iter_text_file_chunks(file_path: str, source_id: Optional[str] = None) -> Iterator[Dict]:
+    """
+    分块读取文本文件并逐个产出 chunk，切出来的和整个读进来再 clean_text + chunk_text 一样
+    """
     ensure_data_dir()
     source_id = source_id or os.path.basename(file_path)
     with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        text = f.read()
-    chunks: List[Dict] = []
-    _add_chunks(chunks, source_id, "text", text, path=file_path)
-    return chunks
+        blocks = iter(lambda: f.read(TEXT_READ_SIZE), "")
+        for n, chunk in enumerate(iter_text_windows(iter_clean_text(blocks))):
+            yield _chunk_dict(source_id, n, "text", chunk, path=file_path)
+
+
+def ingest_text_file(file_path: str, source_id: Optional[str] = None) -> List[Dict]:
+    return list(iter_text_file_chunks(file_path, source_id))
 
 
 def _get_html_via_requests(url: str) -> str:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
-    }
-    resp = requests.get(url, headers=headers, timeout=20)
-    resp.raise_for_status()
-    return resp.text
+    result = get_url_fetcher().fetch(url)
+    if result.error is not None:
+        raise result.error
+    return result.text
 
 
 import shutil
@@ -154,13 +379,29 @@ async def _get_html_via_pyppeteer(url: str) -> str:
 
 
 def ingest_url(url: str, source_id: Optional[str] = None) -> List[Dict]:
+    html = _fetch_url_html(url)
+    if not html:
+        return []
+    return _url_chunks(url, html, source_id)
+
+
+def _fetch_url_html(url: str, fetched: Optional[FetchResult] = None) -> str:
+    """
+    fetched 是并发抓取阶段（UrlFetcher.fetch_all）已经拿到的结果；
+    内容不够时的 pyppeteer 渲染在调用线程里串行进行
+    """
     ensure_data_dir()
     print(f"DEBUG: Starting ingest for {url}")
     
     html = ""
     try:
         # 1. 尝试 requests
-        html = _get_html_via_requests(url)
+        if fetched is None:
+            html = _get_html_via_requests(url)
+        elif fetched.error is not None:
+            raise fetched.error
+        else:
+            html = fetched.text
         # 简单的检查：如果内容太短，可能是 SPA 或反爬，转用 Pyppeteer
         if len(html) < 500 or "<script" in html[:500] and "<body>" not in html[:1000]:
             print(f"Requests content too short or looks like SPA, switching to Pyppeteer for {url}")
@@ -180,7 +421,11 @@ def ingest_url(url: str, source_id: Optional[str] = None) -> List[Dict]:
             # If both fail, we might want to return empty list instead of crashing
             # or raise a more user-friendly error.
             # For now, let's catch it and return empty list so other sources can proceed.
-            return []
+            return ""
+    return html
+
+
+def _url_chunks(url: str, html: str, source_id: Optional[str] = None) -> List[Dict]:
 
     doc = Document(html)
     summary_html = doc.summary()
@@ -240,22 +485,314 @@ def ingest_url(url: str, source_id: Optional[str] = None) -> List[Dict]:
 from .notebooks import NotebookManager
 from .db import (
     load_chunks_db, 
-    create_chunks_batch_db, 
-    create_source_db,
+    iter_index_rows_db,
+    bulk_ingest_db,
     count_chunks_by_source,
-    get_source_db
+    count_chunk_rows_db,
+    get_source_db,
+    find_source_by_url_db,
+    update_source_meta_db,
+    list_chunk_hashes_db,
+    list_stale_chunks_db,
+    update_chunk_features_db
 )
 
+def hash_file(file_path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _source_meta(source: Optional[Dict]) -> Dict:
+    if not source or not source.get('meta_data'):
+        return {}
+    return json.loads(source['meta_data'])
+
+
+def _stored_meta(notebook_id: Optional[str], source: Optional[Dict]) -> Dict:
+    # 资料的 chunk 还都在库里时才用它的指纹跳过重新摄取；chunk 丢了（或统计对不上）就当没摄取过
+    if not notebook_id or not source or not source.get('chunk_count'):
+        return {}
+    if source['chunk_count'] != count_chunk_rows_db(notebook_id, source['id']):
+        return {}
+    return _source_meta(source)
+
+
+def file_fingerprint(file_path: str, notebook_id: Optional[str] = None, source_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    文件的内容指纹 {content_hash, size, mtime}；和笔记本里已摄取的版本内容相同时返回 None。
+    size 和 mtime 都没变就不再读文件算哈希
+    """
+    source_id = source_id or os.path.basename(file_path)
+    st = os.stat(file_path)
+    meta = _stored_meta(notebook_id, get_source_db(notebook_id, source_id)) if notebook_id else {}
+    if meta.get('content_hash') and meta.get('size') == st.st_size and meta.get('mtime') == st.st_mtime:
+        return None
+    fingerprint = {'content_hash': hash_file(file_path), 'size': st.st_size, 'mtime': st.st_mtime}
+    if meta.get('content_hash') == fingerprint['content_hash']:
+        # 内容没变只是 mtime 变了（touch、重新拷贝）：记下新的 mtime，下次 stat 一下就能跳过
+        meta.update(fingerprint)
+        update_source_meta_db(notebook_id, source_id, meta)
+        return None
+    return fingerprint
+
+
+def _counted(chunks: Iterable[Dict], done: Callable[[int], None], fail: Callable[[], None]) -> Iterator[Dict]:
+    # 迭代完后报告产出了多少个 chunk；没解析完时报告失败，异常（读文件的 OSError 转成 SourceFailed）交给写入端处理
+    n = 0
+    try:
+        for chunk in chunks:
+            n += 1
+            yield chunk
+    except SourceFailed:
+        fail()
+        raise
+    except OSError as e:
+        fail()
+        raise SourceFailed(str(e)) from e
+    done(n)
+
+
+def _pdf_source_chunks(file_path: str, source_id: str, fingerprint: Dict, on_pages: Callable[[int, int], None]) -> Iterator[Dict]:
+    # OCR 决定和省下的时间随指纹一起存进资料的 meta_data
+    ocr_report: Dict = {}
+    yield from iter_pdf_chunks(file_path, source_id, ocr_report, on_pages)
+    if ocr_report:
+        fingerprint['ocr_plan'] = ocr_report
+
+
+def iter_sources(
+    file_paths: List[str],
+    urls: List[str],
+    notebook_id: Optional[str] = None,
+    progress: Optional[Progress] = None,
+    skipped: Optional[List[str]] = None,
+    failed: Optional[List[str]] = None,
+) -> Iterator[Tuple[str, Dict, Iterator[Dict]]]:
+    """
+    逐个资料产出 (source_id, 内容指纹, chunk 迭代器)：PDF 逐页、文本文件分块读取，chunk 边解析边产出。
+    内容没变的资料不再解析、OCR、分块，记进 skipped。PDF 的指纹里还会带上 OCR 决定的统计（ocr_plan），
+    在它的 chunk 迭代完之后才填进去。打不开、抓不到的资料记进 failed；解析到一半出错的，
+    chunk 迭代器抛 SourceFailed（也记进 failed），调用方不能保存它的指纹。
+    progress 收到每个文件 / URL 的 status（parsing / fetching / parsed / skipped / failed）和 PDF 的页数进度
+    """
+    report: Progress = progress or (lambda source, update: None)
+    skipped = skipped if skipped is not None else []
+    failed = failed if failed is not None else []
+
+    def fail(source: str):
+        failed.append(source)
+        report(source, {"status": "failed"})
+
+    for fp in file_paths:
+        report(fp, {"status": "parsing"})
+        source_id = os.path.basename(fp)
+        try:
+            fingerprint = file_fingerprint(fp, notebook_id, source_id)
+        except OSError as e:
+            # 文件不存在、没有读权限：跳过这一个，其余的照常摄取
+            print(f"ERROR: Cannot read {fp}: {e}")
+            fail(fp)
+            continue
+        if fingerprint is None:
+            print(f"DEBUG: {fp} unchanged since last ingest, skipping")
+            skipped.append(fp)
+            report(fp, {"status": "skipped"})
+            continue
+        ext = os.path.splitext(fp)[1].lower()
+        if ext in [".pdf"]:
+            chunks = _pdf_source_chunks(
+                fp, source_id, fingerprint,
+                on_pages=lambda done, total, fp=fp: report(fp, {"pages_done": done, "pages_total": total}),
+            )
+        else:
+            chunks = iter_text_file_chunks(fp, source_id)
+        yield source_id, fingerprint, _counted(
+            chunks, lambda n, fp=fp: report(fp, {"status": "parsed", "chunks": n}), lambda fp=fp: fail(fp)
+        )
+    # 网页先并发抓取（共用连接池，按站点限流），再按顺序逐个解析
+    for u in urls:
+        report(u, {"status": "fetching"})
+    for fetched in get_url_fetcher().fetch_all(urls):
+        u = fetched.url
+        html = _fetch_url_html(u, fetched)
+        if not html:
+            fail(u)
+            continue
+        # URL 的资料 id 是网页标题，解析后才知道，按 meta_data 里的 url 找上次的版本
+        content_hash = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        if notebook_id and _stored_meta(notebook_id, find_source_by_url_db(notebook_id, u)).get('content_hash') == content_hash:
+            print(f"DEBUG: {u} unchanged since last ingest, skipping")
+            skipped.append(u)
+            report(u, {"status": "skipped"})
+            continue
+        # 一个网页就是一段，整页解析
+        url_chunks = _url_chunks(u, html)
+        by_source: Dict[str, List[Dict]] = {}
+        for chunk in url_chunks:
+            by_source.setdefault(chunk['source_id'], []).append(chunk)
+        for source_id, chunks in by_source.items():
+            yield source_id, {'content_hash': content_hash}, iter(chunks)
+        report(u, {"status": "parsed", "chunks": len(url_chunks)})
+
+
+def ingest_sources(
+    file_paths: List[str],
+    urls: List[str],
+    notebook_id: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> Tuple[List[Dict], Dict[str, Dict], List[str], List[str]]:
+    """
+    解析一批文件和 URL，返回 (chunks, 各资料的内容指纹, 内容没变而跳过的文件 / URL, 失败的文件 / URL)，
+    所有 chunk 都在内存里（bulk_load 导入用，一般摄取走 stream_ingest）
+    """
+    chunks: List[Dict] = []
+    fingerprints: Dict[str, Dict] = {}
+    skipped: List[str] = []
+    failed: List[str] = []
+    for source_id, fingerprint, source_chunks in iter_sources(file_paths, urls, notebook_id, progress, skipped, failed):
+        try:
+            parsed = list(source_chunks)
+        except SourceFailed as e:
+            # 没解析完的资料整个不写，库里的旧版本保持不变
+            print(f"WARNING: {e}; keeping the previous version of {source_id}")
+            continue
+        chunks.extend(parsed)
+        fingerprints[source_id] = fingerprint
+    return chunks, fingerprints, skipped, failed
+
+
+class _SourceDiff:
+    """
+    一个资料重新摄取时，把新解析出的 chunk 逐个和库里的旧版本按正文哈希比对：
+    正文没变的 chunk 沿用原来的 id，不重写也不重建索引（位置变了的记进 relocated）；
+    新 chunk 的编号接在已有编号后面，不会和保留下来的 chunk 撞 id；比对完剩下的旧 chunk 要删除
+    """
+
+    def __init__(self, source_id: str, old: List[Tuple[str, int, str, Optional[str]]]):
+        self.source_id = source_id
+        self.pool: Dict[str, List[Tuple[str, int, Optional[str]]]] = {}
+        for cid, rowid, h, location in old:
+            self.pool.setdefault(h, []).append((cid, rowid, location))
+        # 第一次摄取的资料保留原来的编号
+        self.renumber = bool(old)
+        self.next_n = 1 + max((int(cid.rsplit('#', 1)[1]) for cid, _, _, _ in old if cid.rsplit('#', 1)[-1].isdigit()), default=-1)
+        self.relocated: List[Tuple[str, Optional[str]]] = []
+
+    def add(self, chunk: Dict) -> bool:
+        """
+        返回 chunk 是否需要写入
+        """
+        chunk['content_hash'] = chunk_hash(chunk.get('text', ''))
+        match = self.pool.get(chunk['content_hash'])
+        if match:
+            cid, _, location = match.pop(0)
+            if location != chunk.get('location'):
+                self.relocated.append((cid, chunk.get('location')))
+            return False
+        if self.renumber:
+            chunk['id'] = f"{self.source_id}#{self.next_n}"
+            self.next_n += 1
+        return True
+
+    def removed(self) -> List[Tuple[str, int]]:
+        # 新版本里没有的旧 chunk 的 (id, rowid)
+        return [(cid, rowid) for rows in self.pool.values() for cid, rowid, _ in rows]
+
+
+def diff_chunks(new_chunks: List[Dict], notebook_id: Optional[str] = None) -> Tuple[List[Dict], List[Tuple[str, int]], List[Tuple[str, Optional[str]]]]:
+    """
+    和库里同一资料已有的 chunk 按正文哈希比对（见 _SourceDiff），返回
+    (需要写入的 chunk, 要删除的旧 chunk 的 (id, rowid), 正文没变但位置变了的 chunk 的 (id, 新 location))
+    """
+    if not notebook_id:
+        for chunk in new_chunks:
+            chunk['content_hash'] = chunk_hash(chunk.get('text', ''))
+        return new_chunks, [], []
+    by_source: Dict[str, List[Dict]] = {}
+    for chunk in new_chunks:
+        by_source.setdefault(chunk.get('source_id'), []).append(chunk)
+    existing = list_chunk_hashes_db(notebook_id, by_source)
+
+    written: List[Dict] = []
+    removed: List[Tuple[str, int]] = []
+    relocated: List[Tuple[str, Optional[str]]] = []
+    for source_id, chunks in by_source.items():
+        diff = _SourceDiff(source_id, existing.get(source_id, []))
+        written.extend(chunk for chunk in chunks if diff.add(chunk))
+        removed.extend(diff.removed())
+        relocated.extend(diff.relocated)
+    return written, removed, relocated
+
+
 def load_chunks(notebook_id: Optional[str] = None) -> List[Dict]:
     return load_chunks_db(notebook_id)
 
-def save_chunks(new_chunks: List[Dict], notebook_id: Optional[str] = None) -> Dict[str, int]:
+def load_index_chunks(notebook_id: Optional[str] = None) -> Iterator[Dict]:
+    """
+    建索引用的精简 chunk（分批流式读取）：带预先分好词的 features，旧版本分词器写入的行 features 为 None、带 text
+    """
+    return iter_index_rows_db(notebook_id)
+
+def retokenize_stale_chunks(batch_size: int = 500) -> int:
+    """
+    分词器版本升级后，把库里旧版本的 features 分批重新计算（在后台线程里跑）
+    """
+    total = 0
+    while True:
+        rows = list_stale_chunks_db(limit=batch_size)
+        if not rows:
+            break
+        update_chunk_features_db([(rowid, text_features(text)) for rowid, text in rows])
+        total += len(rows)
+    if total:
+        print(f"DEBUG: Re-tokenized {total} chunks")
+    return total
+
+def _prepare_chunk(chunk: Dict, notebook_id: str):
+    # Inject notebook_id
+    chunk['notebook_id'] = notebook_id
+    # Ensure created_at
+    if 'created_at' not in chunk:
+        chunk['created_at'] = time.time()
+
+
+def _source_row(chunk: Dict, notebook_id: str, fingerprint: Optional[Dict] = None) -> Dict:
+    # Existing sources keep their row and only take the new meta_data
+    sid = chunk.get('source_id')
+    return {
+        'id': sid,
+        'notebook_id': notebook_id,
+        'source_type': chunk.get('source_type', 'unknown'),
+        'file_name': sid, # Use source_id as filename default
+        'created_at': chunk.get('created_at'),
+        'meta_data': {
+            'url': chunk.get('url'),
+            'path': chunk.get('path'),
+            # 内容哈希和 size / mtime，下次摄取时据此跳过没变的资料（见 iter_sources）
+            **(fingerprint or {})
+        }
+    }
+
+
+def save_chunks(
+    new_chunks: List[Dict],
+    notebook_id: Optional[str] = None,
+    bulk_load: Optional[bool] = None,
+    fingerprints: Optional[Dict[str, Dict]] = None,
+) -> Tuple[Dict[str, int], List[Dict], List[int]]:
+    """
+    保存一批解析出的 chunk，返回 (统计, 实际写入的 chunk, 删除的旧 chunk 的 rowid)，
+    后两项用来增量更新索引。重新摄取的资料只写入新增或改动的 chunk（见 diff_chunks）
+    """
     ensure_data_dir()
     
     if not notebook_id:
         # Fallback for legacy global mode or error
         print("WARNING: save_chunks called without notebook_id, skipping persistence.")
-        return {"added": 0, "total": 0, "before": 0}
+        return {"added": 0, "removed": 0, "relocated": 0, "unchanged": 0, "total": 0, "before": 0}, [], []
         
     print(f"DEBUG: save_chunks called with {len(new_chunks)} chunks for notebook {notebook_id}")
     
@@ -264,50 +801,129 @@ def save_chunks(new_chunks: List[Dict], notebook_id: Optional[str] = None) -> Di
     sources_to_create = {}
     
     for chunk in new_chunks:
-        # Inject notebook_id
-        chunk['notebook_id'] = notebook_id
-        # Ensure created_at
-        if 'created_at' not in chunk:
-            chunk['created_at'] = time.time()
-            
+        _prepare_chunk(chunk, notebook_id)
         sid = chunk.get('source_id')
         if not sid:
             continue
             
         if sid not in sources_to_create:
-            # Check if source already exists in DB to avoid overhead? 
-            # create_source_db uses INSERT OR IGNORE, so it's safe.
-            sources_to_create[sid] = {
-                'id': sid,
-                'notebook_id': notebook_id,
-                'source_type': chunk.get('source_type', 'unknown'),
-                'file_name': sid, # Use source_id as filename default
-                'created_at': chunk.get('created_at'),
-                'meta_data': {
-                    'url': chunk.get('url'),
-                    'path': chunk.get('path')
-                }
-            }
+            sources_to_create[sid] = _source_row(chunk, notebook_id, (fingerprints or {}).get(sid))
+    
+    # 2. 和已有的 chunk 比对，只有要写入的才分词（入库时分好词，建索引时直接读）
+    written, removed, relocated = diff_chunks(new_chunks, notebook_id)
+    for chunk in written:
+        if chunk.get('features') is None:
+            chunk['features'] = text_features(chunk.get('text', ''))
             
-    # Batch create sources
-    for s in sources_to_create.values():
-        create_source_db(
-            s['id'], 
-            s['notebook_id'], 
-            s['source_type'], 
-            s['file_name'], 
-            s['created_at'], 
-            s['meta_data']
+    # 资料和 chunk 在同一个事务里批量写入，中途失败不会留下没有 chunk 的资料；
+    # 大批量导入（bulk_load，默认按 chunk 数自动开启）推迟二级索引维护、加大页缓存
+    stats = bulk_ingest_db(
+        notebook_id, list(sources_to_create.values()), written, bulk_load=bulk_load,
+        removed_ids=[cid for cid, _ in removed], relocated=relocated,
+    )
+    stats["unchanged"] = len(new_chunks) - len(written)
+    return stats, written, [rowid for _, rowid in removed]
+
+
+# 流式摄取每攒够这么多个要写入的 chunk 提交一次事务、增量更新一次索引
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "256"))
+
+# on_batch(写入的 chunk, 删除的旧 chunk 的 rowid)：每次提交后调用，用来增量更新索引
+OnBatch = Callable[[List[Dict], List[int]], None]
+
+
+class ChunkWriter:
+    """
+    流式摄取的写入端：资料的 chunk 边解析边比对（见 _SourceDiff）、分词，攒够 batch_size 个就在一个事务里写入，
+    再通过 on_batch 增量加进索引，文档还没解析完，前面的部分就能检索到了。内存里只有当前这一批。
+    资料的内容指纹在它全部写完时才和删除旧 chunk 一起提交：中途失败（SourceFailed）或取消的话，
+    已经提交的部分留在库里，下次摄取不会因为指纹相同而跳过它
+    """
+
+    def __init__(self, notebook_id: str, on_batch: Optional[OnBatch] = None, batch_size: int = STREAM_BATCH_SIZE):
+        self.notebook_id = notebook_id
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.stats: Dict[str, int] = {"before": 0, "added": 0, "removed": 0, "relocated": 0, "unchanged": 0, "total": 0}
+        self.written = 0
+        self._flushed = False
+
+    def write_source(self, source_id: str, fingerprint: Optional[Dict], chunks: Iterable[Dict]):
+        diff = _SourceDiff(source_id, list_chunk_hashes_db(self.notebook_id, [source_id]).get(source_id, []))
+        source = None
+        batch: List[Dict] = []
+        try:
+            for chunk in chunks:
+                _prepare_chunk(chunk, self.notebook_id)
+                if source is None:
+                    # 写完之前资料行上不带指纹（旧指纹也去掉）
+                    source = _source_row(chunk, self.notebook_id)
+                if not diff.add(chunk):
+                    self.stats["unchanged"] += 1
+                    continue
+                chunk['features'] = text_features(chunk.get('text', ''))
+                batch.append(chunk)
+                if len(batch) >= self.batch_size:
+                    self._flush([source], batch, relocated=diff.relocated)
+                    batch, diff.relocated = [], []
+        except SourceFailed as e:
+            # 和取消一样：已经提交的批次留着，不记指纹、不删旧 chunk，下次摄取重新解析
+            print(f"WARNING: {e}; keeping the previous chunks of {source_id}")
+            return
+        if source is None:
+            # 没解析出任何 chunk：和以前一样不动库里的资料
+            return
+        source['meta_data'].update(fingerprint or {})
+        self._flush([source], batch, removed=diff.removed(), relocated=diff.relocated)
+
+    def _flush(self, sources: List[Dict], chunks: List[Dict], removed: Sequence[Tuple[str, int]] = (), relocated: Sequence[Tuple[str, Optional[str]]] = ()):
+        stats = bulk_ingest_db(
+            self.notebook_id, sources, chunks, bulk_load=False,
+            removed_ids=[cid for cid, _ in removed], relocated=relocated,
         )
-        
-    # 2. Save Chunks
-    # We need to know how many chunks were there before.
-    # This is expensive to count globally, maybe just return added count?
-    # The API returns {"added": ..., "total": ..., "before": ...}
-    # We can get total count for this notebook from DB.
-    # For now, let's just approximate or query.
-    
-    # Actually, let's just insert.
-    create_chunks_batch_db(new_chunks)
-    
-    return {"added": len(new_chunks), "total": -1, "before": -1}
+        if not self._flushed:
+            self.stats["before"] = stats["before"]
+            self._flushed = True
+        for key in ("added", "removed", "relocated"):
+            self.stats[key] += stats[key]
+        self.stats["total"] = stats["total"]
+        self.written += len(chunks)
+        # 和 bulk_ingest_db 里 generation 加一的条件一致，索引的 generation 才能和数据库对上
+        if self.on_batch is not None and (chunks or stats["removed"] or stats["relocated"]):
+            self.on_batch(chunks, [rowid for _, rowid in removed])
+
+
+def stream_ingest(
+    file_paths: List[str],
+    urls: List[str],
+    notebook_id: Optional[str] = None,
+    progress: Optional[Progress] = None,
+    on_batch: Optional[OnBatch] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> Tuple[Dict, int]:
+    """
+    流式摄取一批文件和 URL：解析出的 chunk 分批写入、分批更新索引，峰值内存和文档大小无关。
+    返回 (统计, 写入的 chunk 数)
+    """
+    ensure_data_dir()
+    skipped: List[str] = []
+    failed: List[str] = []
+    if not notebook_id:
+        # Fallback for legacy global mode or error
+        print("WARNING: stream_ingest called without notebook_id, skipping persistence.")
+        for _, _, chunks in iter_sources(file_paths, urls, notebook_id, progress, skipped, failed):
+            try:
+                for _ in chunks:
+                    pass
+            except SourceFailed as e:
+                print(f"WARNING: {e}")
+        return {"added": 0, "removed": 0, "relocated": 0, "unchanged": 0, "total": 0, "before": 0, "skipped": skipped, "failed": failed}, 0
+    writer = ChunkWriter(notebook_id, on_batch=on_batch, batch_size=batch_size)
+    for source_id, fingerprint, chunks in iter_sources(file_paths, urls, notebook_id, progress, skipped, failed):
+        writer.write_source(source_id, fingerprint, chunks)
+    stats = dict(writer.stats, skipped=skipped, failed=failed)
+    if not writer._flushed:
+        # 什么都没写（资料都没变或都解析失败）：空写入只为取当前的 chunk 数，不会加 generation
+        counts = bulk_ingest_db(notebook_id, [], [], bulk_load=False)
+        stats["before"], stats["total"] = counts["before"], counts["total"]
+    return stats, writer.written
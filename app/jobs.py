@@ -0,0 +1,150 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Set
+from .db import (
+    create_ingest_job_db,
+    get_ingest_job_db,
+    claim_ingest_job_db,
+    update_ingest_job_progress_db,
+    heartbeat_ingest_jobs_db,
+    finish_ingest_job_db,
+    cancel_ingest_job_db,
+)
+from .ingest import IngestCancelled, Progress
+
+# 后台执行摄取任务的线程数（每个进程）
+INGEST_JOB_WORKERS = int(os.environ.get("INGEST_JOB_WORKERS", "2"))
+# 同一笔记本同时运行的摄取任务上限（所有进程合计），多出来的排队
+INGEST_JOBS_PER_NOTEBOOK = int(os.environ.get("INGEST_JOBS_PER_NOTEBOOK", "1"))
+# 运行中任务的租约：进程每隔 1/3 租约续一次，超过租约没续的任务（进程重启、崩溃）被重新领取
+INGEST_JOB_LEASE = float(os.environ.get("INGEST_JOB_LEASE", "60"))
+# 同一任务最多被领取几次；每次都没跑完（比如每次都把进程搞崩）就标成失败
+INGEST_JOB_MAX_ATTEMPTS = int(os.environ.get("INGEST_JOB_MAX_ATTEMPTS", "3"))
+# 没有可领的任务时多久再查一次数据库（本进程提交的任务会立即唤醒）
+INGEST_JOB_POLL_INTERVAL = 1.0
+# 进度最多隔这么久写一次数据库，取消请求也在写进度时检查
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+RunIngest = Callable[[Dict, Progress], Dict]
+
+
+class JobProgress:
+    """
+    一个运行中任务的进度：{"phase", "sources": {文件 / URL: {status, pages_done, pages_total, chunks}}}。
+    作为 ingest_sources 的 progress 回调，节流写进数据库；发现取消请求或租约丢了就抛 IngestCancelled
+    """
+
+    def __init__(self, job_id: str, owner: str, request: Dict):
+        self.job_id = job_id
+        self.owner = owner
+        sources = list(request.get("file_paths") or []) + list(request.get("urls") or [])
+        self.data: Dict = {"phase": "parsing", "sources": {s: {"status": "queued"} for s in sources}}
+        self._flushed_at = 0.0
+
+    def __call__(self, source: Optional[str], update: Dict):
+        if source is None:
+            self.data.update(update)
+        else:
+            self.data["sources"].setdefault(source, {}).update(update)
+        # 状态变化（开始 / 完成一个资料、进入下一阶段）立即写，页数进度节流
+        if "status" in update or "phase" in update or time.time() - self._flushed_at >= PROGRESS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._flushed_at = time.time()
+        cancel = update_ingest_job_progress_db(self.job_id, self.owner, self.data)
+        if cancel is None:
+            raise IngestCancelled(f"Lost the lease on ingest job {self.job_id}")
+        if cancel:
+            raise IngestCancelled(f"Ingest job {self.job_id} was cancelled")
+
+
+class IngestJobRunner:
+    """
+    后台摄取任务：POST /ingest/jobs 把请求写进 ingest_jobs 表后立即返回任务 id，
+    本进程的 worker 线程从表里领取任务执行。任务状态都在数据库里，进程重启后排队的任务照常执行，
+    执行到一半的任务租约过期后重新领取（重新摄取是幂等的：已经写入的资料内容没变会被跳过）。
+    多个进程共用一张表，同一笔记本同时运行的任务数受 INGEST_JOBS_PER_NOTEBOOK 限制
+    """
+
+    def __init__(self, run: RunIngest, workers: int = INGEST_JOB_WORKERS):
+        self._run = run
+        self._workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._active: Set[str] = set()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"ingest-job-{i}", daemon=True)
+            for i in range(max(1, self._workers))
+        ]
+        self._threads.append(threading.Thread(target=self._heartbeat, name="ingest-job-heartbeat", daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def submit(self, notebook_id: Optional[str], request: Dict) -> Dict:
+        job = create_ingest_job_db(uuid.uuid4().hex, notebook_id, request)
+        self._wake.set()
+        return job
+
+    @staticmethod
+    def get(job_id: str) -> Optional[Dict]:
+        return get_ingest_job_db(job_id)
+
+    @staticmethod
+    def cancel(job_id: str) -> Optional[Dict]:
+        return cancel_ingest_job_db(job_id)
+
+    def _worker(self):
+        while True:
+            try:
+                job = claim_ingest_job_db(self.owner, INGEST_JOBS_PER_NOTEBOOK, INGEST_JOB_LEASE, INGEST_JOB_MAX_ATTEMPTS)
+            except Exception as e:
+                print(f"ERROR: Failed to claim ingest job: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(INGEST_JOB_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            self._execute(job)
+
+    def _execute(self, job: Dict):
+        job_id = job["id"]
+        print(f"DEBUG: Running ingest job {job_id} for notebook {job['notebook_id']} (attempt {job['attempts']})")
+        with self._lock:
+            self._active.add(job_id)
+        progress = JobProgress(job_id, self.owner, job["request"])
+        try:
+            progress.flush()
+            result = self._run(job["request"], progress)
+            finish_ingest_job_db(job_id, self.owner, "done", result=result, progress=dict(progress.data, phase="done"))
+        except IngestCancelled as e:
+            print(f"DEBUG: {e}")
+            finish_ingest_job_db(job_id, self.owner, "cancelled", progress=dict(progress.data, phase="cancelled"))
+        except Exception as e:
+            print(f"ERROR: Ingest job {job_id} failed: {e}")
+            finish_ingest_job_db(job_id, self.owner, "failed", error=str(e), progress=progress.data)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+            # 同一笔记本排队的下一个任务现在可以运行了
+            self._wake.set()
+
+    def _heartbeat(self):
+        # 单个页面的 OCR 可能比租约还久，续租不能只靠进度回调
+        while True:
+            time.sleep(INGEST_JOB_LEASE / 3)
+            with self._lock:
+                active = list(self._active)
+            try:
+                heartbeat_ingest_jobs_db(self.owner, active)
+            except Exception as e:
+                print(f"ERROR: Failed to renew ingest job leases: {e}")
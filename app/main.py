@@ -1,41 +1,77 @@
-from typing import List, Optional, Dict
+import threading
+from typing import Callable, List, Optional, Dict
 from fastapi import FastAPI, Body, HTTPException
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 import os
 
-from .ingest import ingest_pdf, ingest_text_file, ingest_url, save_chunks, load_chunks, DATA_DIR
-from .index import Index
+from .ingest import ingest_sources, save_chunks, stream_ingest, load_chunks, load_index_chunks, retokenize_stale_chunks, DATA_DIR, Progress
 from .hybrid import HybridIndex
-from .rag import answer_query
+from .fts import FtsIndex
+from .cache import IndexCache
+from .builder import IndexBuilder
+from .rag import answer_query, invalidate_query_cache, query_cache_stats
 from .notebooks import NotebookManager
 from .sources import SourceManager
-from .db import init_db
+from .db import init_db, get_generation_db, get_notebook_db, get_search_backend_db, set_search_backend_db
+from .snapshot import save_snapshot, delete_snapshot
+from .jobs import IngestJobRunner
 
 # Initialize Database
 init_db()
+# 分词器版本升级后，后台把旧的预分词结果重算一遍；建索引时遇到旧行会临时自己分词
+threading.Thread(target=retokenize_stale_chunks, daemon=True).start()
 
 app = FastAPI(title="mynotebooklm", version="0.1.0")
 
 app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
 
-# 全局索引缓存：Dict[notebook_id, HybridIndex]
+# 全局索引缓存：notebook_id -> HybridIndex，按内存预算 LRU 淘汰，固定的笔记本不淘汰
 # key=None 代表默认的全局索引（旧兼容）
-_INDEX_CACHE: Dict[Optional[str], HybridIndex] = {}
+INDEX_CACHE_MAX_BYTES = int(os.environ.get("INDEX_CACHE_MAX_BYTES", str(1 << 30)))
+INDEX_CACHE_PINNED = [n for n in os.environ.get("INDEX_CACHE_PINNED", "").split(",") if n]
+_INDEX_CACHE = IndexCache(INDEX_CACHE_MAX_BYTES, pinned=INDEX_CACHE_PINNED)
+
+
+def build_index(notebook_id: Optional[str]) -> HybridIndex:
+    if not notebook_id:
+        return HybridIndex(load_index_chunks(notebook_id))
+    # 先读 generation 再读 chunks：期间若有写入，快照只会被标成旧的 generation，下次重建
+    generation = get_generation_db(notebook_id)
+    backend = get_search_backend_db(notebook_id)
+    if backend != "hybrid":
+        # FTS 后端直接查 SQLite，不占内存也没有快照
+        return FtsIndex(notebook_id, generation=generation, rescore_trigrams=backend == "fts+trigram")
+    index = HybridIndex(load_index_chunks(notebook_id), generation=generation)
+    save_snapshot(notebook_id, index)
+    return index
+
+
+# 缓存里没有的索引由构建器加载；写操作触发的增量更新 / 重建在后台线程执行
+_INDEX_BUILDER = IndexBuilder(_INDEX_CACHE, build=build_index)
 
 
 def get_index(notebook_id: Optional[str] = None) -> HybridIndex:
-    global _INDEX_CACHE
-    if notebook_id not in _INDEX_CACHE:
-        chunks = load_chunks(notebook_id)
-        _INDEX_CACHE[notebook_id] = HybridIndex(chunks)
-    return _INDEX_CACHE[notebook_id]
+    return _INDEX_BUILDER.get(notebook_id)
 
 
-def refresh_index(notebook_id: Optional[str] = None):
-    global _INDEX_CACHE
-    chunks = load_chunks(notebook_id)
-    _INDEX_CACHE[notebook_id] = HybridIndex(chunks)
+def refresh_index(notebook_id: Optional[str] = None) -> int:
+    """
+    后台全量重建，重建期间旧索引继续服务，返回新索引对应的 generation
+    """
+    _INDEX_BUILDER.submit(notebook_id)
+    # 全量重建时 generation 不一定变化，直接清掉这个笔记本的查询缓存
+    invalidate_query_cache(notebook_id)
+    return get_generation_db(notebook_id) if notebook_id else 0
+
+
+def update_index(notebook_id: Optional[str], update: Callable[[HybridIndex], None]) -> int:
+    """
+    写操作只需要增量更新已经加载的索引；没加载过的下次 get_index 时从快照或数据库加载。
+    更新在后台应用，返回写入后数据库的 generation：索引的 generation 追上它时这次写入就可见了。
+    """
+    _INDEX_BUILDER.submit(notebook_id, update)
+    return get_generation_db(notebook_id) if notebook_id else 0
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -47,7 +83,15 @@ def home():
 @app.get("/status")
 def status(notebook_id: Optional[str] = None):
     chunks = load_chunks(notebook_id)
-    return {"chunks": len(chunks), "data_dir": DATA_DIR, "notebook_id": notebook_id}
+    index = _INDEX_CACHE.get(notebook_id)
+    return {
+        "chunks": len(chunks),
+        "data_dir": DATA_DIR,
+        "notebook_id": notebook_id,
+        "query_cache": query_cache_stats(),
+        # 已加载索引当前可见的 generation，写操作返回的 generation 不超过它时即已生效
+        "index_generation": index.generation if index is not None else None,
+    }
 
 
 # --- Notebook Management ---
@@ -65,13 +109,57 @@ def create_notebook(title: str = Body(..., embed=True)):
 @app.delete("/notebooks/{notebook_id}")
 def delete_notebook(notebook_id: str):
     if NotebookManager.delete_notebook(notebook_id):
-        # 清除缓存
-        if notebook_id in _INDEX_CACHE:
-            del _INDEX_CACHE[notebook_id]
+        # 清除缓存和磁盘快照
+        _INDEX_CACHE.pop(notebook_id)
+        _INDEX_CACHE.unpin(notebook_id)
+        delete_snapshot(notebook_id)
+        invalidate_query_cache(notebook_id)
         return {"success": True}
     raise HTTPException(status_code=404, detail="Notebook not found")
 
 
+# --- Index Cache ---
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"index": _INDEX_CACHE.stats(), "query": query_cache_stats()}
+
+
+@app.post("/cache/pin/{notebook_id}")
+def pin_notebook(notebook_id: str):
+    if not get_notebook_db(notebook_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    _INDEX_CACHE.pin(notebook_id)
+    return {"success": True}
+
+
+@app.delete("/cache/pin/{notebook_id}")
+def unpin_notebook(notebook_id: str):
+    _INDEX_CACHE.unpin(notebook_id)
+    return {"success": True}
+
+
+@app.post("/notebooks/{notebook_id}/reindex")
+def reindex_notebook(notebook_id: str):
+    if not get_notebook_db(notebook_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    return {"success": True, "generation": refresh_index(notebook_id)}
+
+
+@app.put("/notebooks/{notebook_id}/backend")
+def set_search_backend(notebook_id: str, backend: str = Body(..., embed=True)):
+    # hybrid: 内存索引；fts / fts+trigram: SQLite FTS5，适合内存放不下的大笔记本
+    if not get_notebook_db(notebook_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    try:
+        set_search_backend_db(notebook_id, backend)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if backend != "hybrid":
+        delete_snapshot(notebook_id)
+    return {"success": True, "backend": backend, "generation": refresh_index(notebook_id)}
+
+
 # --- Source Management ---
 
 @app.get("/notebooks/{notebook_id}/sources")
@@ -82,40 +170,102 @@ def list_sources(notebook_id: str):
 def delete_source(notebook_id: str, source_id: str):
     # source_id 可能包含 / 等字符（如果是 path/url），这里用 :path 匹配
     if SourceManager.delete_source(notebook_id, source_id):
-        refresh_index(notebook_id)
-        return {"success": True}
+        generation = update_index(notebook_id, lambda index: index.remove_source(source_id))
+        return {"success": True, "generation": generation}
     raise HTTPException(status_code=404, detail="Source not found")
 
 @app.patch("/notebooks/{notebook_id}/sources/{source_id:path}")
 def update_source(notebook_id: str, source_id: str, enabled: bool = Body(..., embed=True)):
     if SourceManager.update_source(notebook_id, source_id, enabled=enabled):
-        refresh_index(notebook_id)
-        return {"success": True}
+        generation = update_index(notebook_id, lambda index: index.set_source_enabled(source_id, enabled))
+        return {"success": True, "generation": generation}
     raise HTTPException(status_code=404, detail="Source not found")
 
 
 # --- Ingest & Query (Updated) ---
 
+def run_ingest(
+    file_paths: List[str],
+    urls: List[str],
+    notebook_id: Optional[str] = None,
+    bulk_load: Optional[bool] = None,
+    progress: Optional[Progress] = None,
+) -> Dict:
+    # 内容没变的文件 / URL 直接跳过；变了的资料只写入和索引新增或改动的 chunk
+    if not bulk_load:
+        # 默认流式摄取：边解析边分批写入、增量更新索引，内存只有一批 chunk，大文档前面的部分先能检索到
+        stats, written_count = stream_ingest(
+            file_paths, urls, notebook_id=notebook_id, progress=progress,
+            on_batch=lambda written, removed_rowids: update_index(notebook_id, lambda index: index.add_chunks(written, removed_rowids)),
+        )
+        generation = get_generation_db(notebook_id) if notebook_id else 0
+        return {"ingested": stats, "new_chunks": written_count, "generation": generation}
+
+    # 显式 bulk_load：全部解析完后在一个事务里批量导入
+    new_chunks, fingerprints, skipped, failed = ingest_sources(file_paths, urls, notebook_id=notebook_id, progress=progress)
+    if progress is not None:
+        # 最后一个可以取消的点，之后的写入在一个事务里完成
+        progress(None, {"phase": "saving"})
+    stats, written, removed_rowids = save_chunks(new_chunks, notebook_id=notebook_id, bulk_load=bulk_load, fingerprints=fingerprints)
+    stats["skipped"] = skipped
+    stats["failed"] = failed
+    if stats["added"] or stats["removed"] or stats["relocated"]:
+        generation = update_index(notebook_id, lambda index: index.add_chunks(written, removed_rowids))
+    else:
+        generation = get_generation_db(notebook_id) if notebook_id else 0
+    
+    return {"ingested": stats, "new_chunks": len(written), "generation": generation}
+
+
+# 后台摄取任务：请求存进 ingest_jobs 表，worker 线程领取执行，进程重启后继续
+_INGEST_JOBS = IngestJobRunner(run=lambda request, progress: run_ingest(progress=progress, **request))
+_INGEST_JOBS.start()
+
+
 @app.post("/ingest")
 def ingest(
     file_paths: List[str] = Body(default=[]),
     urls: List[str] = Body(default=[]),
     notebook_id: Optional[str] = Body(None),
+    bulk_load: Optional[bool] = Body(None),
 ):
-    new_chunks = []
-    for fp in file_paths:
-        ext = os.path.splitext(fp)[1].lower()
-        if ext in [".pdf"]:
-            new_chunks.extend(ingest_pdf(fp))
-        else:
-            new_chunks.extend(ingest_text_file(fp))
-    for u in urls:
-        new_chunks.extend(ingest_url(u))
-    
-    stats = save_chunks(new_chunks, notebook_id=notebook_id)
-    refresh_index(notebook_id)
-    
-    return {"ingested": stats, "new_chunks": len(new_chunks)}
+    if notebook_id and not get_notebook_db(notebook_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    return run_ingest(file_paths, urls, notebook_id=notebook_id, bulk_load=bulk_load)
+
+
+@app.post("/ingest/jobs")
+def create_ingest_job(
+    file_paths: List[str] = Body(default=[]),
+    urls: List[str] = Body(default=[]),
+    notebook_id: Optional[str] = Body(None),
+    bulk_load: Optional[bool] = Body(None),
+):
+    if notebook_id and not get_notebook_db(notebook_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    job = _INGEST_JOBS.submit(notebook_id, {
+        "file_paths": file_paths,
+        "urls": urls,
+        "notebook_id": notebook_id,
+        "bulk_load": bulk_load,
+    })
+    return {"job_id": job["id"], "status": job["status"]}
+
+
+@app.get("/ingest/jobs/{job_id}")
+def get_ingest_job(job_id: str):
+    job = _INGEST_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/ingest/jobs/{job_id}/cancel")
+def cancel_ingest_job(job_id: str):
+    job = _INGEST_JOBS.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 @app.post("/query")
@@ -125,5 +275,5 @@ def query(
     notebook_id: Optional[str] = Body(None),
 ):
     index = get_index(notebook_id)
-    result = answer_query(q, index, top_k=top_k)
+    result = answer_query(q, index, top_k=top_k, notebook_id=notebook_id)
     return result
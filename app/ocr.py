@@ -1,7 +1,25 @@
 import sys
 import os
+import hashlib
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple, Union
 import cv2
 import numpy as np
+from .db import get_ocr_cache_db, put_ocr_cache_db
+
+# 多个 OCR worker 并行时，每个 tesseract 只用一个线程，否则 OpenMP 线程数会成倍超卖 CPU
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# 优先用 tesserocr：直接调用 libtesseract，模型加载一次后常驻
+try:
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
 
 # 尝试导入 pytesseract
 try:
@@ -10,6 +28,24 @@ try:
 except ImportError:
     pytesseract = None
 
+# lang='chi_sim+eng' 表示同时识别简体中文和英文
+OCR_LANG = os.environ.get("OCR_LANG", "chi_sim+eng")
+# psm 6 (SINGLE_BLOCK) 表示假设是一块统一的文本块
+OCR_PSM = 6
+# 常驻 OCR worker 线程数（tesserocr 识别时释放 GIL；pytesseract 每张图起一个子进程）
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", "2"))
+# 排队等待识别的图片上限，队列满时提交方阻塞
+OCR_QUEUE_SIZE = int(os.environ.get("OCR_QUEUE_SIZE", "64"))
+# 单张图片的识别超时（秒），超时的图片返回空字符串
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", "60"))
+# OCR 结果缓存（按图片内容 + OCR 配置寻址，跨文档、跨笔记本共用）的容量上限，0 表示不用缓存
+OCR_CACHE_MAX_MB = float(os.environ.get("OCR_CACHE_MAX_MB", "64"))
+# 预处理或识别参数改变时加一，旧的缓存结果不再命中
+OCR_CACHE_VERSION = 1
+
+# (文本, 平均置信度 0-100)；置信度在不需要时可能是 None
+OcrResult = Tuple[str, Optional[float]]
+
 def preprocess_image(image_bytes: bytes) -> np.ndarray:
     """
     图像预处理：转为 numpy -> 灰度 -> 二值化 -> 去噪
@@ -21,6 +57,14 @@ def preprocess_image(image_bytes: bytes) -> np.ndarray:
     # 2. 转灰度
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
+    return preprocess_gray(gray)
+
+
+def preprocess_gray(gray: np.ndarray) -> np.ndarray:
+    """
+    灰度图的预处理：二值化 -> 去噪。整页 OCR 直接传 fitz 渲染出的灰度像素（见 ocr_array），
+    不经过 PNG 编码 / 解码
+    """
     # 3. 自适应二值化 (Adaptive Thresholding)
     binary = cv2.adaptiveThreshold(
         gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
@@ -32,27 +76,232 @@ def preprocess_image(image_bytes: bytes) -> np.ndarray:
     
     return denoised
 
-def ocr_image(image_bytes: bytes) -> str:
+
+class OcrEngine(ABC):
     """
-    对图片字节流进行 OCR 识别 (使用 Tesseract)
+    识别一张预处理好的图片；每个 worker 线程持有自己的引擎实例，引擎不需要线程安全
     """
-    if pytesseract is None:
-        print("WARNING: pytesseract not installed. OCR disabled.")
-        return ""
-    
+
+    @abstractmethod
+    def recognize(self, img: np.ndarray, timeout: float, confidence: bool = False) -> Optional[OcrResult]:
+        """
+        返回 (文本, 平均置信度)，超时返回 None（不进缓存）。
+        confidence 为 False 时引擎可以不算置信度（返回 None）
+        """
+
+    def close(self):
+        pass
+
+
+class TesserocrEngine(OcrEngine):
+    def __init__(self):
+        self.api = tesserocr.PyTessBaseAPI(lang=OCR_LANG, psm=OCR_PSM)
+
+    def recognize(self, img: np.ndarray, timeout: float, confidence: bool = False) -> Optional[OcrResult]:
+        self.api.SetImage(Image.fromarray(img))
+        # Recognize 超时或失败时返回 False
+        if not self.api.Recognize(timeout=int(timeout * 1000)):
+            print(f"WARNING: OCR timed out after {timeout}s")
+            return None
+        # 识别结果已经在 api 里了，置信度顺手取
+        return self.api.GetUTF8Text(), float(self.api.MeanTextConf())
+
+    def close(self):
+        self.api.End()
+
+
+class PytesseractEngine(OcrEngine):
+    # 没有 tesserocr 时的退路：每张图片起一个 tesseract 进程
+    def recognize(self, img: np.ndarray, timeout: float, confidence: bool = False) -> Optional[OcrResult]:
+        try:
+            if not confidence:
+                return pytesseract.image_to_string(img, lang=OCR_LANG, config=f'--psm {OCR_PSM}', timeout=timeout), None
+            # 要置信度时用 image_to_data（同样只跑一次 tesseract），按行拼回文本
+            data = pytesseract.image_to_data(
+                img, lang=OCR_LANG, config=f'--psm {OCR_PSM}', timeout=timeout, output_type=pytesseract.Output.DICT
+            )
+        except RuntimeError as e:
+            # pytesseract 超时时杀掉 tesseract 进程并抛出 RuntimeError
+            print(f"WARNING: OCR timed out after {timeout}s: {e}")
+            return None
+        lines: Dict[Tuple[int, int, int], List[str]] = {}
+        confs = []
+        for word, conf, block, par, line in zip(data["text"], data["conf"], data["block_num"], data["par_num"], data["line_num"]):
+            # conf 为 -1 的是版面元素（块、段、行），不是单词
+            if float(conf) < 0 or not word.strip():
+                continue
+            lines.setdefault((block, par, line), []).append(word)
+            confs.append(float(conf))
+        text = "\n".join(" ".join(words) for words in lines.values())
+        return text, (sum(confs) / len(confs) if confs else 0.0)
+
+
+def create_engine() -> Optional[OcrEngine]:
+    if tesserocr is not None:
+        return TesserocrEngine()
+    if pytesseract is not None:
+        return PytesseractEngine()
+    return None
+
+
+# 编码后的图片（PNG / JPEG 等）或灰度像素数组
+OcrInput = Union[bytes, np.ndarray]
+
+
+class OcrPool:
+    """
+    常驻的 OCR worker 线程池：每个 worker 创建一次引擎（加载一次模型）后反复使用，
+    图片经有界队列分发，submit 在队列满时阻塞
+    """
+
+    def __init__(self, workers: int = OCR_WORKERS, queue_size: int = OCR_QUEUE_SIZE, timeout: float = OCR_TIMEOUT):
+        self.timeout = timeout
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"ocr-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, image: OcrInput, confidence: bool = False) -> Future:
+        future: Future = Future()
+        self._queue.put((image, confidence, future))
+        return future
+
+    def _worker(self):
+        engine = None
+        try:
+            engine = create_engine()
+        except Exception as e:
+            print(f"ERROR: Failed to start OCR engine: {e}")
+        while True:
+            image, confidence, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(_recognize(engine, image, self.timeout, confidence))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def _recognize(engine: Optional[OcrEngine], image: OcrInput, timeout: float, confidence: bool = False) -> Optional[OcrResult]:
+    # 失败或超时返回 None，和"图片里没有文字"（空字符串，可以缓存）区分开
+    if engine is None:
+        return None
     try:
         # 预处理
-        processed_img = preprocess_image(image_bytes)
-        
-        # Tesseract 识别
-        # lang='chi_sim+eng' 表示同时识别简体中文和英文
-        # psm 6 表示假设是一块统一的文本块
-        text = pytesseract.image_to_string(processed_img, lang='chi_sim+eng', config='--psm 6')
-        
-        return text.strip()
-    except pytesseract.TesseractNotFoundError:
-        print("ERROR: Tesseract binary not found. Please install tesseract-ocr (e.g., 'brew install tesseract').")
-        return ""
+        if isinstance(image, np.ndarray):
+            processed_img = preprocess_gray(image)
+        else:
+            processed_img = preprocess_image(image)
+        result = engine.recognize(processed_img, timeout, confidence)
+        if result is None:
+            return None
+        return result[0].strip(), result[1]
     except Exception as e:
-        print(f"ERROR: OCR failed: {e}")
-        return ""
+        if pytesseract is not None and isinstance(e, pytesseract.TesseractNotFoundError):
+            print("ERROR: Tesseract binary not found. Please install tesseract-ocr (e.g., 'brew install tesseract').")
+        else:
+            print(f"ERROR: OCR failed: {e}")
+        return None
+
+
+_pool: Optional[OcrPool] = None
+_pool_lock = threading.Lock()
+
+def get_ocr_pool() -> OcrPool:
+    # 第一次 OCR 时才启动 worker（PDF worker 进程里各自一个池）
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if tesserocr is None and pytesseract is not None:
+                print("WARNING: tesserocr not installed, falling back to pytesseract (one tesseract process per image; OCR workers only limit concurrency).")
+            _pool = OcrPool()
+        return _pool
+
+def ocr_cache_key(image: OcrInput) -> str:
+    if isinstance(image, np.ndarray):
+        # 原始像素：尺寸也进哈希，按行连续时不复制
+        h = hashlib.blake2b(memoryview(np.ascontiguousarray(image)), digest_size=16)
+        h.update(f"|raw{image.shape}".encode("utf-8"))
+    else:
+        h = hashlib.blake2b(image, digest_size=16)
+    h.update(f"|{OCR_LANG}|psm{OCR_PSM}|v{OCR_CACHE_VERSION}".encode("utf-8"))
+    return h.hexdigest()
+
+def _cache_get(keys: List[str]) -> Dict[str, OcrResult]:
+    if OCR_CACHE_MAX_MB <= 0:
+        return {}
+    try:
+        return get_ocr_cache_db(keys)
+    except sqlite3.Error as e:
+        # 缓存只是优化：数据库不可用（表还没建、锁超时）时照常识别
+        print(f"WARNING: OCR cache lookup failed: {e}")
+        return {}
+
+def _cache_put(entries: Dict[str, OcrResult]):
+    if OCR_CACHE_MAX_MB <= 0 or not entries:
+        return
+    try:
+        put_ocr_cache_db(entries, int(OCR_CACHE_MAX_MB * (1 << 20)))
+    except sqlite3.Error as e:
+        print(f"WARNING: OCR cache write failed: {e}")
+
+def _ocr_batch(images: List[OcrInput], confidence: bool = False) -> List[Optional[OcrResult]]:
+    """
+    先按内容哈希查缓存，同一批里重复的图片只识别一次，其余的交给 worker 并行识别；
+    按输入顺序返回结果，失败的是 None
+    """
+    keys = [ocr_cache_key(image) for image in images]
+    results = _cache_get(keys)
+    if confidence:
+        # 不带置信度的缓存结果不够用，重新识别
+        results = {k: r for k, r in results.items() if r[1] is not None}
+    if results:
+        print(f"DEBUG: OCR cache hit for {sum(k in results for k in keys)}/{len(keys)} images")
+    pool = get_ocr_pool()
+    futures = {}
+    for key, image in zip(keys, images):
+        if key not in results and key not in futures:
+            futures[key] = pool.submit(image, confidence)
+    fresh = {}
+    for key, future in futures.items():
+        result = future.result()
+        if result is not None:
+            fresh[key] = result
+    _cache_put(fresh)
+    results.update(fresh)
+    return [results.get(key) for key in keys]
+
+def _ocr_disabled() -> bool:
+    if tesserocr is None and pytesseract is None:
+        print("WARNING: pytesseract not installed. OCR disabled.")
+        return True
+    return False
+
+def ocr_images(images: List[bytes]) -> List[str]:
+    """
+    批量 OCR：一次提交一页的所有图片，由 worker 并行识别，按输入顺序返回文本
+    """
+    if not images:
+        return []
+    if _ocr_disabled():
+        return ["" for _ in images]
+    return [r[0] if r is not None else "" for r in _ocr_batch(images)]
+
+def ocr_image(image_bytes: bytes) -> str:
+    """
+    对图片字节流进行 OCR 识别 (使用 Tesseract)
+    """
+    return ocr_images([image_bytes])[0]
+
+def ocr_array(gray: np.ndarray) -> Tuple[str, Optional[float]]:
+    """
+    对灰度像素数组（比如直接包装 fitz Pixmap 的 samples，见 ingest._pixmap_gray）做 OCR，
+    返回 (文本, 平均置信度 0-100)；识别失败或 OCR 不可用时置信度为 None
+    """
+    if _ocr_disabled():
+        return "", None
+    result = _ocr_batch([gray], confidence=True)[0]
+    return result if result is not None else ("", None)
@@ -0,0 +1,138 @@
+import os
+from typing import Dict, Iterable, List, Tuple
+
+# 像素宽或高小于这个值的图片（图标、项目符号、分隔线）不 OCR
+OCR_MIN_IMAGE_PX = int(os.environ.get("OCR_MIN_IMAGE_PX", "32"))
+# 渲染到页面上的面积不到页面面积这个比例的图片不 OCR
+OCR_MIN_AREA_RATIO = float(os.environ.get("OCR_MIN_AREA_RATIO", "0.005"))
+# 图片区域被文字层的文本块覆盖了这么多（比如扫描件自带的隐藏文字层），说明文字已经有了，不 OCR
+OCR_TEXT_COVERAGE = float(os.environ.get("OCR_TEXT_COVERAGE", "0.6"))
+# 文字层已经有这么多字的页面，面积小于 OCR_TEXT_HEAVY_AREA_RATIO 的图片当作 logo / 插图，不 OCR
+OCR_TEXT_HEAVY_CHARS = int(os.environ.get("OCR_TEXT_HEAVY_CHARS", "500"))
+OCR_TEXT_HEAVY_AREA_RATIO = float(os.environ.get("OCR_TEXT_HEAVY_AREA_RATIO", "0.05"))
+# 每个文档的 OCR 时间预算（秒），用完后剩下的图片和整页 OCR 都跳过；<= 0 表示不限
+OCR_BUDGET_SECONDS = float(os.environ.get("OCR_BUDGET_SECONDS", "600"))
+# 还没实际 OCR 过任何图片时，估算省下的时间用的单张耗时（秒）
+OCR_ESTIMATED_SECONDS = float(os.environ.get("OCR_ESTIMATED_SECONDS", "1.0"))
+
+Rect = Tuple[float, float, float, float]
+
+
+def _area(r: Rect) -> float:
+    return max(0.0, r[2] - r[0]) * max(0.0, r[3] - r[1])
+
+
+def _intersection(a: Rect, b: Rect) -> float:
+    return _area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+
+
+class OcrPlanner:
+    """
+    决定一个文档里每张图片、每一页值不值得 OCR：看图片像素尺寸、在页面上渲染的面积
+    （page.get_image_rects）、和文字层文本块的重叠，以及文档的 OCR 时间预算。
+    按决定计数并记下实际 OCR 耗时，report() 的结果存进资料的 meta_data（ocr_plan），
+    能看出跳过了多少 OCR、大约省了多少时间；不保留逐条决定，免得大文档把 meta_data 撑大。
+    PDF 分段并行处理时每个 worker 进程一个 planner，预算按页数分摊，最后用 merge_reports 合并
+    """
+
+    def __init__(self, budget: float = OCR_BUDGET_SECONDS):
+        self.budget = budget
+        self.spent = 0.0
+        self.ocr_count = 0
+        self.counts: Dict[str, int] = {}
+
+    def _record(self, decision: str):
+        self.counts[decision] = self.counts.get(decision, 0) + 1
+
+    def budget_left(self) -> bool:
+        return self.budget <= 0 or self.spent < self.budget
+
+    def plan_images(self, page, images: List[Tuple], text_len: int, done: Iterable[int] = ()) -> List[int]:
+        """
+        images 是 page.get_images(full=True) 的结果，text_len 是文字层的字数，
+        done 是本文档里已经识别过的 xref（直接复用结果）。返回这一页要用 OCR 结果的 xref
+        """
+        done = set(done)
+        page_rect = page.rect
+        page_area = _area(tuple(page_rect)) or 1.0
+        text_blocks = None
+        selected: List[int] = []
+        for img in images:
+            xref, width, height = img[0], img[2], img[3]
+            if xref in selected:
+                continue
+            reason = None
+            if min(width, height) < OCR_MIN_IMAGE_PX:
+                reason = "too_small"
+            else:
+                rects = [tuple(r) for r in page.get_image_rects(xref)]
+                # 只算落在页面里的部分
+                rects = [(max(r[0], page_rect.x0), max(r[1], page_rect.y0), min(r[2], page_rect.x1), min(r[3], page_rect.y1)) for r in rects]
+                shown = sum(_area(r) for r in rects)
+                if shown <= 0:
+                    reason = "not_rendered"
+                elif shown / page_area < OCR_MIN_AREA_RATIO:
+                    reason = "tiny_on_page"
+                elif text_len >= OCR_TEXT_HEAVY_CHARS and shown / page_area < OCR_TEXT_HEAVY_AREA_RATIO:
+                    reason = "icon_on_text_page"
+                elif text_len:
+                    if text_blocks is None:
+                        # block_type 0 是文本块，1 是图片块
+                        text_blocks = [tuple(b[:4]) for b in page.get_text("blocks") if b[6] == 0]
+                    covered = sum(_intersection(r, b) for r in rects for b in text_blocks)
+                    if covered / shown >= OCR_TEXT_COVERAGE:
+                        reason = "covered_by_text"
+            if reason is None and xref not in done and not self.budget_left():
+                reason = "budget"
+            if reason is None:
+                decision = "reuse" if xref in done else "ocr"
+                selected.append(xref)
+            else:
+                decision = "skip:" + reason
+            self._record(decision)
+        return selected
+
+    def plan_full_page(self) -> bool:
+        """
+        文字层和图片 OCR 都没拿到多少字时的整页渲染 OCR，只受预算限制
+        """
+        ok = self.budget_left()
+        self._record("full_page:ocr" if ok else "full_page:skip:budget")
+        return ok
+
+    def charge(self, seconds: float, images: int = 1):
+        # 记下实际 OCR 的耗时（缓存命中的很快，按实际时间算）
+        self.spent += seconds
+        self.ocr_count += images
+
+    def report(self) -> Dict:
+        return {
+            "budget_seconds": self.budget,
+            "ocr_seconds": round(self.spent, 3),
+            "ocr_count": self.ocr_count,
+            "counts": dict(self.counts),
+        }
+
+
+def merge_reports(reports: List[Dict], budget: float = OCR_BUDGET_SECONDS) -> Dict:
+    """
+    合并各段页码的 report（按页码顺序传入），并估算跳过的 OCR 省下的时间：
+    跳过的数量 × 本文档实测的单次 OCR 平均耗时
+    """
+    counts: Dict[str, int] = {}
+    spent, ocr_count = 0.0, 0
+    for r in reports:
+        for k, v in r["counts"].items():
+            counts[k] = counts.get(k, 0) + v
+        spent += r["ocr_seconds"]
+        ocr_count += r["ocr_count"]
+    per_ocr = spent / ocr_count if ocr_count else OCR_ESTIMATED_SECONDS
+    skipped = sum(v for k, v in counts.items() if ":skip:" in k or k.startswith("skip:"))
+    return {
+        "budget_seconds": budget,
+        "ocr_seconds": round(spent, 3),
+        "ocr_count": ocr_count,
+        "skipped": skipped,
+        "estimated_seconds_saved": round(skipped * per_ocr, 3),
+        "counts": counts,
+    }
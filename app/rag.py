@@ -1,9 +1,16 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import os
 import requests
-from typing import Dict, List, Tuple
 import textwrap
-from .index import Index
+from .hybrid import HybridIndex
+from .cache import QueryCache
+from .utils import clean_text
+
+# 同一笔记本里重复的问题直接复用检索结果和生成的回答；key 带 index generation，资料变了自然失效
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "600"))
+RETRIEVAL_CACHE = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+ANSWER_CACHE = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
 
 
 def call_deepseek_api(messages: List[Dict], api_key: str) -> str:
@@ -35,11 +42,18 @@ def call_deepseek_api(messages: List[Dict], api_key: str) -> str:
 
 
 def synthesize_answer(query: str, hits: List[Tuple[Dict, float]]) -> Dict:
+    return _synthesize(query, hits)[0]
+
+
+def _synthesize(query: str, hits: List[Tuple[Dict, float]]) -> Tuple[Dict, bool]:
+    """
+    返回 (回答, 是否可以缓存)；LLM 调用失败降级的回答不缓存，下次再试
+    """
     if not hits:
         return {
             "answer": "未检索到相关内容。请先摄取资料或调整问题。",
             "citations": [],
-        }
+        }, True
     
     context_parts: List[str] = []
     citations: List[Dict] = []
@@ -58,6 +72,7 @@ def synthesize_answer(query: str, hits: List[Tuple[Dict, float]]) -> Dict:
             }
         )
     
+    cacheable = True
     api_key = os.environ.get("DEEPSEEK_API_KEY")
     if api_key:
         # 使用 LLM 生成
@@ -74,6 +89,7 @@ def synthesize_answer(query: str, hits: List[Tuple[Dict, float]]) -> Dict:
             answer = llm_answer
         else:
             # 降级处理
+            cacheable = False
             body_parts = [f"- {textwrap.shorten(c['text'], width=200, placeholder='…')}" for c, _ in hits]
             answer = "（LLM调用失败，降级为摘要）基于已摄取资料，检索到以下要点：\n" + "\n".join(body_parts)
     else:
@@ -81,9 +97,35 @@ def synthesize_answer(query: str, hits: List[Tuple[Dict, float]]) -> Dict:
         body_parts = [f"- {textwrap.shorten(c['text'], width=400, placeholder='…')}" for c, _ in hits]
         answer = "（未配置API Key，显示摘录）基于已摄取资料，检索到以下要点：\n" + "\n".join(body_parts)
 
-    return {"answer": answer, "citations": citations}
+    return {"answer": answer, "citations": citations}, cacheable
+
+
+def normalize_query(query: str) -> str:
+    return clean_text(query).lower()
+
+
+def answer_query(query: str, index: HybridIndex, top_k: int = 6, notebook_id: Optional[str] = None) -> Dict:
+    # 有无 API Key 生成的回答不同，也放进 key
+    key = (notebook_id, normalize_query(query), top_k, getattr(index, "generation", 0))
+    answer_key = key + (bool(os.environ.get("DEEPSEEK_API_KEY")),)
+    result = ANSWER_CACHE.get(answer_key)
+    if result is not None:
+        return result
+
+    hits = RETRIEVAL_CACHE.get(key)
+    if hits is None:
+        hits = index.search(query, top_k=top_k)
+        RETRIEVAL_CACHE.put(key, hits)
+    result, cacheable = _synthesize(query, hits)
+    if cacheable:
+        ANSWER_CACHE.put(answer_key, result)
+    return result
+
+
+def invalidate_query_cache(notebook_id: Optional[str] = None):
+    RETRIEVAL_CACHE.invalidate(notebook_id)
+    ANSWER_CACHE.invalidate(notebook_id)
 
 
-def answer_query(query: str, index: Index, top_k: int = 6) -> Dict:
-    hits = index.search(query, top_k=top_k)
-    return synthesize_answer(query, hits)
+def query_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {"retrieval": RETRIEVAL_CACHE.stats(), "answer": ANSWER_CACHE.stats()}
@@ -0,0 +1,557 @@
+import uuid
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from scipy import sparse
+
+# 权重：BM25 0.6 + Jaccard 0.25 + Trigram 0.15
+W_BM25 = 0.6
+W_JACCARD = 0.25
+W_TRIGRAM = 0.15
+
+# 与 rank_bm25.BM25Okapi 的默认参数保持一致
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+DTYPE = np.float32
+
+# 段数超过该值时合并成一段
+MAX_SEGMENTS = 8
+# 已删除文档占比超过该值时合并并丢弃已删除的列
+COMPACT_RATIO = 0.25
+
+# 一篇文档的特征：(去重 token key, 词频, 去重 trigram key)，见 utils.text_features
+Features = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def okapi_idf(df: np.ndarray, corpus_size: int) -> np.ndarray:
+    """
+    与 BM25Okapi._calc_idf 相同的 idf：负 idf 用 epsilon * 平均 idf 兜底
+    """
+    idf = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+    # 已经没有文档包含的 term 不参与平均（BM25Okapi 的词表里本来就没有它们）
+    present = df > 0
+    if present.any():
+        idf[(idf < 0) & present] = BM25_EPSILON * idf[present].mean()
+    return idf
+
+
+def _gather_rows(
+    indptr: np.ndarray, indices: np.ndarray, data: Optional[np.ndarray], rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    取出 CSR 的若干行（倒排表），代价只和这些行的长度有关；底层数组可以是 mmap 的
+    """
+    starts = indptr[rows].astype(np.int64)
+    ends = indptr[rows + 1].astype(np.int64)
+    sub_indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+    if len(rows) and sub_indptr[-1]:
+        pos = np.concatenate([np.arange(s, e) for s, e in zip(starts.tolist(), ends.tolist())])
+    else:
+        pos = np.empty(0, dtype=np.int64)
+    return sub_indptr, indices[pos], (data[pos] if data is not None else None)
+
+
+def _row_values(mat: sparse.csr_matrix, i: int, cols: np.ndarray) -> np.ndarray:
+    """
+    取稀疏矩阵第 i 行在 cols（升序，且包含该行所有非零列）上的取值
+    """
+    start, end = mat.indptr[i], mat.indptr[i + 1]
+    out = np.zeros(len(cols), dtype=np.float64)
+    out[np.searchsorted(cols, mat.indices[start:end])] = mat.data[start:end]
+    return out
+
+
+def top_k_indices(scores: np.ndarray, keys: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    按分数降序、key 升序取前 top_k 个位置。先用 partition 找到第 k 大的分数，
+    只对不低于它的元素排序，同分时的取舍与完整排序一致。
+    """
+    if len(scores) > top_k:
+        kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+        keep = np.nonzero(scores >= kth)[0]
+    else:
+        keep = np.arange(len(scores))
+    order = np.lexsort((keys[keep], -scores[keep]))
+    return keep[order[:top_k]]
+
+
+# Python 字典里一个 int -> int 条目的大致开销（两个 int 对象 + 哈希表槽位）
+DICT_ENTRY_BYTES = 100
+
+
+def array_bytes(arrays: Iterable[Optional[np.ndarray]]) -> Tuple[int, int]:
+    """
+    返回 (堆内存字节数, mmap 映射字节数)；映射的页可以被系统换出，分开统计
+    """
+    heap = mapped = 0
+    for arr in arrays:
+        if arr is None:
+            continue
+        if isinstance(arr, np.memmap):
+            mapped += arr.nbytes
+        else:
+            heap += arr.nbytes
+    return heap, mapped
+
+
+class _Vocab:
+    """
+    term key（64 位整数）-> 矩阵行号。冻结部分是按 key 排序的两个数组，可以直接 mmap；
+    新出现的 term 先放进字典，攒多了再合并进数组。行号只增不减。
+    """
+
+    def __init__(self, keys: Optional[np.ndarray] = None, rows: Optional[np.ndarray] = None, uid: Optional[str] = None):
+        self.keys = keys if keys is not None else np.empty(0, dtype=np.int64)
+        self.rows = rows if rows is not None else np.empty(0, dtype=np.int32)
+        self.extra: Dict[int, int] = {}
+        self.uid = uid or uuid.uuid4().hex[:12]
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.extra)
+
+    def lookup(self, keys: np.ndarray, add: bool = False) -> np.ndarray:
+        """
+        返回每个 key 的行号，不存在的为 -1；add=True 时为新 key 分配行号
+        """
+        out = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.keys) and len(keys):
+            pos = np.searchsorted(self.keys, keys)
+            pos[pos == len(self.keys)] = 0
+            hit = self.keys[pos] == keys
+            out[hit] = self.rows[pos[hit]]
+        for i in np.nonzero(out < 0)[0].tolist():
+            key = int(keys[i])
+            row = self.extra.get(key)
+            if row is None and add:
+                row = self.extra[key] = len(self)
+            if row is not None:
+                out[i] = row
+        return out
+
+    def memory_usage(self) -> Tuple[int, int]:
+        heap, mapped = array_bytes([self.keys, self.rows])
+        return heap + len(self.extra) * DICT_ENTRY_BYTES, mapped
+
+    def freeze(self):
+        if not self.extra:
+            return
+        keys = np.concatenate([self.keys, np.fromiter(self.extra.keys(), dtype=np.int64, count=len(self.extra))])
+        rows = np.concatenate([self.rows, np.fromiter(self.extra.values(), dtype=np.int32, count=len(self.extra))])
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.rows, self.extra = keys[order], rows[order], {}
+
+    def maybe_freeze(self):
+        # 字典里的 Python int 很占内存，超过冻结部分的 1/8 就合并一次
+        if len(self.extra) > max(4096, len(self.keys) // 8):
+            self.freeze()
+
+
+class _Segment:
+    """
+    一段不可变的文档列区间 [offset, offset + n_docs)：token 词频矩阵和 trigram 0/1 矩阵，
+    都是 行=term、列=文档 的 CSR，只保存 indptr / indices / data 三个数组（trigram 不需要 data）。
+    """
+
+    def __init__(
+        self,
+        tf_indptr: np.ndarray,
+        tf_indices: np.ndarray,
+        tf_data: np.ndarray,
+        tri_indptr: np.ndarray,
+        tri_indices: np.ndarray,
+        offset: int,
+        n_docs: int,
+        uid: Optional[str] = None,
+    ):
+        self.tf_indptr = tf_indptr
+        self.tf_indices = tf_indices
+        self.tf_data = tf_data
+        self.tri_indptr = tri_indptr
+        self.tri_indices = tri_indices
+        self.offset = offset
+        self.n_docs = n_docs
+        self.uid = uid or uuid.uuid4().hex[:12]
+
+    @classmethod
+    def from_matrices(cls, tf: sparse.csr_matrix, trigrams: sparse.csr_matrix, offset: int) -> "_Segment":
+        tf.sort_indices()
+        trigrams.sort_indices()
+        return cls(
+            tf.indptr.astype(np.int64), tf.indices.astype(np.int32), tf.data.astype(np.uint16),
+            trigrams.indptr.astype(np.int64), trigrams.indices.astype(np.int32),
+            offset, tf.shape[1],
+        )
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.tf_indptr) - 1
+
+    @property
+    def n_trigram_rows(self) -> int:
+        return len(self.tri_indptr) - 1
+
+    def tf_matrix(self, n_rows: Optional[int] = None) -> sparse.csr_matrix:
+        return _padded_csr(self.tf_indptr, self.tf_indices, self.tf_data, n_rows or self.n_rows, self.n_docs)
+
+    def trigram_matrix(self, n_rows: Optional[int] = None) -> sparse.csr_matrix:
+        data = np.ones(len(self.tri_indices), dtype=np.uint16)
+        return _padded_csr(self.tri_indptr, self.tri_indices, data, n_rows or self.n_trigram_rows, self.n_docs)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "tf_indptr": self.tf_indptr,
+            "tf_indices": self.tf_indices,
+            "tf_data": self.tf_data,
+            "tri_indptr": self.tri_indptr,
+            "tri_indices": self.tri_indices,
+        }
+
+
+def _padded_csr(indptr, indices, data, n_rows: int, n_cols: int) -> sparse.csr_matrix:
+    # 段编译之后词表又增长了：在末尾补空行
+    if n_rows > len(indptr) - 1:
+        indptr = np.concatenate([indptr, np.full(n_rows - len(indptr) + 1, indptr[-1], dtype=indptr.dtype)])
+    return sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_cols))
+
+
+class SparseScorer:
+    """
+    把语料编译成 term-document CSR 矩阵（分段存储），每一行就是一条倒排表：
+      - token 矩阵保存原始词频；BM25 的文档长度归一化 k1 * (1 - b + b * dl / avgdl)
+        按文档预先算好，检索时只对 query 命中的行换算成 BM25 权重，avgdl 变化不用重算矩阵
+      - 同一份行结构兼做 Jaccard 交集的 0/1 矩阵
+      - trigram 0/1 矩阵
+    query 矩阵与这些行做稀疏矩阵乘法，只会访问 query 命中的倒排表。
+
+    文档只追加不移动：add 编译一个新段，set_live / delete 只改掩码并就地更新
+    文档数、avgdl 和文档频率；compact 在删除过多时合并段并丢弃已删除的列。
+    所有数组都可以由 export / from_export 落盘和 mmap 加载。
+    """
+
+    def __init__(self, docs: Iterable[Features] = (), live: Optional[Sequence[bool]] = None):
+        self.vocab = _Vocab()
+        self.trigram_vocab = _Vocab()
+        self.segments: List[_Segment] = []
+        self.doc_len = np.empty(0, dtype=DTYPE)
+        # 去重后的 token / trigram 数（Jaccard 与 trigram 重叠的分母）
+        self.doc_uniq = np.empty(0, dtype=np.int32)
+        self.doc_uniq_trigrams = np.empty(0, dtype=np.int32)
+        # live: 参与检索和统计的文档（资料已启用且未删除）
+        self.live = np.empty(0, dtype=bool)
+        self.deleted = np.empty(0, dtype=bool)
+        # BM25 统计只算 live 文档，和只用启用资料重建索引的结果一致
+        self.df = np.empty(0, dtype=np.float64)
+        self.n_live = 0
+        self.total_len = 0.0
+        self._idf: Optional[np.ndarray] = None
+        self._norm: Optional[np.ndarray] = None
+        self._norm_avgdl: Optional[float] = None
+        self.add(docs, live)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_len)
+
+    @property
+    def avgdl(self) -> float:
+        return self.total_len / self.n_live if self.n_live else 0.0
+
+    @property
+    def idf(self) -> np.ndarray:
+        if self._idf is None:
+            self._idf = okapi_idf(self.df, self.n_live)
+        return self._idf
+
+    @property
+    def norm(self) -> np.ndarray:
+        # live 文档全是空文本时 avgdl 为 0，此时归一化只作用于不可检索的文档
+        avgdl = self.avgdl
+        if self._norm is None or self._norm_avgdl != avgdl or len(self._norm) != self.n_docs:
+            self._norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len / (avgdl or 1.0))
+            self._norm_avgdl = avgdl
+        return self._norm
+
+    def add(self, docs: Iterable[Features], live: Optional[Sequence[bool]] = None) -> int:
+        """
+        追加一批文档，编译成一个新段，返回这批文档的起始下标
+        """
+        offset = self.n_docs
+        docs = list(docs)
+        if not docs:
+            return offset
+
+        n = len(docs)
+        tok_lens = np.fromiter((len(d[0]) for d in docs), dtype=np.int64, count=n)
+        tri_lens = np.fromiter((len(d[2]) for d in docs), dtype=np.int64, count=n)
+        tok_keys = np.concatenate([d[0] for d in docs]).astype(np.int64)
+        tok_tf = np.concatenate([d[1] for d in docs]).astype(np.int64)
+        tri_keys = np.concatenate([d[2] for d in docs]).astype(np.int64)
+
+        # 先对整批 key 去重再查词表，新 term 分配新行号
+        uniq, inverse = np.unique(tok_keys, return_inverse=True)
+        tok_rows = self.vocab.lookup(uniq, add=True)[inverse]
+        uniq, inverse = np.unique(tri_keys, return_inverse=True)
+        tri_rows = self.trigram_vocab.lookup(uniq, add=True)[inverse]
+        self.vocab.maybe_freeze()
+        self.trigram_vocab.maybe_freeze()
+
+        tok_cols = np.repeat(np.arange(n), tok_lens)
+        tri_cols = np.repeat(np.arange(n), tri_lens)
+        tf = sparse.csr_matrix((tok_tf, (tok_rows, tok_cols)), shape=(len(self.vocab), n))
+        trigrams = sparse.csr_matrix(
+            (np.ones(len(tri_rows), dtype=np.uint16), (tri_rows, tri_cols)), shape=(len(self.trigram_vocab), n)
+        )
+        seg = _Segment.from_matrices(tf, trigrams, offset)
+        self.segments.append(seg)
+
+        doc_len = np.zeros(n, dtype=np.float64)
+        np.add.at(doc_len, tok_cols, tok_tf)
+        self.doc_len = np.concatenate([self.doc_len, doc_len.astype(DTYPE)])
+        self.doc_uniq = np.concatenate([self.doc_uniq, tok_lens.astype(np.int32)])
+        self.doc_uniq_trigrams = np.concatenate([self.doc_uniq_trigrams, tri_lens.astype(np.int32)])
+        live_mask = np.ones(n, dtype=bool) if live is None else np.asarray(live, dtype=bool)
+        self.live = np.concatenate([self.live, live_mask])
+        self.deleted = np.concatenate([self.deleted, np.zeros(n, dtype=bool)])
+        self.df = np.concatenate([self.df, np.zeros(len(self.vocab) - len(self.df))])
+        self._idf = None
+        self._update_stats(seg, np.nonzero(live_mask)[0], 1)
+
+        if len(self.segments) > MAX_SEGMENTS:
+            self._merge()
+        return offset
+
+    def _update_stats(self, seg: _Segment, local_docs: np.ndarray, sign: int):
+        if not len(local_docs):
+            return
+        # 取出这些文档的列，每行非零元个数就是它们对文档频率的贡献
+        sub = seg.tf_matrix()[:, local_docs]
+        self.df[: sub.shape[0]] += sign * np.diff(sub.indptr)
+        self.n_live += sign * len(local_docs)
+        self.total_len += sign * float(self.doc_len[seg.offset + local_docs].sum())
+        self._idf = None
+
+    def set_live(self, docs: Sequence[int], live: bool):
+        docs = np.asarray(docs, dtype=np.int64)
+        if not len(docs):
+            return
+        docs = np.unique(docs)
+        docs = docs[(self.live[docs] != live) & ~self.deleted[docs]]
+        if not len(docs):
+            return
+        self.live[docs] = live
+        for seg in self.segments:
+            in_seg = (docs >= seg.offset) & (docs < seg.offset + seg.n_docs)
+            self._update_stats(seg, docs[in_seg] - seg.offset, 1 if live else -1)
+
+    def delete(self, docs: Sequence[int]):
+        self.set_live(docs, False)
+        self.deleted[np.asarray(docs, dtype=np.int64)] = True
+
+    def compact(self) -> Optional[np.ndarray]:
+        """
+        已删除文档占比超过 COMPACT_RATIO 时合并所有段并丢弃已删除的列。
+        返回保留下来的旧文档下标（它在数组里的位置就是新下标），没有压缩时返回 None。
+        """
+        n_deleted = int(self.deleted.sum())
+        if not n_deleted or n_deleted < COMPACT_RATIO * self.n_docs:
+            return None
+        keep = np.nonzero(~self.deleted)[0]
+        self._merge(keep)
+        return keep
+
+    def _merge(self, keep: Optional[np.ndarray] = None):
+        tf = sparse.hstack([s.tf_matrix(len(self.vocab)) for s in self.segments], format="csr")
+        trigrams = sparse.hstack(
+            [s.trigram_matrix(len(self.trigram_vocab)) for s in self.segments], format="csr"
+        )
+        if keep is not None:
+            tf = tf[:, keep]
+            trigrams = trigrams[:, keep]
+            self.doc_len = self.doc_len[keep]
+            self.doc_uniq = self.doc_uniq[keep]
+            self.doc_uniq_trigrams = self.doc_uniq_trigrams[keep]
+            self.live = self.live[keep]
+            self.deleted = self.deleted[keep]
+        self.segments = [_Segment.from_matrices(tf, trigrams, 0)] if self.n_docs else []
+
+    def _query_matrices(
+        self, queries: List[Features]
+    ) -> Tuple[sparse.csr_matrix, sparse.csr_matrix, sparse.csr_matrix, np.ndarray, np.ndarray]:
+        idf = self.idf
+        bm_rows, bm_cols, bm_vals = [], [], []
+        tri_rows, tri_cols = [], []
+        for i, (keys, tf, tri_keys) in enumerate(queries):
+            rows = self.vocab.lookup(np.asarray(keys, dtype=np.int64))
+            found = rows >= 0
+            bm_rows.extend([i] * int(found.sum()))
+            bm_cols.extend(rows[found].tolist())
+            # 重复的 query token 重复计分（与 BM25Okapi 一致）
+            bm_vals.extend((idf[rows[found]] * np.asarray(tf)[found]).tolist())
+            rows = self.trigram_vocab.lookup(np.asarray(tri_keys, dtype=np.int64))
+            rows = rows[rows >= 0]
+            tri_rows.extend([i] * len(rows))
+            tri_cols.extend(rows.tolist())
+
+        m = len(queries)
+        shape = (m, len(self.vocab))
+        q_bm = sparse.csr_matrix((np.asarray(bm_vals, dtype=DTYPE), (bm_rows, bm_cols)), shape=shape)
+        q_bin = sparse.csr_matrix((np.ones(len(bm_rows), dtype=DTYPE), (bm_rows, bm_cols)), shape=shape)
+        q_tri = sparse.csr_matrix(
+            (np.ones(len(tri_rows), dtype=DTYPE), (tri_rows, tri_cols)), shape=(m, len(self.trigram_vocab))
+        )
+        q_uniq = np.asarray([len(q[0]) for q in queries])
+        q_uniq_trigrams = np.asarray([len(q[2]) for q in queries])
+        return q_bm, q_bin, q_tri, q_uniq, q_uniq_trigrams
+
+    def _segment_products(
+        self, seg: _Segment, q_bm: sparse.csr_matrix, q_bin: sparse.csr_matrix, q_tri: sparse.csr_matrix
+    ) -> Tuple[sparse.csr_matrix, sparse.csr_matrix, sparse.csr_matrix]:
+        """
+        只取出整批 query 命中的倒排表，就地换算 BM25 权重后各做一次稀疏矩阵乘法
+        """
+        rows = np.unique(q_bin.indices[q_bin.indices < seg.n_rows])
+        indptr, indices, tf = _gather_rows(seg.tf_indptr, seg.tf_indices, seg.tf_data, rows)
+        tf = tf.astype(DTYPE)
+        weights = tf * (BM25_K1 + 1) / (tf + self.norm[seg.offset + indices])
+        shape = (len(rows), seg.n_docs)
+        bm = q_bm[:, rows] @ sparse.csr_matrix((weights.astype(DTYPE), indices, indptr), shape=shape)
+        inter = q_bin[:, rows] @ sparse.csr_matrix((np.ones(len(indices), dtype=DTYPE), indices, indptr), shape=shape)
+
+        rows = np.unique(q_tri.indices[q_tri.indices < seg.n_trigram_rows])
+        indptr, indices, _ = _gather_rows(seg.tri_indptr, seg.tri_indices, None, rows)
+        tri = q_tri[:, rows] @ sparse.csr_matrix(
+            (np.ones(len(indices), dtype=DTYPE), indices, indptr), shape=(len(rows), seg.n_docs)
+        )
+        products = (bm.tocsr(), inter.tocsr(), tri.tocsr())
+        for mat in products:
+            mat.sort_indices()
+        return products
+
+    def search_many(self, queries: List[Features], top_k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        整批 query 在每个段上各做一次稀疏矩阵乘法。
+        返回每个 query 的 (文档下标, 分数)，只包含至少共享一个 token 或 trigram 的 live 文档。
+        """
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        if not queries:
+            return []
+        if not self.n_live or top_k <= 0:
+            return [empty for _ in queries]
+
+        q_bm, q_bin, q_tri, q_uniq, q_uniq_trigrams = self._query_matrices(queries)
+        products = [(seg.offset,) + self._segment_products(seg, q_bm, q_bin, q_tri) for seg in self.segments]
+
+        results = []
+        for i in range(len(queries)):
+            parts = []
+            for offset, bm, inter, tri in products:
+                local = np.union1d(
+                    inter.indices[inter.indptr[i] : inter.indptr[i + 1]],
+                    tri.indices[tri.indptr[i] : tri.indptr[i + 1]],
+                )
+                if len(local):
+                    parts.append((
+                        local.astype(np.int64) + offset,
+                        _row_values(bm, i, local),
+                        _row_values(inter, i, local),
+                        _row_values(tri, i, local),
+                    ))
+            if not parts:
+                results.append(empty)
+                continue
+            docs, bm_raw, n_inter, n_tri = (np.concatenate(p) for p in zip(*parts))
+            live = self.live[docs]
+            docs, bm_raw, n_inter, n_tri = docs[live], bm_raw[live], n_inter[live], n_tri[live]
+            if not len(docs):
+                results.append(empty)
+                continue
+
+            # Min-Max 归一化：没有 token 命中的 chunk BM25 原始分为 0
+            bounds = bm_raw if len(docs) == self.n_live else np.append(bm_raw, 0.0)
+            mn, mx = float(bounds.min()), float(bounds.max())
+            bm_norm = np.ones(len(docs)) if mx == mn else (bm_raw - mn) / (mx - mn)
+
+            # 只有 trigram 命中的文档交集为 0，分母兜底为 1 避免 0/0
+            jac = n_inter / np.maximum(q_uniq[i] + self.doc_uniq[docs] - n_inter, 1)
+
+            scores = W_BM25 * bm_norm + W_JACCARD * jac
+            if q_uniq_trigrams[i]:
+                scores += W_TRIGRAM * n_tri / np.maximum(q_uniq_trigrams[i], self.doc_uniq_trigrams[docs])
+
+            keep = top_k_indices(scores, docs, top_k)
+            results.append((docs[keep], scores[keep]))
+        return results
+
+    def memory_usage(self) -> Tuple[int, int]:
+        """
+        估算 (堆内存字节数, mmap 映射字节数)
+        """
+        arrays = [self.doc_len, self.doc_uniq, self.doc_uniq_trigrams, self.live, self.deleted, self.df, self._idf, self._norm]
+        for seg in self.segments:
+            arrays.extend(seg.arrays().values())
+        heap, mapped = array_bytes(arrays)
+        for vocab in (self.vocab, self.trigram_vocab):
+            h, m = vocab.memory_usage()
+            heap, mapped = heap + h, mapped + m
+        return heap, mapped
+
+    # --- 快照 ---
+
+    def export(self) -> Tuple[Dict, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """
+        返回 (元数据, 不可变数组, 可变数组)。不可变数组的名字里带段 / 词表的 uid 和大小，
+        同名文件内容一定相同，保存快照时已存在的可以跳过。
+        """
+        self.vocab.freeze()
+        self.trigram_vocab.freeze()
+        frozen: Dict[str, np.ndarray] = {}
+        vocab_names = []
+        for prefix, vocab in (("vocab", self.vocab), ("trigram_vocab", self.trigram_vocab)):
+            name = f"{prefix}-{vocab.uid}-{len(vocab)}"
+            frozen[f"{name}.keys"] = vocab.keys
+            frozen[f"{name}.rows"] = vocab.rows
+            vocab_names.append(name)
+        segments = []
+        for seg in self.segments:
+            for key, arr in seg.arrays().items():
+                frozen[f"seg-{seg.uid}.{key}"] = arr
+            segments.append({"uid": seg.uid, "offset": seg.offset, "n_docs": seg.n_docs})
+        meta = {
+            "vocab": vocab_names[0],
+            "trigram_vocab": vocab_names[1],
+            "segments": segments,
+            "n_live": self.n_live,
+            "total_len": self.total_len,
+        }
+        mutable = {
+            "doc_len": self.doc_len,
+            "doc_uniq": self.doc_uniq,
+            "doc_uniq_trigrams": self.doc_uniq_trigrams,
+            "live": self.live,
+            "deleted": self.deleted,
+            "df": self.df,
+        }
+        return meta, frozen, mutable
+
+    @classmethod
+    def from_export(cls, meta: Dict, frozen: Dict[str, np.ndarray], mutable: Dict[str, np.ndarray]) -> "SparseScorer":
+        scorer = cls()
+        for attr in ("vocab", "trigram_vocab"):
+            name = meta[attr]
+            uid = name.split("-")[1]
+            setattr(scorer, attr, _Vocab(frozen[f"{name}.keys"], frozen[f"{name}.rows"], uid=uid))
+        scorer.segments = [
+            _Segment(
+                offset=s["offset"],
+                n_docs=s["n_docs"],
+                uid=s["uid"],
+                **{k: frozen[f"seg-{s['uid']}.{k}"] for k in ("tf_indptr", "tf_indices", "tf_data", "tri_indptr", "tri_indices")}
+            )
+            for s in meta["segments"]
+        ]
+        for key, arr in mutable.items():
+            setattr(scorer, key, arr)
+        scorer.n_live = meta["n_live"]
+        scorer.total_len = meta["total_len"]
+        return scorer
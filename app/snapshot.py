@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+try:
+    import fcntl
+except ImportError:  # Windows: 单进程部署，不需要跨进程锁
+    fcntl = None
+import numpy as np
+from .db import DATA_DIR
+from .hybrid import HybridIndex
+from .utils import TOKENIZER_VERSION
+
+# data/index/{notebook_id}/manifest.json + 若干 .npy
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "index")
+MANIFEST = "manifest.json"
+LOCK_FILE = "snapshot.lock"
+# 快照文件布局有变化时加一
+FORMAT_VERSION = 2
+
+
+def snapshot_path(notebook_id: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, notebook_id)
+
+
+@contextmanager
+def _snapshot_lock(path: str):
+    # 多个 worker 进程可能同时保存同一个笔记本的快照，写文件和清理旧文件要互斥
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(path, LOCK_FILE), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def snapshot_generation(notebook_id: str) -> Optional[int]:
+    manifest = _read_manifest(snapshot_path(notebook_id))
+    return manifest["meta"].get("generation") if manifest else None
+
+
+def save_snapshot(notebook_id: str, index: HybridIndex) -> bool:
+    """
+    把编译好的索引写到 data/index/{notebook_id}/。
+    段和词表是不可变的，文件已存在就跳过，所以增量更新之后再保存只需要写新段和按文档的小数组。
+    manifest 最后原子替换，读到的总是一份完整的快照。
+    别的进程已经保存了更新的 generation 时不覆盖，返回 False。
+    """
+    path = snapshot_path(notebook_id)
+    os.makedirs(path, exist_ok=True)
+    with _snapshot_lock(path):
+        current = _read_manifest(path)
+        if current and current.get("tokenizer_version") == TOKENIZER_VERSION and current["meta"].get("generation", -1) > index.generation:
+            return False
+        _save(path, index)
+    return True
+
+
+def _save(path: str, index: HybridIndex):
+    meta, frozen, mutable = index.export()
+
+    files = {}
+    for name, arr in frozen.items():
+        fname = f"{name}.npy"
+        if not os.path.exists(os.path.join(path, fname)):
+            _write_array(path, fname, arr)
+        files[name] = fname
+    stamp = uuid.uuid4().hex[:12]
+    for name, arr in mutable.items():
+        fname = f"{name}.{stamp}.npy"
+        _write_array(path, fname, arr)
+        files[name] = fname
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "tokenizer_version": TOKENIZER_VERSION,
+        "meta": meta,
+        "frozen": sorted(frozen),
+        "files": files,
+    }
+    tmp = os.path.join(path, f"{MANIFEST}.{stamp}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+    # 清理不再被引用的旧文件（已经 mmap 它们的进程不受影响）
+    keep = set(files.values()) | {MANIFEST, LOCK_FILE}
+    for fname in os.listdir(path):
+        if fname not in keep and not fname.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(path, fname))
+            except OSError:
+                pass
+
+
+def _write_array(path: str, fname: str, arr: np.ndarray):
+    tmp = os.path.join(path, f"{fname}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(arr))
+    os.replace(tmp, os.path.join(path, fname))
+
+
+def load_snapshot(notebook_id: str, generation: int) -> Optional[HybridIndex]:
+    """
+    快照的分词器版本和 generation 都对得上时 mmap 加载，否则返回 None（调用方重建）。
+    所有 worker 进程映射同一批文件，共享页缓存；会被原地修改的掩码 / 文档频率数组
+    用写时复制映射（mmap_mode="c"），改动只在本进程可见，没改的页仍然共享。
+    """
+    path = snapshot_path(notebook_id)
+    manifest = _read_manifest(path)
+    if (
+        manifest is None
+        or manifest.get("format") != FORMAT_VERSION
+        or manifest.get("tokenizer_version") != TOKENIZER_VERSION
+        or manifest["meta"].get("generation") != generation
+    ):
+        return None
+
+    frozen_names = set(manifest["frozen"])
+    frozen, mutable = {}, {}
+    try:
+        for name, fname in manifest["files"].items():
+            mode = "c" if name in ("live", "deleted", "df") else "r"
+            arr = np.load(os.path.join(path, fname), mmap_mode=mode)
+            if name in frozen_names:
+                frozen[name] = arr
+            else:
+                mutable[name] = arr
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Failed to load index snapshot for {notebook_id}: {e}")
+        return None
+    return HybridIndex.from_export(manifest["meta"], frozen, mutable)
+
+
+def delete_snapshot(notebook_id: str):
+    shutil.rmtree(snapshot_path(notebook_id), ignore_errors=True)
@@ -1,6 +1,9 @@
+import hashlib
 import re
-from typing import List, Tuple
+from collections import Counter
+from typing import Iterable, Iterator, List, Optional, Tuple
 import jieba
+import numpy as np
 
 
 def clean_text(text: str) -> str:
@@ -34,6 +37,44 @@ def chunk_text(text: str, max_chars: int = 800, overlap: int = 120) -> List[str]
     return chunks
 
 
+def iter_clean_text(pieces: Iterable[str]) -> Iterator[str]:
+    # 分块读入的文本逐块 clean_text，结果拼起来和整段 clean_text 一样（跨块的空白也合并）
+    started, pending = False, False
+    for piece in pieces:
+        out = []
+        for j, part in enumerate(re.split(r"\s+", piece)):
+            if j > 0:
+                pending = True
+            if part:
+                if pending and started:
+                    out.append(" ")
+                out.append(part)
+                started, pending = True, False
+        if out:
+            yield "".join(out)
+
+
+def iter_text_windows(pieces: Iterable[str], max_chars: int = 800, overlap: int = 120) -> Iterator[str]:
+    # 对 iter_clean_text 的输出（没有空行，只有一段）分块，结果和 chunk_text 一样，不把全文放进内存
+    step = max_chars - overlap if max_chars > overlap else max_chars
+    buf, pos, emitted = "", 0, False
+    for piece in pieces:
+        buf = buf[pos:] + piece
+        pos = 0
+        # 已经读到超过 max_chars 个字，说明不止一块，pos 处的窗口已经确定
+        while len(buf) - pos > max_chars:
+            yield buf[pos:pos + max_chars]
+            pos += step
+            emitted = True
+    if not emitted:
+        if buf:
+            yield buf
+        return
+    while pos < len(buf):
+        yield buf[pos:pos + max_chars]
+        pos += step
+
+
 def _ngrams(tokens: List[str], n: int = 2) -> List[str]:
     if n <= 1:
         return tokens
@@ -58,3 +99,72 @@ def char_trigrams(text: str) -> List[str]:
     for i in range(len(t) - 2):
         grams.append(t[i : i + 3].lower())
     return grams
+
+
+# 分词或 trigram 规则有变化时加一，已保存的索引快照随之失效
+TOKENIZER_VERSION = 1
+
+
+def term_key(term: str) -> int:
+    # 跨进程稳定的 64 位 key（内置 hash() 每个进程的种子不同）
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def trigram_key(gram: str) -> int:
+    # 3 个 Unicode 码位各占 21 位，直接拼成一个 63 位整数，不会冲突
+    return (ord(gram[0]) << 42) | (ord(gram[1]) << 21) | ord(gram[2])
+
+
+def text_features(text: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    检索用的文本特征：(去重 token key, 对应词频, 去重 trigram key)
+    """
+    counts = Counter(tokenize(text))
+    keys = np.fromiter((term_key(t) for t in counts), dtype=np.int64, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.int32, count=len(counts))
+    trigrams = set(char_trigrams(text))
+    tri_keys = np.fromiter((trigram_key(g) for g in trigrams), dtype=np.int64, count=len(trigrams))
+    return keys, tf, tri_keys
+
+
+def chunk_hash(text: str) -> str:
+    # 重新摄取时按内容比对 chunk：正文没变的 chunk 原样保留（位置变了只改 location）
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+
+
+# 存库格式: int32[2] 头 (token 数, trigram 数) + int64 token key + int64 trigram key + int32 词频，
+# 按这个顺序排列每段都是对齐的，读的时候可以直接 frombuffer
+def pack_features(features: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> bytes:
+    keys, tf, tri_keys = features
+    header = np.array([len(keys), len(tri_keys)], dtype="<i4")
+    return b"".join([
+        header.tobytes(),
+        np.asarray(keys, dtype="<i8").tobytes(),
+        np.asarray(tri_keys, dtype="<i8").tobytes(),
+        np.asarray(tf, dtype="<i4").tobytes(),
+    ])
+
+
+def unpack_features(blob: Optional[bytes]) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    if not blob:
+        return None
+    n, m = (int(x) for x in np.frombuffer(blob, dtype="<i4", count=2))
+    keys = np.frombuffer(blob, dtype="<i8", count=n, offset=8)
+    tri_keys = np.frombuffer(blob, dtype="<i8", count=m, offset=8 + 8 * n)
+    tf = np.frombuffer(blob, dtype="<i4", count=n, offset=8 + 8 * (n + m))
+    return keys, tf, tri_keys
+
+
+# FTS5 检索后端：每个 term 写成它的 64 位 key 的十六进制（纯字母数字，FTS5 的 unicode61 分词器不会再切开），
+# 按词频重复，bm25() 看到的词频和文档长度与 tokenize 的结果一致
+def fts_token(key: int) -> str:
+    return "t" + format(int(key) & 0xFFFFFFFFFFFFFFFF, "x")
+
+
+def fts_document(keys: np.ndarray, tf: np.ndarray) -> str:
+    return " ".join(" ".join([fts_token(k)] * int(n)) for k, n in zip(keys.tolist(), tf.tolist()))
+
+
+def fts_match(keys: np.ndarray) -> str:
+    # 任一 term 命中即为候选，和 HybridIndex 的候选集一致（trigram 候选除外）
+    return " OR ".join(fts_token(k) for k in keys.tolist())
@@ -0,0 +1,113 @@
+"""
+EXPLAIN QUERY PLAN regression check for the hot chunk / source queries.
+
+Runs the real db functions against a throwaway database, captures the SQL
+they execute and fails (exit code 1) if any plan does a full table scan of
+chunks or sources. Also checks the lookups SQLite performs internally for
+ON DELETE CASCADE, which EXPLAIN on the DELETE itself does not show.
+
+Usage: python scripts/check_query_plans.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import db
+
+# Child-table lookups done by ON DELETE CASCADE
+CASCADE_QUERIES = [
+    ("cascade sources -> chunks", "SELECT 1 FROM chunks WHERE notebook_id = 'nb' AND source_id = 'src'"),
+    ("cascade notebooks -> chunks", "SELECT 1 FROM chunks WHERE notebook_id = 'nb'"),
+    ("cascade notebooks -> sources", "SELECT 1 FROM sources WHERE notebook_id = 'nb'"),
+]
+
+
+def _capture(conn, fn, *args):
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args)
+    finally:
+        conn.set_trace_callback(None)
+    # Dedupe keeping order (cascading deletes report the same statement twice)
+    return list(dict.fromkeys(s for s in statements if s.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE"))))
+
+
+def _table_scans(conn, sql: str):
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    # detail looks like "SCAN c" / "SCAN chunks" / "SEARCH c USING INDEX ..."; FTS5 lookups
+    # show up as "SCAN f VIRTUAL TABLE INDEX ..." and use the FTS index. "SCAN (subquery-N)"
+    # reads a derived table whose own access to the base table is listed separately
+    return [
+        row[3] for row in plan
+        if row[3].startswith("SCAN ") and "USING" not in row[3] and "CONSTANT ROW" not in row[3]
+        and "VIRTUAL TABLE" not in row[3] and not row[3].startswith("SCAN (subquery")
+    ]
+
+
+def check() -> bool:
+    tmp = tempfile.mkdtemp(prefix="query-plans-")
+    db.DATA_DIR = tmp
+    db.DB_PATH = os.path.join(tmp, "notebooklm.db")
+    db.init_db()
+    conn = db.get_db_connection()
+
+    # Some rows so that ANALYZE-free plans still look realistic
+    db.create_notebook_db("nb", "plans", time.time())
+    db.create_source_db("src", "nb", "text", "src", time.time(), {})
+    db.create_chunks_batch_db([
+        {"id": f"src#{i}", "source_id": "src", "notebook_id": "nb", "text": f"chunk {i}", "created_at": time.time()}
+        for i in range(50)
+    ])
+
+    queries = []
+    for name, fn, args in [
+        ("list_sources_db", db.list_sources_db, ("nb",)),
+        ("count_chunks_by_source", db.count_chunks_by_source, ("nb", "src")),
+        ("count_chunk_rows_db", db.count_chunk_rows_db, ("nb", "src")),
+        ("load_chunks_db", db.load_chunks_db, ("nb",)),
+        ("iter_index_rows_db", lambda nb: list(db.iter_index_rows_db(nb)), ("nb",)),
+        ("get_chunks_by_rowids_db", db.get_chunks_by_rowids_db, ([1, 2],)),
+        ("get_generation_db", db.get_generation_db, ("nb",)),
+        ("set_search_backend_db", db.set_search_backend_db, ("nb", "fts")),
+        ("fts_search_db", db.fts_search_db, ("nb", "chunk", 8)),
+        ("get_chunk_features_by_rowids_db", db.get_chunk_features_by_rowids_db, ([1, 2],)),
+        ("update_source_status_db", db.update_source_status_db, ("nb", "src", True)),
+        ("create_chunks_batch_db", db.create_chunks_batch_db, ([{"id": "src#0", "source_id": "src", "notebook_id": "nb", "text": "x"}],)),
+        ("bulk_ingest_db", db.bulk_ingest_db, ("nb", [{"id": "src"}], [{"id": "src#1", "source_id": "src", "notebook_id": "nb", "text": "x"}], False)),
+        ("list_chunk_hashes_db", db.list_chunk_hashes_db, ("nb", ["src"])),
+        ("find_source_by_url_db", db.find_source_by_url_db, ("nb", "https://example.com")),
+        ("bulk_ingest_db (diff)", db.bulk_ingest_db, ("nb", [], [], False, ["src#3"], [("src#4", "page 2")])),
+        ("bulk_ingest_db (bulk load)", db.bulk_ingest_db, ("nb", [{"id": "src"}], [{"id": "src#2", "source_id": "src", "notebook_id": "nb", "text": "x"}], True)),
+        ("put_ocr_cache_db", db.put_ocr_cache_db, ({"k1": ("text", 91.5), "k2": ("", None)}, 1 << 20)),
+        ("get_ocr_cache_db", db.get_ocr_cache_db, (["k1", "k3"],)),
+        ("create_ingest_job_db", db.create_ingest_job_db, ("job1", "nb", {"file_paths": []})),
+        ("create_ingest_job_db", db.create_ingest_job_db, ("job2", "nb", {"file_paths": []})),
+        ("claim_ingest_job_db", db.claim_ingest_job_db, ("owner", 1, 60.0, 3)),
+        ("update_ingest_job_progress_db", db.update_ingest_job_progress_db, ("job1", "owner", {"phase": "parsing"})),
+        ("heartbeat_ingest_jobs_db", db.heartbeat_ingest_jobs_db, ("owner", ["job1"])),
+        ("cancel_ingest_job_db", db.cancel_ingest_job_db, ("job2",)),
+        ("finish_ingest_job_db", db.finish_ingest_job_db, ("job1", "owner", "done", {"added": 0})),
+        ("delete_source_db", db.delete_source_db, ("nb", "src")),
+    ]:
+        queries.extend((name, sql) for sql in _capture(conn, fn, *args))
+    queries.extend(CASCADE_QUERIES)
+
+    ok = True
+    for name, sql in queries:
+        scans = _table_scans(conn, sql)
+        status = "FAIL" if scans else "ok"
+        print(f"[{status}] {name}: {' '.join(sql.split())[:100]}")
+        for detail in scans:
+            print(f"       full scan: {detail}")
+        ok = ok and not scans
+    db.close_db_connection()
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check() else 1)
@@ -2,112 +2,232 @@ import os
 import json
 import sys
 import time
+import codecs
+import argparse
+from typing import Dict, Iterator, Tuple
 
 # Add parent directory to path to import app modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.db import init_db, create_notebook_db, create_source_db, create_chunks_batch_db
+from app.db import init_db, create_notebook_db, create_source_db, create_chunks_batch_db, refresh_source_stats_db, transaction
 # from app.notebooks import NotebookManager # Don't use this as it now points to DB
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 NOTEBOOKS_META_PATH = os.path.join(DATA_DIR, "notebooks.json")
 NOTEBOOKS_DIR = os.path.join(DATA_DIR, "notebooks")
+# Progress of an interrupted migration: notebook_id -> {offset, chunks, done}
+CHECKPOINT_PATH = os.path.join(DATA_DIR, "migration_checkpoint.json")
 
-def migrate():
+BATCH_SIZE = 2000
+READ_BLOCK_SIZE = 1 << 20
+
+
+def iter_json_array(path: str, start: int = 0, block_size: int = READ_BLOCK_SIZE) -> Iterator[Tuple[Dict, int]]:
+    """
+    Streams the items of a top-level JSON array without loading the file,
+    yielding (item, byte offset just past the item). Passing such an offset
+    as start resumes right after that item.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        f.seek(start)
+        # buf[:mark] has been yielded already; offset is the byte offset of buf[mark]
+        buf, pos, mark = "", 0, 0
+        offset = start
+        eof = False
+        state = "open" if start == 0 else "next"
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            ch = buf[pos] if pos < len(buf) else ""
+            item = None
+            if not ch:
+                pass
+            elif state == "open":
+                if ch != "[":
+                    raise ValueError(f"{path} does not contain a JSON array")
+                pos += 1
+                state = "first"
+                continue
+            elif state == "next":
+                if ch == "]":
+                    return
+                if ch != ",":
+                    raise ValueError(f"Expected ',' or ']' in {path} near byte {offset}")
+                pos += 1
+                state = "item"
+                continue
+            elif ch == "]" and state == "first":
+                return
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            if item is None:
+                # Buffer exhausted or the item continues past it: drop the
+                # consumed text and read another block
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {path}")
+                buf, pos, mark = buf[mark:], pos - mark, 0
+                block = f.read(block_size)
+                eof = not block
+                buf += utf8.decode(block, final=eof)
+                continue
+            offset += len(buf[mark:end].encode("utf-8"))
+            pos = mark = end
+            state = "next"
+            yield item, offset
+
+
+def load_checkpoint() -> Dict[str, Dict]:
+    if not os.path.exists(CHECKPOINT_PATH):
+        return {}
+    with open(CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint: Dict[str, Dict]):
+    # Write-then-rename so an interruption never leaves a torn checkpoint
+    tmp = CHECKPOINT_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, CHECKPOINT_PATH)
+
+
+def _write_batch(notebook_id: str, sources: Dict[str, Dict], batch):
+    # Sources and chunks of a batch are committed together; chunk writes are
+    # upserts, so a batch replayed after a crash overwrites itself
+    with transaction():
+        for s in sources.values():
+            create_source_db(
+                s['id'],
+                s['notebook_id'],
+                s['source_type'],
+                s['file_name'],
+                s['created_at'],
+                s['meta_data']
+            )
+        create_chunks_batch_db(batch, refresh_stats=False)
+
+
+def migrate_notebook_chunks(nb: Dict, chunks_path: str, checkpoint: Dict[str, Dict], batch_size: int = BATCH_SIZE):
+    state = checkpoint.setdefault(nb['id'], {"offset": 0, "chunks": 0, "done": False})
+    total_bytes = os.path.getsize(chunks_path)
+    if state["offset"]:
+        print(f"  Resuming after {state['chunks']} chunks ({state['offset']}/{total_bytes} bytes)")
+
+    # Sources are inferred from the first chunk seen for each; ones created
+    # before a resume are kept (INSERT OR IGNORE)
+    seen_sources = set()
+    new_sources: Dict[str, Dict] = {}
+    batch = []
+    started, done_before = time.time(), state["chunks"]
+    offset = state["offset"]
+
+    def flush():
+        _write_batch(nb['id'], new_sources, batch)
+        state["offset"], state["chunks"] = offset, state["chunks"] + len(batch)
+        save_checkpoint(checkpoint)
+        new_sources.clear()
+        batch.clear()
+        rate = (state["chunks"] - done_before) / max(time.time() - started, 1e-6)
+        print(f"  {state['chunks']} chunks, {100.0 * offset / max(total_bytes, 1):.1f}% of {chunks_path} ({rate:.0f} chunks/s)")
+
+    for chunk, offset in iter_json_array(chunks_path, start=state["offset"]):
+        sid = chunk.get('source_id')
+        if not sid:
+            continue
+
+        if sid not in seen_sources:
+            seen_sources.add(sid)
+            # Infer source info from the first chunk we see
+            new_sources[sid] = {
+                'id': sid,
+                'notebook_id': nb['id'],
+                'source_type': chunk.get('source_type', 'unknown'),
+                'file_name': sid, # Use source_id as filename for now
+                'created_at': time.time(),
+                'meta_data': {
+                    'url': chunk.get('url'),
+                    'path': chunk.get('path')
+                }
+            }
+
+        # Prepare chunk for DB
+        # Ensure notebook_id is present
+        chunk['notebook_id'] = nb['id']
+        # Ensure created_at
+        if 'created_at' not in chunk:
+            chunk['created_at'] = time.time()
+
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            flush()
+    if batch or new_sources:
+        flush()
+
+    # Per-source stats were skipped per batch, compute them once
+    refresh_source_stats_db(nb['id'])
+    state["done"] = True
+    save_checkpoint(checkpoint)
+    print(f"  Migrated {state['chunks']} chunks.")
+
+
+def migrate(batch_size: int = BATCH_SIZE, restart: bool = False):
     print("Starting migration to SQLite...")
-    
+
     # 1. Init DB
     init_db()
     print("Database initialized.")
-    
+
     # 2. Read notebooks from JSON
     if not os.path.exists(NOTEBOOKS_META_PATH):
         print("No notebooks.json found. Nothing to migrate.")
         return
-        
+
     with open(NOTEBOOKS_META_PATH, "r", encoding="utf-8") as f:
         try:
             notebooks = json.load(f)
         except:
             notebooks = []
-            
+
     print(f"Found {len(notebooks)} notebooks in JSON.")
-    
+
+    checkpoint = {} if restart else load_checkpoint()
+
     for nb in notebooks:
+        if checkpoint.get(nb['id'], {}).get("done"):
+            print(f"Skipping notebook {nb['title']} ({nb['id']}): already migrated")
+            continue
         print(f"Migrating notebook: {nb['title']} ({nb['id']})")
-        
+
         # Insert Notebook
         # Check if exists first to avoid duplicate if re-running
         try:
             create_notebook_db(nb['id'], nb['title'], nb.get('created_at', time.time()))
         except Exception as e:
             print(f"  Note: Notebook might already exist: {e}")
-        
+
         # Read chunks
         chunks_path = os.path.join(NOTEBOOKS_DIR, nb['id'], "chunks.json")
         if not os.path.exists(chunks_path):
             print(f"  No chunks file found for {nb['title']}")
             continue
-            
-        with open(chunks_path, 'r', encoding='utf-8') as f:
-            try:
-                chunks = json.load(f)
-            except:
-                chunks = []
-                
-        print(f"  Found {len(chunks)} chunks.")
-        
-        # Identify Sources
-        # Map source_id -> source_info
-        sources = {}
-        chunks_to_insert = []
-        
-        for chunk in chunks:
-            sid = chunk.get('source_id')
-            if not sid:
-                continue
-                
-            if sid not in sources:
-                # Infer source info from the first chunk we see
-                sources[sid] = {
-                    'id': sid,
-                    'notebook_id': nb['id'],
-                    'source_type': chunk.get('source_type', 'unknown'),
-                    'file_name': sid, # Use source_id as filename for now
-                    'created_at': time.time(),
-                    'meta_data': {
-                        'url': chunk.get('url'),
-                        'path': chunk.get('path')
-                    }
-                }
-            
-            # Prepare chunk for DB
-            # Ensure notebook_id is present
-            chunk['notebook_id'] = nb['id']
-            # Ensure created_at
-            if 'created_at' not in chunk:
-                chunk['created_at'] = time.time()
-                
-            chunks_to_insert.append(chunk)
-            
-        # Insert Sources
-        print(f"  Creating {len(sources)} sources...")
-        for s in sources.values():
-            create_source_db(
-                s['id'], 
-                s['notebook_id'], 
-                s['source_type'], 
-                s['file_name'], 
-                s['created_at'], 
-                s['meta_data']
-            )
-            
-        # Insert Chunks
-        print(f"  Inserting {len(chunks_to_insert)} chunks...")
-        if chunks_to_insert:
-            create_chunks_batch_db(chunks_to_insert)
-            
+
+        try:
+            migrate_notebook_chunks(nb, chunks_path, checkpoint, batch_size=batch_size)
+        except ValueError as e:
+            # Malformed chunks.json: keep what was committed, rerun resumes here
+            print(f"  ERROR: Failed to read {chunks_path}: {e}")
+
     print("Migration completed successfully.")
 
 if __name__ == "__main__":
-    migrate()
+    parser = argparse.ArgumentParser(description="Migrate JSON notebooks to SQLite (resumable)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="chunks per commit")
+    parser.add_argument("--restart", action="store_true", help=f"ignore {CHECKPOINT_PATH} and start over")
+    args = parser.parse_args()
+    migrate(batch_size=args.batch_size, restart=args.restart)